@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic import BaseSettings
 from dotenv import load_dotenv
 
@@ -9,6 +11,101 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 1440
 
+    # Database connection pool. Set DB_PREPARED_STATEMENT_CACHE_SIZE to 0
+    # when connecting through pgbouncer in transaction mode.
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT_SECONDS: float = 30.0
+    DB_POOL_RECYCLE_SECONDS: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_STATEMENT_CACHE_SIZE: int = 500
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 100
+    DB_COMMAND_TIMEOUT_SECONDS: float = 60.0
+
+    # Optional read replica for GraphQL queries. A tenant's reads stay on the
+    # primary for DB_READ_YOUR_WRITES_SECONDS after its own mutations.
+    DATABASE_REPLICA_URL: Optional[str] = None
+    DB_READ_YOUR_WRITES_SECONDS: int = 15
+    DB_RECENT_WRITERS_SIZE: int = 10000
+
+    # Decoded access token cache
+    AUTH_TOKEN_CACHE_SIZE: int = 10000
+    AUTH_TOKEN_CACHE_TTL_SECONDS: int = 300
+
+    # Password hashing
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASH_WORKERS: int = 4
+    PASSWORD_HASH_MAX_QUEUE: int = 64
+
+    # Outbound M-Pesa / payment service HTTP
+    MPESA_HTTP2: bool = True
+    MPESA_HTTP_TIMEOUT_SECONDS: float = 20.0
+    MPESA_HTTP_MAX_CONNECTIONS: int = 20
+    MPESA_HTTP_MAX_KEEPALIVE: int = 10
+    MPESA_HTTP_KEEPALIVE_EXPIRY_SECONDS: float = 30.0
+    MPESA_TOKEN_REFRESH_MARGIN_SECONDS: int = 60
+
+    # Payment endpoints: Daraja for direct STK pushes, the lipay payment
+    # microservice for the default path
+    MPESA_DARAJA_BASE_URL: str = "https://sandbox.safaricom.co.ke"
+    LIPAY_GRAPHQL_URL: str = "https://finance.lipay.store/graphql"
+
+    # Pending M-Pesa transaction reconciliation
+    MPESA_RECONCILE_INTERVAL_SECONDS: int = 60
+    MPESA_RECONCILE_MIN_AGE_SECONDS: int = 120
+    MPESA_RECONCILE_EXPIRE_AFTER_SECONDS: int = 3600
+    MPESA_RECONCILE_BATCH_SIZE: int = 100
+    MPESA_RECONCILE_CONCURRENCY: int = 5
+
+    # MikroTik API client
+    MIKROTIK_CONNECT_TIMEOUT_SECONDS: float = 10.0
+    MIKROTIK_COMMAND_TIMEOUT_SECONDS: float = 10.0
+
+    # MikroTik connection pool
+    MIKROTIK_POOL_MAX_SESSIONS_PER_ROUTER: int = 4
+    MIKROTIK_POOL_IDLE_TIMEOUT_SECONDS: int = 300
+    MIKROTIK_POOL_HEALTH_CHECK_INTERVAL_SECONDS: int = 30
+    MIKROTIK_POOL_ACQUIRE_TIMEOUT_SECONDS: float = 15.0
+
+    # Router hotspot state mirror
+    ROUTER_STATE_REFRESH_SECONDS: int = 30
+    ROUTER_STATE_MAX_STALENESS_SECONDS: int = 60
+    ROUTER_STATE_IDLE_SECONDS: int = 600
+    ROUTER_STATE_FOLLOW: bool = False
+
+    # Provisioning job queue
+    PROVISIONING_POLL_INTERVAL_SECONDS: float = 2.0
+    PROVISIONING_MAX_IN_FLIGHT: int = 32
+    PROVISIONING_WORKERS_PER_ROUTER: int = 2
+    PROVISIONING_MAX_ATTEMPTS: int = 8
+    PROVISIONING_RETRY_BASE_SECONDS: float = 5.0
+    PROVISIONING_RETRY_MAX_SECONDS: float = 900.0
+    PROVISIONING_LOCK_TIMEOUT_SECONDS: int = 300
+    BULK_PROVISION_MAX_CUSTOMERS: int = 1000
+
+    # Expiry enforcement
+    EXPIRY_BATCH_SIZE: int = 200
+    EXPIRY_MAX_SLEEP_SECONDS: int = 60
+    EXPIRY_TEARDOWN_GRACE_SECONDS: int = 120
+
+    # Payment callback de-duplication
+    CALLBACK_RECENT_KEYS: int = 10000
+    CALLBACK_RECENT_TTL_SECONDS: int = 86400
+    # processed_callbacks rows are kept well past the gateways' retry window
+    CALLBACK_RETENTION_DAYS: int = 30
+    CALLBACK_PRUNE_INTERVAL_SECONDS: int = 3600
+    CALLBACK_PRUNE_BATCH_SIZE: int = 5000
+
+    # Reseller financial counters
+    FINANCIALS_RECONCILE_INTERVAL_SECONDS: int = 3600
+
+    # Dashboard metrics cache
+    DASHBOARD_CACHE_TTL_SECONDS: int = 30
+    DASHBOARD_CACHE_MAX_TENANTS: int = 5000
+
+    # Streaming CSV / NDJSON exports
+    EXPORT_BATCH_SIZE: int = 1000
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
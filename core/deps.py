@@ -1,7 +1,11 @@
+import hashlib
+import time
+from typing import Optional, Union
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.cache import TTLCache
 from app.core.security import ALGORITHM
 from app.config import settings
 from app.db.database import get_db
@@ -15,9 +19,16 @@ class CurrentUser(BaseModel):
     role: str
     organization_name: str
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> CurrentUser:
-    if not token:
-        return None  # Allow unauthenticated access
+# Decoded claims by sha256(token); entries never outlive the token's exp
+token_cache = TTLCache(maxsize=settings.AUTH_TOKEN_CACHE_SIZE, ttl=settings.AUTH_TOKEN_CACHE_TTL_SECONDS)
+
+def decode_token(token: str) -> CurrentUser:
+    """Validate a bearer token and return its claims, from token_cache when possible"""
+    key = hashlib.sha256(token.encode()).hexdigest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -25,19 +36,32 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> CurrentUser:
     )
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[ALGORITHM])
-        user_code: str = payload.get("sub")
-        user_id: str = payload.get("user_id")
-        role: str = payload.get("role")
-        organization_name: str = payload.get("organization_name")
-        if not all([user_code, user_id, role, organization_name]):
-            raise credentials_exception
-        return CurrentUser(
-            user_code=int(user_code),
-            user_id=int(user_id),
-            role=role,
-            organization_name=organization_name
-        )
     except JWTError:
         raise credentials_exception
-    
-    
\ No newline at end of file
+    user_code: str = payload.get("sub")
+    user_id: str = payload.get("user_id")
+    role: str = payload.get("role")
+    organization_name: str = payload.get("organization_name")
+    if not all([user_code, user_id, role, organization_name]):
+        raise credentials_exception
+    user = CurrentUser(
+        user_code=int(user_code),
+        user_id=int(user_id),
+        role=role,
+        organization_name=organization_name
+    )
+
+    ttl = token_cache.ttl
+    if payload.get("exp"):
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        token_cache.set(key, user, ttl=ttl)
+    return user
+
+async def get_current_user(token: Union[str, CurrentUser, None] = Depends(oauth2_scheme)) -> Optional[CurrentUser]:
+    if not token:
+        return None  # Allow unauthenticated access
+    if isinstance(token, CurrentUser):
+        # Already decoded once for this request by get_context
+        return token
+    return decode_token(token)
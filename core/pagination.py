@@ -0,0 +1,34 @@
+import base64
+import binascii
+from datetime import datetime
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """Opaque cursor for keyset pagination on (timestamp, id)"""
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_page(stmt, timestamp_column, id_column, first: int, after: Optional[str] = None):
+    """
+    Newest-first page of first + 1 rows (the extra row tells whether another
+    page exists). Rows are located with a (timestamp, id) row comparison, so
+    any page costs the same index seek as the first one.
+    """
+    stmt = stmt.where(timestamp_column.isnot(None))
+    if after:
+        timestamp, row_id = decode_cursor(after)
+        stmt = stmt.where(tuple_(timestamp_column, id_column) < (timestamp, row_id))
+    return stmt.order_by(timestamp_column.desc(), id_column.desc()).limit(first + 1)
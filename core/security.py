@@ -1,4 +1,97 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-ALGORITHM = "HS256"
\ No newline at end of file
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Hashes at any other cost are flagged by verify_and_update and rehashed on login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
+ALGORITHM = "HS256"
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a small thread pool so a hash (hundreds of ms of CPU)
+    never blocks the event loop. bcrypt releases the GIL, so the workers run
+    in parallel with the loop. At most PASSWORD_HASH_WORKERS operations run at
+    once; callers beyond that wait, and once PASSWORD_HASH_MAX_QUEUE are
+    waiting new requests get a 503 instead of piling up behind a login burst.
+    """
+
+    def __init__(
+        self,
+        workers: int = settings.PASSWORD_HASH_WORKERS,
+        max_queue: int = settings.PASSWORD_HASH_MAX_QUEUE,
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+        self._in_flight = 0
+        self._durations = deque(maxlen=500)
+        self.counters = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0}
+
+    async def _run(self, fn, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if self._waiting >= self.max_queue:
+            self.counters["rejected"] += 1
+            logger.warning(f"Password hashing queue full ({self._waiting} waiting), rejecting request")
+            raise HTTPException(status_code=503, detail="Server busy, please try again shortly")
+
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+            self._durations.append(time.monotonic() - started)
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._run(pwd_context.hash, password)
+        self.counters["hashed"] += 1
+        return hashed
+
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """(matches, new_hash); new_hash is set when the stored hash uses another cost"""
+        valid, new_hash = await self._run(pwd_context.verify_and_update, password, hashed)
+        self.counters["verified"] += 1
+        if new_hash:
+            self.counters["rehashed"] += 1
+        return valid, new_hash
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "workers": self.workers,
+            "in_flight": self._in_flight,
+            "queued": self._waiting,
+            "avg_ms": round(1000 * sum(self._durations) / len(self._durations), 1) if self._durations else 0.0,
+        }
+
+
+password_hasher = PasswordHasher()
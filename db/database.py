@@ -1,29 +1,189 @@
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from app.config import settings
+from app.core.cache import TTLCache
+
+logger = logging.getLogger(__name__)
 
 # ✅ Required for defining models
 Base = declarative_base()
 
 # Replace sync driver with async driver
 DATABASE_URL = settings.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
+DATABASE_REPLICA_URL = (
+    settings.DATABASE_REPLICA_URL.replace("postgresql://", "postgresql+asyncpg://")
+    if settings.DATABASE_REPLICA_URL else None
+)
+
+
+class PoolTelemetry:
+    """
+    Counters for the engine's connection pool. Checkout time covers waiting
+    for a free connection plus the pre-ping; a pool that is too small shows
+    up as a rising avg/max wait and timeouts while in_use sits at
+    pool_size + max_overflow.
+    """
+
+    def __init__(self):
+        self.engine = None
+        self._waits = deque(maxlen=500)
+        self._max_wait = 0.0
+        self.counters = {"checkouts": 0, "timeouts": 0, "connects": 0, "invalidated": 0}
+
+    def record_checkout(self, seconds: float):
+        self.counters["checkouts"] += 1
+        self._waits.append(seconds)
+        self._max_wait = max(self._max_wait, seconds)
+
+    def record_timeout(self, seconds: float):
+        self.counters["timeouts"] += 1
+        logger.warning(f"Database pool checkout timed out after {seconds:.1f}s")
+
+    def stats(self) -> dict:
+        pool = self.engine.pool if self.engine is not None else None
+        return {
+            **self.counters,
+            "pool_size": pool.size() if pool else 0,
+            "in_use": pool.checkedout() if pool else 0,
+            "idle": pool.checkedin() if pool else 0,
+            "overflow": max(pool.overflow(), 0) if pool else 0,
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "avg_wait_ms": round(1000 * sum(self._waits) / len(self._waits), 1) if self._waits else 0.0,
+            "max_wait_ms": round(1000 * self._max_wait, 1),
+        }
+
+
+pool_telemetry = PoolTelemetry()
+replica_pool_telemetry = PoolTelemetry()
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that times every checkout into its engine's telemetry"""
+
+    telemetry: PoolTelemetry = pool_telemetry
+
+    def connect(self):
+        started = time.monotonic()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.telemetry.record_timeout(time.monotonic() - started)
+            raise
+        self.telemetry.record_checkout(time.monotonic() - started)
+        return connection
+
+
+class ReplicaPool(InstrumentedPool):
+    # dispose() rebuilds a pool from its class alone, so the telemetry it
+    # reports to is a class attribute rather than a constructor argument
+    telemetry = replica_pool_telemetry
+
+
+def _create_engine(url: str, pool_class=InstrumentedPool):
+    telemetry = pool_class.telemetry
+    engine = create_async_engine(
+        url,
+        echo=False,
+        future=True,
+        poolclass=pool_class,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT_SECONDS,
+        pool_recycle=settings.DB_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        query_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+        connect_args={
+            "prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE,
+            "command_timeout": settings.DB_COMMAND_TIMEOUT_SECONDS,
+        },
+    )
+    telemetry.engine = engine
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _count_connect(dbapi_connection, connection_record):
+        telemetry.counters["connects"] += 1
+
+    @event.listens_for(engine.sync_engine, "invalidate")
+    def _count_invalidate(dbapi_connection, connection_record, exception):
+        telemetry.counters["invalidated"] += 1
+
+    return engine
+
 
 # Create async engine
-async_engine = create_async_engine(
-    DATABASE_URL,
-    echo=False,
-    future=True
-)
+async_engine = _create_engine(DATABASE_URL)
+
+# Read replica for reporting reads; without one, reads go to the primary
+replica_engine = _create_engine(DATABASE_REPLICA_URL, ReplicaPool) if DATABASE_REPLICA_URL else async_engine
+
+class WriteTrackingSession(Session):
+    """Session that sets info["wrote"] once it flushes or runs anything but a SELECT"""
+
+
+@event.listens_for(WriteTrackingSession, "after_flush")
+def _flagged_flush(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(WriteTrackingSession, "do_orm_execute")
+def _flagged_execute(orm_execute_state):
+    # text() statements count as writes since they can't be told apart
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["wrote"] = True
+
+
+def old_value(obj, attribute: str):
+    """An attribute's value as loaded from the database, for flush hooks computing deltas"""
+    history = inspect(obj).attrs[attribute].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, attribute)
+
 
 # Create sessionmaker for async sessions
 AsyncSessionLocal = sessionmaker(
     bind=async_engine,
     class_=AsyncSession,
+    sync_session_class=WriteTrackingSession,
     expire_on_commit=False,
     autocommit=False,
     autoflush=False
 )
 
+ReplicaSessionLocal = sessionmaker(
+    bind=replica_engine,
+    class_=AsyncSession,
+    sync_session_class=WriteTrackingSession,
+    expire_on_commit=False,
+    autocommit=False,
+    autoflush=False
+)
+
+# Tenants that wrote recently read from the primary until the replica has caught up
+recent_writers = TTLCache(maxsize=settings.DB_RECENT_WRITERS_SIZE, ttl=settings.DB_READ_YOUR_WRITES_SECONDS)
+
+
+def has_replica() -> bool:
+    return replica_engine is not async_engine
+
+
+def mark_tenant_write(tenant_id: int):
+    recent_writers.set(tenant_id, True)
+
+
+def reads_from_primary(tenant_id: Optional[int]) -> bool:
+    """True when this tenant's reads must see its own writes, or there is no replica"""
+    return not has_replica() or (tenant_id is not None and tenant_id in recent_writers)
+
+
 # Dependency for using DB session in route handlers
 async def get_db():
     async with AsyncSessionLocal() as session:
@@ -36,5 +196,45 @@ async def get_db():
         finally:
             await session.close()
 
+class LazySession:
+    """
+    Stands in for an AsyncSession that is only created on first use, for
+    request contexts where many requests never touch the database. finish()
+    commits only if the session wrote something; a read-only transaction is
+    just rolled back when the session closes, and an unused one costs nothing.
+    """
+
+    def __init__(self, factory=AsyncSessionLocal):
+        self._factory = factory
+        self._session: Optional[AsyncSession] = None
+
+    @property
+    def session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._factory()
+        return self._session
+
+    @property
+    def started(self) -> bool:
+        return self._session is not None
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    async def finish(self, failed: bool = False):
+        session = self._session
+        if session is None:
+            return
+        try:
+            if failed:
+                await session.rollback()
+            elif session.info.get("wrote") or session.new or session.dirty or session.deleted:
+                await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
 # Alias for the cleanup worker
-async_session = AsyncSessionLocal
\ No newline at end of file
+async_session = AsyncSessionLocal
@@ -0,0 +1,316 @@
+"""
+Plan regression check for the hot query paths.
+
+Seeds a synthetic tenant population inside a transaction, ANALYZEs it, runs
+EXPLAIN on the queries the API issues per request and fails if any of them
+reads its main table with a sequential scan. The transaction is rolled back,
+so nothing is left behind, but run it against a migrated staging or scratch
+database rather than production:
+
+    python -m app.db.migrate
+    python -m app.db.explain_check --customers 50000 --resellers 1000
+
+Only tenant-scoped and selective queries are listed; admin-wide listings
+legitimately scan whole tables. Seed enough resellers that routers, plans and
+subscriptions span more than a few pages, or the planner will (correctly)
+scan those small tables sequentially.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, NamedTuple, Sequence
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.core.pagination import encode_cursor, keyset_page
+from app.db.database import async_engine
+from app.db.models import (
+    ConnectionType, Customer, CustomerPayment, CustomerStatus, DurationUnit, MpesaTransaction,
+    MpesaTransactionStatus, PaymentDailyRollup, PaymentMethod, PaymentStatus, Plan, ProvisioningJob,
+    ProvisioningJobStatus, ProvisioningLog, Router, Subscription, User, UserRole
+)
+
+SEEDED_TABLES = [
+    "users", "routers", "plans", "customers", "customer_payments", "provisioning_logs",
+    "provisioning_jobs", "mpesa_transactions", "subscriptions", "payment_daily_rollups",
+]
+
+
+class PlanCheck(NamedTuple):
+    name: str
+    tables: Sequence[str]
+    stmt: Any
+
+
+async def _insert(conn: AsyncConnection, model, rows: List[Dict[str, Any]]) -> List[int]:
+    table = model.__table__
+    result = await conn.execute(insert(table).returning(table.c.id, sort_by_parameter_order=True), rows)
+    return list(result.scalars())
+
+
+async def seed(conn: AsyncConnection, customers: int, resellers: int) -> Dict[str, int]:
+    """Insert a skewed but realistic dataset; returns ids the checks filter on"""
+    rng = random.Random(14)
+    now = datetime.utcnow()
+
+    def ago(days: float) -> datetime:
+        return now - timedelta(days=days)
+
+    reseller_ids = await _insert(conn, User, [
+        {
+            "user_code": 9_000_000_000_000 + i,
+            "email": f"explain-check-{i}@example.invalid",
+            "password_hash": "x",
+            "role": UserRole.RESELLER,
+            "organization_name": f"Explain check {i}",
+            "created_at": now,
+        }
+        for i in range(resellers)
+    ])
+    router_rows = [
+        {"user_id": reseller_id, "name": f"router-{n}", "ip_address": "192.0.2.1",
+         "username": "admin", "password": "x", "port": 8728, "created_at": now}
+        for reseller_id in reseller_ids for n in range(2)
+    ]
+    router_ids = await _insert(conn, Router, router_rows)
+    routers_by_reseller: Dict[int, List[int]] = {}
+    for router_id, row in zip(router_ids, router_rows):
+        routers_by_reseller.setdefault(row["user_id"], []).append(router_id)
+
+    plan_rows = [
+        {"name": f"plan-{n}", "speed": "5M/5M", "price": 50, "duration_value": 1,
+         "duration_unit": DurationUnit.DAYS, "connection_type": ConnectionType.HOTSPOT,
+         "user_id": reseller_id, "created_at": now}
+        for reseller_id in reseller_ids for n in range(4)
+    ]
+    plan_ids = await _insert(conn, Plan, plan_rows)
+    plans_by_reseller: Dict[int, List[int]] = {}
+    for plan_id, row in zip(plan_ids, plan_rows):
+        plans_by_reseller.setdefault(row["user_id"], []).append(plan_id)
+
+    customer_rows = []
+    for i in range(customers):
+        reseller_id = rng.choice(reseller_ids)
+        status = rng.choices(
+            [CustomerStatus.ACTIVE, CustomerStatus.INACTIVE, CustomerStatus.PENDING], [70, 25, 5]
+        )[0]
+        # The expiry scheduler keeps overdue ACTIVE rows rare
+        expiry = now + timedelta(days=rng.uniform(-0.2, 30)) if status == CustomerStatus.ACTIVE else ago(rng.uniform(0, 90))
+        customer_rows.append({
+            "name": f"customer-{i}",
+            "phone": "254700000000",
+            "mac_address": ":".join(f"{b:02X}" for b in (0xEC, 0xEC) + tuple(i.to_bytes(4, "big"))),
+            "status": status,
+            "expiry": expiry,
+            "plan_id": rng.choice(plans_by_reseller[reseller_id]),
+            "user_id": reseller_id,
+            "router_id": rng.choice(routers_by_reseller[reseller_id]),
+            "created_at": ago(rng.uniform(0, 365)),
+        })
+    customer_ids = await _insert(conn, Customer, customer_rows)
+
+    payment_rows, log_rows, job_rows, mpesa_rows = [], [], [], []
+    for n, (customer_id, row) in enumerate(zip(customer_ids, customer_rows)):
+        for _ in range(2):
+            payment_rows.append({
+                "customer_id": customer_id,
+                "reseller_id": row["user_id"],
+                "plan_id": row["plan_id"],
+                "amount": 50.0,
+                "payment_method": rng.choice(list(PaymentMethod)),
+                "payment_date": ago(rng.uniform(0, 365)),
+                "days_paid_for": 1,
+                "status": rng.choices([PaymentStatus.COMPLETED, PaymentStatus.FAILED], [95, 5])[0],
+                "created_at": now,
+            })
+            log_rows.append({
+                "customer_id": customer_id,
+                "router_id": row["router_id"],
+                "mac_address": row["mac_address"],
+                "action": "HOTSPOT_BYPASS",
+                "status": "SUCCESS",
+                "log_date": ago(rng.uniform(0, 365)),
+            })
+        if n % 2 == 0:
+            job_rows.append({
+                "customer_id": customer_id,
+                "router_id": row["router_id"],
+                "action": "HOTSPOT_BYPASS",
+                "payload": {"mac_address": row["mac_address"]},
+                "status": rng.choices([ProvisioningJobStatus.SUCCEEDED, ProvisioningJobStatus.PENDING], [98, 2])[0],
+                "attempts": 1,
+                "max_attempts": 8,
+                "next_attempt_at": ago(rng.uniform(0, 30)),
+                "created_at": now,
+                "updated_at": now,
+            })
+        mpesa_rows.append({
+            "checkout_request_id": f"ws_CO_EXPLAIN_{n}",
+            "phone_number": "254700000000",
+            "amount": 50,
+            "reference": row["mac_address"],
+            "status": rng.choices(
+                [MpesaTransactionStatus.completed, MpesaTransactionStatus.pending, MpesaTransactionStatus.failed],
+                [97, 2, 1]
+            )[0],
+            "customer_id": customer_id,
+            "mpesa_receipt_number": f"EXPL{n:08d}",
+            "created_at": ago(rng.uniform(0, 365)),
+            "updated_at": now,
+        })
+    await _insert(conn, CustomerPayment, payment_rows)
+    await _insert(conn, ProvisioningLog, log_rows)
+    await _insert(conn, ProvisioningJob, job_rows)
+    await _insert(conn, MpesaTransaction, mpesa_rows)
+    await _insert(conn, Subscription, [
+        {"user_id": reseller_id, "is_active": True, "paid_on": ago(10), "expires_on": now + timedelta(days=20),
+         "plan_type": "monthly", "cost": 500.0}
+        for reseller_id in reseller_ids
+    ])
+
+    day = func.date(CustomerPayment.payment_date)
+    await conn.execute(
+        insert(PaymentDailyRollup.__table__).from_select(
+            ["reseller_id", "day", "payment_method", "total_amount", "payment_count"],
+            select(CustomerPayment.reseller_id, day, CustomerPayment.payment_method,
+                   func.sum(CustomerPayment.amount), func.count(CustomerPayment.id))
+            .where(CustomerPayment.reseller_id.in_(reseller_ids), CustomerPayment.status == PaymentStatus.COMPLETED)
+            .group_by(CustomerPayment.reseller_id, day, CustomerPayment.payment_method)
+        )
+    )
+
+    for table in SEEDED_TABLES:
+        await conn.exec_driver_sql(f"ANALYZE {table}")
+
+    reseller_id = reseller_ids[0]
+    customer_index = next(i for i, row in enumerate(customer_rows) if row["user_id"] == reseller_id)
+    return {
+        "reseller_id": reseller_id,
+        "router_id": routers_by_reseller[reseller_id][0],
+        "customer_id": customer_ids[customer_index],
+        "mac_address": customer_rows[customer_index]["mac_address"],
+        "plan_id": customer_rows[customer_index]["plan_id"],
+    }
+
+
+def checks(ids: Dict[str, int]) -> List[PlanCheck]:
+    """The per-request queries, as issued by the resolvers and services"""
+    now = datetime.utcnow()
+    reseller_id, router_id, customer_id = ids["reseller_id"], ids["router_id"], ids["customer_id"]
+    cursor = encode_cursor(now - timedelta(days=30), 2 ** 31 - 1)
+    reseller_payments = select(CustomerPayment).where(CustomerPayment.reseller_id == reseller_id)
+    reseller_logs = select(ProvisioningLog).join(Router).where(Router.user_id == reseller_id)
+
+    return [
+        PlanCheck("my_customers", ["customers"], select(Customer).where(Customer.user_id == reseller_id)),
+        PlanCheck("dashboard_customer_counts", ["customers"], select(
+            func.count(), func.count().filter(Customer.status == CustomerStatus.ACTIVE)
+        ).select_from(Customer).where(Customer.user_id == reseller_id)),
+        PlanCheck("active_customer_count", ["customers"], select(func.count(Customer.id)).where(
+            Customer.user_id == reseller_id, Customer.status == CustomerStatus.ACTIVE
+        )),
+        PlanCheck("customer_by_mac", ["customers"], select(Customer).where(Customer.mac_address == ids["mac_address"])),
+        PlanCheck("router_customers", ["customers"], select(Customer).where(Customer.router_id == router_id)),
+        PlanCheck("expiry_due_batch", ["customers"], select(Customer.id).where(
+            Customer.status == CustomerStatus.ACTIVE, Customer.expiry <= now
+        ).order_by(Customer.expiry).limit(200)),
+        PlanCheck("next_expiry", ["customers"], select(func.min(Customer.expiry)).where(
+            Customer.status == CustomerStatus.ACTIVE
+        )),
+        PlanCheck("my_payments", ["customer_payments"], reseller_payments.order_by(
+            CustomerPayment.payment_date.desc()
+        ).limit(50).offset(100)),
+        PlanCheck("my_payments_connection", ["customer_payments"], keyset_page(
+            reseller_payments, CustomerPayment.payment_date, CustomerPayment.id, 50, cursor
+        )),
+        PlanCheck("customer_payment_history", ["customer_payments"], select(CustomerPayment).where(
+            CustomerPayment.customer_id == customer_id
+        ).order_by(CustomerPayment.payment_date.desc())),
+        PlanCheck("payment_summary_today", ["customer_payments"], select(
+            func.sum(CustomerPayment.amount), func.count(CustomerPayment.id)
+        ).where(
+            CustomerPayment.reseller_id == reseller_id,
+            CustomerPayment.status == PaymentStatus.COMPLETED,
+            CustomerPayment.payment_date >= now.replace(hour=0, minute=0, second=0, microsecond=0)
+        )),
+        PlanCheck("payment_summary_rollups", ["payment_daily_rollups"], select(
+            func.sum(PaymentDailyRollup.total_amount)
+        ).where(PaymentDailyRollup.reseller_id == reseller_id, PaymentDailyRollup.day < now.date())),
+        PlanCheck("my_provisioning_logs_admin", ["provisioning_logs"], select(ProvisioningLog).join(Router).order_by(
+            ProvisioningLog.log_date.desc()
+        ).limit(50)),
+        PlanCheck("my_provisioning_logs_reseller", ["provisioning_logs"], reseller_logs.order_by(
+            ProvisioningLog.log_date.desc()
+        ).limit(50)),
+        PlanCheck("my_provisioning_logs_connection", ["provisioning_logs"], keyset_page(
+            reseller_logs, ProvisioningLog.log_date, ProvisioningLog.id, 50, cursor
+        )),
+        PlanCheck("my_plans", ["plans"], select(Plan).where(Plan.user_id == reseller_id)),
+        PlanCheck("plan_stats_customer_count", ["customers"], select(func.count(Customer.id)).where(
+            Customer.plan_id == ids["plan_id"]
+        )),
+        PlanCheck("plan_stats_revenue", ["customer_payments"], select(func.sum(CustomerPayment.amount)).where(
+            CustomerPayment.plan_id == ids["plan_id"], CustomerPayment.status == PaymentStatus.COMPLETED
+        )),
+        PlanCheck("my_routers", ["routers"], select(Router).where(Router.user_id == reseller_id)),
+        PlanCheck("active_subscription", ["subscriptions"], select(func.max(Subscription.expires_on)).where(
+            Subscription.user_id == reseller_id, Subscription.is_active == True
+        )),
+        PlanCheck("provisioning_claim", ["provisioning_jobs"], select(ProvisioningJob).where(
+            ProvisioningJob.status == ProvisioningJobStatus.PENDING, ProvisioningJob.next_attempt_at <= now
+        ).order_by(ProvisioningJob.next_attempt_at).limit(64)),
+        PlanCheck("pending_mpesa_transactions", ["mpesa_transactions"], select(MpesaTransaction).where(
+            MpesaTransaction.status == MpesaTransactionStatus.pending
+        )),
+        PlanCheck("mpesa_by_receipt", ["mpesa_transactions"], select(MpesaTransaction).where(
+            MpesaTransaction.mpesa_receipt_number == "EXPL00000042"
+        )),
+    ]
+
+
+def _nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _nodes(child)
+
+
+async def explain(conn: AsyncConnection, check: PlanCheck) -> List[str]:
+    """Returns the scan nodes on the checked tables, e.g. 'Index Scan using ix_... on customers'"""
+    sql = str(check.stmt.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    raw = (await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+    scans = []
+    for node in _nodes(plan):
+        if node.get("Relation Name") in check.tables:
+            using = f" using {node['Index Name']}" if node.get("Index Name") else ""
+            scans.append(f"{node['Node Type']}{using} on {node['Relation Name']}")
+    return scans
+
+
+async def run(customers: int, resellers: int) -> bool:
+    ok = True
+    async with async_engine.connect() as conn:
+        transaction = await conn.begin()
+        try:
+            ids = await seed(conn, customers, resellers)
+            for check in checks(ids):
+                scans = await explain(conn, check)
+                sequential = any(scan.startswith("Seq Scan") for scan in scans)
+                ok = ok and not sequential
+                print(f"{'FAIL' if sequential else 'ok  '}  {check.name:<34} {'; '.join(scans)}")
+        finally:
+            await transaction.rollback()
+    await async_engine.dispose()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail if a hot query path plans a sequential scan")
+    parser.add_argument("--customers", type=int, default=50000, help="customers to seed")
+    parser.add_argument("--resellers", type=int, default=1000, help="resellers to spread them over")
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args.customers, args.resellers)) else 1)
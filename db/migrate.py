@@ -0,0 +1,134 @@
+"""
+Versioned SQL migrations.
+
+Files in db/migrations are applied in name order and recorded in
+schema_migrations, so each runs once per database:
+
+    python -m app.db.migrate            # apply pending migrations
+    python -m app.db.migrate --list     # show applied / pending
+
+A file runs in a single transaction together with its schema_migrations row
+unless its first line is "-- migrate: no-transaction" (needed for CREATE INDEX
+CONCURRENTLY). Those statements run one by one in autocommit mode and should
+be idempotent (IF NOT EXISTS), because a failure part-way leaves the earlier
+statements applied. A CONCURRENTLY build that fails leaves an INVALID index
+behind; drop it before re-running.
+"""
+import argparse
+import asyncio
+import logging
+from pathlib import Path
+from typing import List, Set
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.db.database import async_engine
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+NO_TRANSACTION = "-- migrate: no-transaction"
+RECORD_VERSION = text("INSERT INTO schema_migrations (version) VALUES (:version)")
+
+
+def split_statements(sql: str) -> List[str]:
+    """Split a script on top-level semicolons, respecting quotes, comments and $$ bodies"""
+    statements, current = [], []
+    i, quote = 0, None
+    while i < len(sql):
+        if quote:
+            end = sql.find(quote, i)
+            end = len(sql) if end == -1 else end + len(quote)
+            current.append(sql[i:end])
+            i, quote = end, None
+            continue
+        char = sql[i]
+        if sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end
+            continue
+        if char == "'":
+            quote = "'"
+            current.append(char)
+            i += 1
+            continue
+        if char == "$":
+            end = sql.find("$", i + 1)
+            tag = sql[i:end + 1] if end != -1 else ""
+            if tag and (tag == "$$" or tag[1:-1].isidentifier()):
+                quote = tag
+                current.append(tag)
+                i = end + 1
+                continue
+        if char == ";":
+            statements.append("".join(current).strip())
+            current = []
+        else:
+            current.append(char)
+        i += 1
+    statements.append("".join(current).strip())
+    return [statement for statement in statements if statement]
+
+
+def migration_files() -> List[Path]:
+    return sorted(MIGRATIONS_DIR.glob("*.sql"))
+
+
+async def _ensure_table(conn: AsyncConnection):
+    await conn.exec_driver_sql(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version VARCHAR(255) PRIMARY KEY, "
+        "applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))"
+    )
+
+
+async def applied_versions() -> Set[str]:
+    async with async_engine.begin() as conn:
+        await _ensure_table(conn)
+        result = await conn.exec_driver_sql("SELECT version FROM schema_migrations")
+        return {row[0] for row in result}
+
+
+async def apply(path: Path):
+    sql = path.read_text()
+    async with async_engine.connect() as conn:
+        if sql.lstrip().startswith(NO_TRANSACTION):
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for statement in split_statements(sql):
+            await conn.exec_driver_sql(statement)
+        await conn.execute(RECORD_VERSION, {"version": path.stem})
+        await conn.commit()
+
+
+async def migrate() -> List[str]:
+    """Apply all pending migrations; returns the versions applied"""
+    done = await applied_versions()
+    applied = []
+    for path in migration_files():
+        if path.stem in done:
+            continue
+        logger.info(f"Applying migration {path.name}")
+        await apply(path)
+        applied.append(path.stem)
+    return applied
+
+
+async def main(list_only: bool = False):
+    try:
+        if list_only:
+            done = await applied_versions()
+            for path in migration_files():
+                print(f"{'applied' if path.stem in done else 'pending'}  {path.stem}")
+            return
+        applied = await migrate()
+        print(f"Applied {len(applied)} migration(s)" + (f": {', '.join(applied)}" if applied else ""))
+    finally:
+        await async_engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Apply SQL migrations from db/migrations")
+    parser.add_argument("--list", action="store_true", help="show applied and pending migrations")
+    asyncio.run(main(parser.parse_args().list))
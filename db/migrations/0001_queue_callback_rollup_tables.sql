@@ -0,0 +1,56 @@
+-- Tables behind the provisioning queue, callback de-duplication and the
+-- daily payment rollups.
+
+DO $$
+BEGIN
+    CREATE TYPE provisioningjobstatus AS ENUM ('PENDING', 'RUNNING', 'SUCCEEDED', 'DEAD');
+EXCEPTION
+    WHEN duplicate_object THEN NULL;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS provisioning_jobs (
+    id SERIAL PRIMARY KEY,
+    customer_id INTEGER NOT NULL REFERENCES customers (id),
+    router_id INTEGER NOT NULL REFERENCES routers (id),
+    action VARCHAR NOT NULL,
+    payload JSON NOT NULL,
+    status provisioningjobstatus NOT NULL,
+    attempts INTEGER NOT NULL,
+    max_attempts INTEGER NOT NULL,
+    next_attempt_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    locked_at TIMESTAMP WITHOUT TIME ZONE,
+    last_error VARCHAR(255),
+    created_at TIMESTAMP WITHOUT TIME ZONE,
+    updated_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS ix_provisioning_jobs_status_next_attempt
+    ON provisioning_jobs (status, next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS processed_callbacks (
+    id SERIAL PRIMARY KEY,
+    idempotency_key VARCHAR(255) NOT NULL UNIQUE,
+    customer_ref VARCHAR(50),
+    status VARCHAR(20),
+    created_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+CREATE TABLE IF NOT EXISTS payment_daily_rollups (
+    id SERIAL PRIMARY KEY,
+    reseller_id INTEGER NOT NULL REFERENCES users (id),
+    day DATE NOT NULL,
+    payment_method paymentmethod NOT NULL,
+    total_amount FLOAT NOT NULL,
+    payment_count INTEGER NOT NULL,
+    CONSTRAINT uq_payment_daily_rollups_reseller_day_method UNIQUE (reseller_id, day, payment_method)
+);
+
+-- Backfill from existing payments; the financials reconciler repairs any
+-- reseller whose rollups drift afterwards.
+INSERT INTO payment_daily_rollups (reseller_id, day, payment_method, total_amount, payment_count)
+SELECT reseller_id, date(payment_date), payment_method, sum(amount), count(id)
+FROM customer_payments
+WHERE status = 'COMPLETED' AND payment_date IS NOT NULL
+GROUP BY reseller_id, date(payment_date), payment_method
+ON CONFLICT ON CONSTRAINT uq_payment_daily_rollups_reseller_day_method DO NOTHING;
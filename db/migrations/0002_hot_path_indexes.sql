@@ -0,0 +1,49 @@
+-- migrate: no-transaction
+-- Composite indexes for the filters and sort orders used by the GraphQL
+-- resolvers, billing, dashboard, expiry and M-Pesa lookups. Built
+-- CONCURRENTLY so writes to these tables are not blocked while they build.
+
+-- Expiry scheduler: status = 'ACTIVE' AND expiry <= now ORDER BY expiry
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_customers_status_expiry
+    ON customers (status, expiry);
+
+-- Reseller customer lists, dashboard counts and financials recomputes
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_customers_user_status
+    ON customers (user_id, status);
+
+-- Router sync and bulk provisioning
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_customers_router_id
+    ON customers (router_id);
+
+-- my_payments / my_payments_connection: reseller_id = ? ORDER BY payment_date DESC, id DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_customer_payments_reseller_date_id
+    ON customer_payments (reseller_id, payment_date, id);
+
+-- Per-customer payment history and the customers -> payments revenue join
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_customer_payments_customer_date
+    ON customer_payments (customer_id, payment_date);
+
+-- my_provisioning_logs for admins: ORDER BY log_date DESC, id DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_provisioning_logs_log_date_id
+    ON provisioning_logs (log_date, id);
+
+-- my_provisioning_logs for resellers, reached through their routers
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_provisioning_logs_router_log_date_id
+    ON provisioning_logs (router_id, log_date, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_plans_user_id
+    ON plans (user_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_routers_user_id
+    ON routers (user_id);
+
+-- Active subscription lookup for the dashboard
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscriptions_user_active
+    ON subscriptions (user_id, is_active);
+
+-- Pending transaction sweeps, oldest first
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_mpesa_transactions_status_created
+    ON mpesa_transactions (status, created_at);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_mpesa_transactions_receipt_number
+    ON mpesa_transactions (mpesa_receipt_number);
@@ -0,0 +1,4 @@
+-- Result code and description reported by the callback or the STK status
+-- query; update_mpesa_transaction_status already writes them.
+ALTER TABLE mpesa_transactions ADD COLUMN IF NOT EXISTS result_code VARCHAR(20);
+ALTER TABLE mpesa_transactions ADD COLUMN IF NOT EXISTS result_desc VARCHAR(255);
@@ -0,0 +1,34 @@
+-- Per-plan customer counts and revenue for plan_metrics, kept current by the
+-- flush hook in services/plan_stats.py.
+
+-- Payments remember the plan they were made under, so revenue stays with
+-- that plan when the customer later switches.
+ALTER TABLE customer_payments
+    ADD COLUMN IF NOT EXISTS plan_id INTEGER REFERENCES plans (id) ON DELETE SET NULL;
+
+-- Older payments only have the customer's current plan to go by
+UPDATE customer_payments
+SET plan_id = customers.plan_id
+FROM customers
+WHERE customers.id = customer_payments.customer_id AND customer_payments.plan_id IS NULL;
+
+CREATE TABLE IF NOT EXISTS plan_stats (
+    id SERIAL PRIMARY KEY,
+    plan_id INTEGER NOT NULL UNIQUE REFERENCES plans (id) ON DELETE CASCADE,
+    customer_count INTEGER NOT NULL DEFAULT 0,
+    total_revenue FLOAT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITHOUT TIME ZONE
+);
+
+-- Backfill; the financials reconciler repairs any plan that drifts afterwards
+INSERT INTO plan_stats (plan_id, customer_count, total_revenue, updated_at)
+SELECT plans.id, coalesce(customer_counts.total, 0), coalesce(revenue.total, 0), now() AT TIME ZONE 'utc'
+FROM plans
+LEFT JOIN (
+    SELECT plan_id, count(*) AS total FROM customers GROUP BY plan_id
+) AS customer_counts ON customer_counts.plan_id = plans.id
+LEFT JOIN (
+    SELECT plan_id, sum(amount) AS total FROM customer_payments
+    WHERE status = 'COMPLETED' GROUP BY plan_id
+) AS revenue ON revenue.plan_id = plans.id
+ON CONFLICT (plan_id) DO NOTHING;
@@ -0,0 +1,9 @@
+-- migrate: no-transaction
+-- Lookups by plan for plan_stats bootstraps and reconciliation. Built
+-- CONCURRENTLY so writes to these tables are not blocked while they build.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_customers_plan_id
+    ON customers (plan_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_customer_payments_plan_id
+    ON customer_payments (plan_id);
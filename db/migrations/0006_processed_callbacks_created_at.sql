@@ -0,0 +1,6 @@
+-- migrate: no-transaction
+-- Retention sweep over processed_callbacks by age. Built CONCURRENTLY so
+-- callback claims are not blocked while it builds.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_processed_callbacks_created_at
+    ON processed_callbacks (created_at);
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Enum, DateTime, ForeignKey, Float, Boolean, BigInteger, DECIMAL
+from sqlalchemy import Column, Integer, String, Enum, Date, DateTime, ForeignKey, Float, Boolean, BigInteger, DECIMAL, Index, UniqueConstraint
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -11,6 +11,11 @@ class MpesaTransactionStatus(enum.Enum):
     completed = "completed"
     failed = "failed"
     expired = "expired"
+    # Uppercase aliases used by the services; they map to the same database labels
+    PENDING = "pending"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    EXPIRED = "expired"
 
 class UserRole(str, enum.Enum):
     ADMIN = "admin"
@@ -39,6 +44,12 @@ class PaymentMethod(str, enum.Enum):
     CARD = "card"
     OTHER = "other"
 
+class ProvisioningJobStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    DEAD = "dead"
+
 class DurationUnit(str, enum.Enum):
     HOURS = "HOURS"
     DAYS = "DAYS"
@@ -72,6 +83,12 @@ class Customer(Base):
     router_id = Column(Integer, ForeignKey("routers.id"), nullable=True)
     pending_update_data = Column(JSON, nullable=True)
     router = relationship("Router")
+    __table_args__ = (
+        Index("ix_customers_status_expiry", "status", "expiry"),
+        Index("ix_customers_user_status", "user_id", "status"),
+        Index("ix_customers_router_id", "router_id"),
+        Index("ix_customers_plan_id", "plan_id"),
+    )
 
 class Plan(Base):
     __tablename__ = "plans"
@@ -85,6 +102,9 @@ class Plan(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     router_profile = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_plans_user_id", "user_id"),
+    )
 
 class Payment(Base):
     __tablename__ = "payments"
@@ -108,10 +128,38 @@ class CustomerPayment(Base):
     status = Column(Enum(PaymentStatus), default=PaymentStatus.COMPLETED)
     notes = Column(String(500), nullable=True)
     lipay_tx_no = Column(String(255), nullable=True)  # <-- Add this line
+    # The customer's plan when the payment was recorded; set by the plan_stats flush hook
+    plan_id = Column(Integer, ForeignKey("plans.id", ondelete="SET NULL"), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     customer = relationship("Customer", backref="customer_payments")
     reseller = relationship("User", backref="received_payments", foreign_keys=[reseller_id])
+    __table_args__ = (
+        Index("ix_customer_payments_reseller_date_id", "reseller_id", "payment_date", "id"),
+        Index("ix_customer_payments_customer_date", "customer_id", "payment_date"),
+        Index("ix_customer_payments_plan_id", "plan_id"),
+    )
+
 
+class PaymentDailyRollup(Base):
+    __tablename__ = "payment_daily_rollups"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    reseller_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    payment_method = Column(Enum(PaymentMethod), nullable=False)
+    total_amount = Column(Float, nullable=False, default=0.0)
+    payment_count = Column(Integer, nullable=False, default=0)
+    __table_args__ = (
+        UniqueConstraint("reseller_id", "day", "payment_method", name="uq_payment_daily_rollups_reseller_day_method"),
+    )
+
+class PlanStats(Base):
+    """Per-plan counters behind plan_metrics, maintained by services.plan_stats"""
+    __tablename__ = "plan_stats"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    plan_id = Column(Integer, ForeignKey("plans.id", ondelete="CASCADE"), unique=True, nullable=False)
+    customer_count = Column(Integer, nullable=False, default=0)
+    total_revenue = Column(Float, nullable=False, default=0.0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 class ResellerFinancials(Base):
     __tablename__ = "reseller_financials"
@@ -133,6 +181,9 @@ class Subscription(Base):
     expires_on = Column(DateTime)
     plan_type = Column(String, nullable=False)
     cost = Column(Float, nullable=False)
+    __table_args__ = (
+        Index("ix_subscriptions_user_active", "user_id", "is_active"),
+    )
 
 class Router(Base):
     __tablename__ = "routers"
@@ -144,6 +195,9 @@ class Router(Base):
     password = Column(String, nullable=False)
     port = Column(Integer, nullable=False, default=8728)
     created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_routers_user_id", "user_id"),
+    )
 
 class ProvisioningLog(Base):
     __tablename__ = "provisioning_logs"
@@ -156,6 +210,41 @@ class ProvisioningLog(Base):
     error = Column(String(255))
     details = Column(String(255))
     log_date = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_provisioning_logs_log_date_id", "log_date", "id"),
+        Index("ix_provisioning_logs_router_log_date_id", "router_id", "log_date", "id"),
+    )
+
+class ProvisioningJob(Base):
+    __tablename__ = "provisioning_jobs"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
+    router_id = Column(Integer, ForeignKey("routers.id"), nullable=False)
+    action = Column(String, nullable=False)
+    payload = Column(JSON, nullable=False)
+    status = Column(Enum(ProvisioningJobStatus), nullable=False, default=ProvisioningJobStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=8)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_provisioning_jobs_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+class ProcessedCallback(Base):
+    __tablename__ = "processed_callbacks"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String(255), unique=True, nullable=False)
+    customer_ref = Column(String(50), nullable=True)
+    status = Column(String(20), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_processed_callbacks_created_at", "created_at"),
+    )
 
 class MpesaTransaction(Base):
     __tablename__ = "mpesa_transactions"
@@ -169,7 +258,13 @@ class MpesaTransaction(Base):
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=True)
     merchant_request_id = Column(String(255), nullable=True)
     mpesa_receipt_number = Column(String(255), nullable=True)
+    result_code = Column(String(20), nullable=True)
+    result_desc = Column(String(255), nullable=True)
     transaction_date = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_mpesa_transactions_status_created", "status", "created_at"),
+        Index("ix_mpesa_transactions_receipt_number", "mpesa_receipt_number"),
+    )
 
@@ -0,0 +1,35 @@
+import asyncio
+from typing import Callable, List
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from strawberry.dataloader import DataLoader
+
+from app.db.models import Customer, Plan, Router, User
+
+
+def _load_by_id(db: AsyncSession, model, lock: asyncio.Lock) -> Callable:
+    async def load(ids: List[int]) -> List:
+        # The loaders share the request's session, which can't run two
+        # statements at once, so batches of different types take turns
+        async with lock:
+            result = await db.execute(select(model).where(model.id.in_(set(ids))))
+        by_id = {row.id: row for row in result.scalars()}
+        return [by_id.get(id_) for id_ in ids]
+    return load
+
+
+class Loaders:
+    """
+    Request-scoped DataLoaders, created in get_context. Nested fields call
+    e.g. info.context["loaders"].plans.load(plan_id); every load issued while
+    a level of the query resolves is batched into one IN (...) query per type,
+    and repeats are served from the per-request cache. Missing ids load None.
+    """
+
+    def __init__(self, db: AsyncSession):
+        lock = asyncio.Lock()
+        self.plans = DataLoader(load_fn=_load_by_id(db, Plan, lock))
+        self.routers = DataLoader(load_fn=_load_by_id(db, Router, lock))
+        self.customers = DataLoader(load_fn=_load_by_id(db, Customer, lock))
+        self.users = DataLoader(load_fn=_load_by_id(db, User, lock))
@@ -13,7 +13,7 @@ from app.db.models import (
 from app.services.auth import create_user, authenticate_user
 from app.services.billing import register_customer, make_payment, create_plan
 from app.services.subscription import create_subscription
-from app.services.mpesa_transactions import save_mpesa_transaction, link_transaction_to_customer, update_mpesa_transaction_status
+from app.services.mpesa_transactions import save_mpesa_transaction, update_mpesa_transaction_status
 from app.graphql.types import UserType, CustomerType, PlanType, SubscriptionType, CustomerPaymentType, RouterType
 from app.core.deps import get_current_user
 from app.core.decorators import require_role
@@ -118,6 +118,8 @@ class Mutation:
             stmt = select(Customer).options(selectinload(Customer.plan)).where(Customer.id == customer.id)
             result = await db.execute(stmt)
             customer_with_plan = result.scalar_one()
+            if customer_with_plan.plan:
+                info.context["loaders"].plans.prime(customer_with_plan.plan.id, customer_with_plan.plan)
             
             return CustomerType(
                 id=customer_with_plan.id,
@@ -128,15 +130,8 @@ class Mutation:
                 static_ip=customer_with_plan.static_ip,
                 status=customer_with_plan.status.value,
                 expiry=customer_with_plan.expiry.timestamp() if customer_with_plan.expiry else None,
-                plan=PlanType(
-                    id=customer_with_plan.plan.id,
-                    name=customer_with_plan.plan.name,
-                    speed=customer_with_plan.plan.speed,
-                    price=customer_with_plan.plan.price,
-                    duration_value=customer_with_plan.plan.duration_value,
-                    duration_unit=customer_with_plan.plan.duration_unit.value,
-                    connection_type=customer_with_plan.plan.connection_type.value
-                ) if customer_with_plan.plan else None
+                plan_id=customer_with_plan.plan_id,
+                router_id=customer_with_plan.router_id
             )
             
         except HTTPException:
@@ -275,6 +270,8 @@ class Mutation:
             stmt = select(Customer).options(selectinload(Customer.plan)).where(Customer.id == customer.id)
             result = await db.execute(stmt)
             customer_with_plan = result.scalar_one()
+            if customer_with_plan.plan:
+                info.context["loaders"].plans.prime(customer_with_plan.plan.id, customer_with_plan.plan)
 
             return CustomerType(
                 id=customer_with_plan.id,
@@ -285,15 +282,8 @@ class Mutation:
                 static_ip=customer_with_plan.static_ip,
                 status=customer_with_plan.status.value,
                 expiry=customer_with_plan.expiry.timestamp() if customer_with_plan.expiry else None,
-                plan=PlanType(
-                    id=customer_with_plan.plan.id,
-                    name=customer_with_plan.plan.name,
-                    speed=customer_with_plan.plan.speed,
-                    price=customer_with_plan.plan.price,
-                    duration_value=customer_with_plan.plan.duration_value,
-                    duration_unit=customer_with_plan.plan.duration_unit.value,
-                    connection_type=customer_with_plan.plan.connection_type.value
-                ) if customer_with_plan.plan else None
+                plan_id=customer_with_plan.plan_id,
+                router_id=customer_with_plan.router_id
             )
             
         except HTTPException:
@@ -366,28 +356,33 @@ class Mutation:
             if not stk_response:
                 raise HTTPException(status_code=400, detail="Failed to initiate mobile money payment. Please try again.")
             
-            # Save transaction to database without customer_id
+            # The payment microservice answers with a dict, direct Daraja with StkPushResponse
+            if isinstance(stk_response, dict):
+                checkout_request_id = stk_response["checkoutRequestId"]
+                merchant_request_id = stk_response.get("merchantRequestId")
+                lipay_tx_no = stk_response.get("lipayTxNo")
+            else:
+                checkout_request_id = stk_response.checkout_request_id
+                merchant_request_id = stk_response.merchant_request_id
+                lipay_tx_no = None
+            
+            # Save the transaction already linked to the customer
             transaction = await save_mpesa_transaction(
                 db=db,
-                checkout_request_id=stk_response.checkout_request_id,
+                checkout_request_id=checkout_request_id,
                 phone_number=phone,
                 amount=amount,
                 reference=reference,
-                merchant_request_id=stk_response.merchant_request_id
-            )
-            
-            # Link transaction to customer using separate function
-            await link_transaction_to_customer(
-                db=db,
-                checkout_request_id=stk_response.checkout_request_id,
-                customer_id=customer_id
+                merchant_request_id=merchant_request_id,
+                customer_id=customer_id,
+                lipay_tx_no=lipay_tx_no
             )
             
-            logger.info(f"STK Push initiated for customer {customer_id}, checkout_request_id: {stk_response.checkout_request_id}")
+            logger.info(f"STK Push initiated for customer {customer_id}, checkout_request_id: {checkout_request_id}")
             
             return PaymentInitiationResponse(
                 message="Mobile money payment initiated successfully. Please check your phone to complete payment.",
-                checkout_request_id=stk_response.checkout_request_id,
+                checkout_request_id=checkout_request_id,
                 customer_id=customer_id,
                 status="PENDING"
             )
@@ -481,6 +476,8 @@ class Mutation:
             stmt = select(Customer).options(selectinload(Customer.plan)).where(Customer.id == customer_id)
             result = await db.execute(stmt)
             customer_with_plan = result.scalar_one()
+            if customer_with_plan.plan:
+                info.context["loaders"].plans.prime(customer_with_plan.plan.id, customer_with_plan.plan)
             
             return CustomerType(
                 id=customer_with_plan.id,
@@ -491,15 +488,8 @@ class Mutation:
                 static_ip=customer_with_plan.static_ip,
                 status=customer_with_plan.status.value,
                 expiry=customer_with_plan.expiry.timestamp() if customer_with_plan.expiry else None,
-                plan=PlanType(
-                    id=customer_with_plan.plan.id,
-                    name=customer_with_plan.plan.name,
-                    speed=customer_with_plan.plan.speed,
-                    price=customer_with_plan.plan.price,
-                    duration_value=customer_with_plan.plan.duration_value,
-                    duration_unit=customer_with_plan.plan.duration_unit.value,
-                    connection_type=customer_with_plan.plan.connection_type.value
-                ) if customer_with_plan.plan else None
+                plan_id=customer_with_plan.plan_id,
+                router_id=customer_with_plan.router_id
             )
             
         except HTTPException:
@@ -857,13 +847,11 @@ class Mutation:
                 payment_method_enum, days_paid_for, payment_reference, notes
             )
             
-            # Refresh to get customer relationship
-            await db.refresh(payment, ["customer"])
+            info.context["loaders"].customers.prime(customer.id, customer)
             
             return CustomerPaymentType(
                 id=payment.id,
                 customer_id=payment.customer_id,
-                customer_name=payment.customer.name,
                 amount=payment.amount,
                 payment_method=payment.payment_method.value,
                 payment_reference=payment.payment_reference,
@@ -1,15 +1,18 @@
 from typing import List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import func, select
-from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from fastapi import HTTPException
-from app.db.models import User, Customer, Plan, CustomerPayment, Subscription, UserRole, CustomerStatus, PaymentStatus, PaymentMethod, Router, ProvisioningLog, ResellerFinancials, ConnectionType
+from app.db.models import User, Plan, CustomerPayment, UserRole, PaymentStatus, Router, ProvisioningLog, ResellerFinancials, ConnectionType
 from app.core.deps import get_current_user
-from app.services.billing import get_customers_by_user, get_plans_by_user
-from app.graphql.types import UserType, CustomerType, PlanType, DashboardMetricsType, PlanMetricsType, CustomerPaymentType, ResellerFinancialSummary, PaymentSummary, RouterType, ProvisioningLogType
+from app.services.billing import get_customers_by_user, get_plans_by_user, filter_payments
+from app.services.dashboard import get_dashboard_metrics
+from app.services.reseller_payments import get_payment_summary
+from app.services.plan_stats import get_plan_metrics
+from app.graphql.types import UserType, CustomerType, PlanType, DashboardMetricsType, PlanMetricsType, CustomerPaymentType, ResellerFinancialSummary, PaymentSummary, RouterType, ProvisioningLogType, PageInfo, CustomerPaymentEdge, CustomerPaymentConnection, ProvisioningLogEdge, ProvisioningLogConnection
 from app.core.decorators import require_role
+from app.core.pagination import encode_cursor, keyset_page
 import strawberry
 import logging
 
@@ -22,6 +25,35 @@ def safe_log_error(message: str, error: Exception, user_id: Optional[int] = None
     except Exception:
         pass  # Don't let logging errors break the application
 
+def _payment_type(payment: CustomerPayment) -> CustomerPaymentType:
+    return CustomerPaymentType(
+        id=payment.id,
+        customer_id=payment.customer_id,
+        amount=float(payment.amount or 0),
+        payment_method=payment.payment_method.value if payment.payment_method else "UNKNOWN",
+        payment_reference=payment.payment_reference,
+        payment_date=payment.payment_date.isoformat() if payment.payment_date else datetime.utcnow().isoformat(),
+        days_paid_for=payment.days_paid_for or 0,
+        status=payment.status.value if payment.status else "UNKNOWN",
+        notes=payment.notes
+    )
+
+def _provisioning_log_type(log: ProvisioningLog) -> ProvisioningLogType:
+    return ProvisioningLogType(
+        id=log.id,
+        router_id=log.router_id,
+        customer_id=log.customer_id,
+        action=log.action or "Unknown Action",
+        status=log.status or "Unknown Status",
+        details=log.details,
+        mac_address=log.mac_address,
+        log_date=log.log_date.isoformat() if log.log_date else datetime.utcnow().isoformat()
+    )
+
+def _validate_first(first: int):
+    if first < 1 or first > 1000:
+        raise HTTPException(status_code=400, detail="first must be between 1 and 1000")
+
 @strawberry.type
 class Query:
     @strawberry.field
@@ -49,7 +81,7 @@ class Query:
     @require_role(["admin", "reseller"])
     async def my_customers(self, info) -> List[CustomerType]:
         """Get user's customers with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -72,19 +104,7 @@ class Query:
             customer_list = []
             for c in customers:
                 try:
-                    # Handle potential None values gracefully
-                    plan_data = None
-                    if c.plan:
-                        plan_data = PlanType(
-                            id=c.plan.id,
-                            name=c.plan.name or "Unknown Plan",
-                            speed=c.plan.speed or 0,
-                            price=c.plan.price or 0.0,
-                            duration_value=c.plan.duration_value or 0,
-                            duration_unit=c.plan.duration_unit.value if c.plan.duration_unit else "HOURS",
-                            connection_type=c.plan.connection_type.value if c.plan.connection_type else "HOTSPOT"
-                        )
-                    
+                    # plan and router resolve through the request's DataLoaders
                     customer_data = CustomerType(
                         id=c.id,
                         name=c.name or "Unknown Customer",
@@ -94,7 +114,8 @@ class Query:
                         static_ip=c.static_ip,
                         status=c.status.value if c.status else "INACTIVE",
                         expiry=c.expiry.timestamp() if c.expiry else None,
-                        plan=plan_data
+                        plan_id=c.plan_id,
+                        router_id=c.router_id
                     )
                     customer_list.append(customer_data)
                 except Exception as e:
@@ -118,7 +139,7 @@ class Query:
     @require_role(["admin", "reseller"])
     async def my_plans(self, info) -> List[PlanType]:
         """Get user's plans with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -170,7 +191,7 @@ class Query:
     @require_role(["admin", "reseller"])
     async def dashboard_metrics(self, info) -> DashboardMetricsType:
         """Get dashboard metrics with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -184,74 +205,8 @@ class Query:
             if user.role not in ["admin", "reseller"]:
                 raise HTTPException(status_code=403, detail="Insufficient permissions to view dashboard metrics")
             
-            # Build base queries
-            total_customers_stmt = select(func.count()).select_from(Customer)
-            active_customers_stmt = select(func.count()).select_from(Customer).filter(Customer.status == CustomerStatus.ACTIVE)
-            inactive_customers_stmt = select(func.count()).select_from(Customer).filter(Customer.status == CustomerStatus.INACTIVE)
-            total_revenue_stmt = select(func.sum(CustomerPayment.amount)).join(Customer)
-            expiring_soon_stmt = select(func.count()).select_from(Customer).filter(
-                Customer.status == CustomerStatus.ACTIVE,
-                Customer.expiry <= datetime.utcnow() + timedelta(days=7),
-                Customer.expiry >= datetime.utcnow()
-            )
-            subscription_stmt = select(Subscription).filter(Subscription.is_active == True)
-            
-            # Apply user-specific filters for non-admin users
-            if user.role != "admin":
-                total_customers_stmt = total_customers_stmt.filter(Customer.user_id == user.user_id)
-                active_customers_stmt = active_customers_stmt.filter(Customer.user_id == user.user_id)
-                inactive_customers_stmt = inactive_customers_stmt.filter(Customer.user_id == user.user_id)
-                total_revenue_stmt = total_revenue_stmt.filter(Customer.user_id == user.user_id)
-                expiring_soon_stmt = expiring_soon_stmt.filter(Customer.user_id == user.user_id)
-                subscription_stmt = subscription_stmt.filter(Subscription.user_id == user.user_id)
-            
-            # Execute queries with error handling for each
-            metrics = {
-                'total_customers': 0,
-                'active_customers': 0,
-                'inactive_customers': 0,
-                'total_revenue': 0.0,
-                'expiring_soon': 0,
-                'subscription_days_left': 0
-            }
-            
-            try:
-                total_customers = (await db.execute(total_customers_stmt)).scalar() or 0
-                metrics['total_customers'] = total_customers
-            except Exception as e:
-                safe_log_error("Error fetching total customers count", e, user.user_id)
-            
-            try:
-                active_customers = (await db.execute(active_customers_stmt)).scalar() or 0
-                metrics['active_customers'] = active_customers
-            except Exception as e:
-                safe_log_error("Error fetching active customers count", e, user.user_id)
-            
-            try:
-                inactive_customers = (await db.execute(inactive_customers_stmt)).scalar() or 0
-                metrics['inactive_customers'] = inactive_customers
-            except Exception as e:
-                safe_log_error("Error fetching inactive customers count", e, user.user_id)
-            
-            try:
-                total_revenue = (await db.execute(total_revenue_stmt)).scalar() or 0
-                metrics['total_revenue'] = float(total_revenue)
-            except Exception as e:
-                safe_log_error("Error fetching total revenue", e, user.user_id)
-            
-            try:
-                expiring_soon = (await db.execute(expiring_soon_stmt)).scalar() or 0
-                metrics['expiring_soon'] = expiring_soon
-            except Exception as e:
-                safe_log_error("Error fetching expiring soon count", e, user.user_id)
-            
-            try:
-                subscription = (await db.execute(subscription_stmt)).scalar_one_or_none()
-                if subscription and subscription.expires_on:
-                    days_left = max(0, (subscription.expires_on - datetime.utcnow()).days)
-                    metrics['subscription_days_left'] = days_left
-            except Exception as e:
-                safe_log_error("Error fetching subscription info", e, user.user_id)
+            # One aggregate statement, cached per tenant
+            metrics = await get_dashboard_metrics(db, user.user_id, user.role)
             
             return DashboardMetricsType(
                 total_customers=metrics['total_customers'],
@@ -276,7 +231,7 @@ class Query:
     @require_role(["admin", "reseller"])
     async def plan_metrics(self, info) -> List[PlanMetricsType]:
         """Get plan metrics with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -290,23 +245,8 @@ class Query:
             if user.role not in ["admin", "reseller"]:
                 raise HTTPException(status_code=403, detail="Insufficient permissions to view plan metrics")
             
-            stmt = (
-                select(
-                    Plan.id,
-                    Plan.name,
-                    func.count(Customer.id).label("customer_count"),
-                    func.coalesce(func.sum(CustomerPayment.amount), 0).label("total_revenue")
-                )
-                .outerjoin(Customer, Customer.plan_id == Plan.id)
-                .outerjoin(CustomerPayment, CustomerPayment.customer_id == Customer.id)
-            )
-            
-            if user.role != "admin":
-                stmt = stmt.filter(Plan.user_id == user.user_id)
-            
-            stmt = stmt.group_by(Plan.id, Plan.name)
-            
-            results = (await db.execute(stmt)).all()
+            # Counters are kept current by the plan_stats flush hook
+            results = await get_plan_metrics(db, user.user_id, user.role)
             
             metrics_list = []
             for result in results:
@@ -338,7 +278,7 @@ class Query:
     @require_role(["admin", "reseller"])
     async def my_routers(self, info) -> List[RouterType]:
         """Get user's routers with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -389,7 +329,7 @@ class Query:
     @require_role(["admin", "reseller"])
     async def my_provisioning_logs(self, info, limit: int = 50, offset: int = 0) -> List[ProvisioningLogType]:
         """Get provisioning logs with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -421,17 +361,7 @@ class Query:
             log_list = []
             for log in logs:
                 try:
-                    log_data = ProvisioningLogType(
-                        id=log.id,
-                        router_id=log.router_id,
-                        customer_id=log.customer_id,
-                        action=log.action or "Unknown Action",
-                        status=log.status or "Unknown Status",
-                        details=log.details,
-                        mac_address=log.mac_address,
-                        log_date=log.log_date.isoformat() if log.log_date else datetime.utcnow().isoformat()
-                    )
-                    log_list.append(log_data)
+                    log_list.append(_provisioning_log_type(log))
                 except Exception as e:
                     safe_log_error(f"Error processing provisioning log {log.id}", e, user.user_id)
                     continue
@@ -461,7 +391,7 @@ class Query:
         payment_method: Optional[str] = None
     ) -> List[CustomerPaymentType]:
         """Get payments with comprehensive error handling and validation"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -481,66 +411,8 @@ class Query:
             if offset < 0:
                 raise HTTPException(status_code=400, detail="Offset must be non-negative")
             
-            # Validate customer_id
-            if customer_id is not None and customer_id <= 0:
-                raise HTTPException(status_code=400, detail="Customer ID must be a positive integer")
-            
-            # Validate and parse dates
-            start_dt = None
-            end_dt = None
-            
-            if start_date:
-                try:
-                    start_dt = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-                    # Convert to offset-naive by removing tzinfo
-                    start_dt = start_dt.replace(tzinfo=None)
-                except ValueError:
-                    raise HTTPException(status_code=400, detail="Invalid start_date format. Use ISO format")
-            
-            if end_date:
-                try:
-                    end_dt = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-                    # Convert to offset-naive by removing tzinfo
-                    end_dt = end_dt.replace(tzinfo=None)
-                except ValueError:
-                    raise HTTPException(status_code=400, detail="Invalid end_date format. Use ISO format")
-            
-            if start_dt and end_dt and start_dt > end_dt:
-                raise HTTPException(status_code=400, detail="Start date cannot be after end date")
-            
-            # Build query
-            stmt = select(CustomerPayment).options(
-                joinedload(CustomerPayment.customer)
-            ).where(CustomerPayment.reseller_id == user.user_id)
-            
-            # Apply filters
-            if customer_id:
-                stmt = stmt.where(CustomerPayment.customer_id == customer_id)
-            
-            if start_dt:
-                stmt = stmt.where(CustomerPayment.payment_date >= start_dt)
-            
-            if end_dt:
-                stmt = stmt.where(CustomerPayment.payment_date <= end_dt)
-            
-            if payment_method:
-                try:
-                    # Match case-insensitively with lowercase enum values
-                    method_enum = None
-                    for method in PaymentMethod:
-                        if method.value.lower() == payment_method.lower():
-                            method_enum = method
-                            break
-                    if method_enum is None:
-                        valid_methods = [method.value for method in PaymentMethod]
-                        raise ValueError(f"Invalid payment method: {payment_method}")
-                    stmt = stmt.where(CustomerPayment.payment_method == method_enum)
-                except ValueError as e:
-                    valid_methods = [method.value for method in PaymentMethod]
-                    raise HTTPException(
-                        status_code=400,
-                        detail=f"{str(e)}. Valid options are: {', '.join(valid_methods)}"
-                    )
+            stmt = select(CustomerPayment).where(CustomerPayment.reseller_id == user.user_id)
+            stmt = filter_payments(stmt, customer_id, start_date, end_date, payment_method)
             
             stmt = stmt.order_by(CustomerPayment.payment_date.desc()).limit(limit).offset(offset)
             
@@ -550,23 +422,7 @@ class Query:
             payment_list = []
             for payment in payments:
                 try:
-                    customer_name = "Unknown Customer"
-                    if payment.customer and payment.customer.name:
-                        customer_name = payment.customer.name
-                    
-                    payment_data = CustomerPaymentType(
-                        id=payment.id,
-                        customer_id=payment.customer_id,
-                        customer_name=customer_name,
-                        amount=float(payment.amount or 0),
-                        payment_method=payment.payment_method.value if payment.payment_method else "UNKNOWN",
-                        payment_reference=payment.payment_reference,
-                        payment_date=payment.payment_date.isoformat() if payment.payment_date else datetime.utcnow().isoformat(),
-                        days_paid_for=payment.days_paid_for or 0,
-                        status=payment.status.value if payment.status else "UNKNOWN",
-                        notes=payment.notes
-                    )
-                    payment_list.append(payment_data)
+                    payment_list.append(_payment_type(payment))
                 except Exception as e:
                     safe_log_error(f"Error processing payment {payment.id}", e, user.user_id)
                     continue
@@ -582,11 +438,115 @@ class Query:
         except Exception as e:
             safe_log_error("Unexpected error while fetching payments", e, getattr(user, 'user_id', None))
             raise HTTPException(status_code=500, detail="Failed to retrieve payments")
+
+    @strawberry.field
+    @require_role(["admin", "reseller"])
+    async def my_provisioning_logs_connection(
+        self, info, first: int = 50, after: Optional[str] = None
+    ) -> ProvisioningLogConnection:
+        """
+        Provisioning logs, newest first, paged by an opaque (log_date, id)
+        cursor. Unlike my_provisioning_logs, deep pages cost the same as the
+        first one; pass page_info.end_cursor as `after` to continue.
+        """
+        db: AsyncSession = info.context.get("read_db")
+        if not db:
+            raise HTTPException(status_code=500, detail="Database connection not available")
+
+        try:
+            user = await get_current_user(info.context["user"])
+            if not user:
+                raise HTTPException(status_code=401, detail="Authentication required")
+
+            _validate_first(first)
+
+            stmt = select(ProvisioningLog).join(Router)
+            if user.role != "admin":
+                stmt = stmt.filter(Router.user_id == user.user_id)
+            stmt = keyset_page(stmt, ProvisioningLog.log_date, ProvisioningLog.id, first, after)
+
+            logs = (await db.execute(stmt)).scalars().all()
+            edges = [
+                ProvisioningLogEdge(cursor=encode_cursor(log.log_date, log.id), node=_provisioning_log_type(log))
+                for log in logs[:first]
+            ]
+            return ProvisioningLogConnection(
+                edges=edges,
+                page_info=PageInfo(
+                    has_next_page=len(logs) > first,
+                    end_cursor=edges[-1].cursor if edges else None
+                )
+            )
+
+        except HTTPException:
+            raise
+        except SQLAlchemyError as e:
+            safe_log_error("Database error while fetching provisioning logs", e, getattr(user, 'user_id', None))
+            await db.rollback()
+            raise HTTPException(status_code=500, detail="Database error occurred while fetching provisioning logs")
+        except Exception as e:
+            safe_log_error("Unexpected error while fetching provisioning logs", e, getattr(user, 'user_id', None))
+            raise HTTPException(status_code=500, detail="Failed to retrieve provisioning logs")
+
+    @strawberry.field
+    @require_role(["admin", "reseller"])
+    async def my_payments_connection(
+        self,
+        info,
+        first: int = 50,
+        after: Optional[str] = None,
+        customer_id: Optional[int] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        payment_method: Optional[str] = None
+    ) -> CustomerPaymentConnection:
+        """
+        Payments, newest first, paged by an opaque (payment_date, id) cursor.
+        Takes the same filters as my_payments; pass page_info.end_cursor as
+        `after` to continue.
+        """
+        db: AsyncSession = info.context.get("read_db")
+        if not db:
+            raise HTTPException(status_code=500, detail="Database connection not available")
+
+        try:
+            user = await get_current_user(info.context["user"])
+            if not user:
+                raise HTTPException(status_code=401, detail="Authentication required")
+
+            _validate_first(first)
+
+            stmt = select(CustomerPayment).where(CustomerPayment.reseller_id == user.user_id)
+            stmt = filter_payments(stmt, customer_id, start_date, end_date, payment_method)
+            stmt = keyset_page(stmt, CustomerPayment.payment_date, CustomerPayment.id, first, after)
+
+            payments = (await db.execute(stmt)).scalars().all()
+            edges = [
+                CustomerPaymentEdge(cursor=encode_cursor(payment.payment_date, payment.id), node=_payment_type(payment))
+                for payment in payments[:first]
+            ]
+            return CustomerPaymentConnection(
+                edges=edges,
+                page_info=PageInfo(
+                    has_next_page=len(payments) > first,
+                    end_cursor=edges[-1].cursor if edges else None
+                )
+            )
+
+        except HTTPException:
+            raise
+        except SQLAlchemyError as e:
+            safe_log_error("Database error while fetching payments", e, getattr(user, 'user_id', None))
+            await db.rollback()
+            raise HTTPException(status_code=500, detail="Database error occurred while fetching payments")
+        except Exception as e:
+            safe_log_error("Unexpected error while fetching payments", e, getattr(user, 'user_id', None))
+            raise HTTPException(status_code=500, detail="Failed to retrieve payments")
     @strawberry.field
     @require_role(["admin", "reseller"])
     async def financial_summary(self, info) -> ResellerFinancialSummary:
         """Get financial summary with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -679,7 +639,7 @@ class Query:
     @require_role(["admin", "reseller"])
     async def payment_summary(self, info) -> PaymentSummary:
         """Get payment summary with comprehensive error handling"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
@@ -693,83 +653,8 @@ class Query:
             if user.role not in ["admin", "reseller"]:
                 raise HTTPException(status_code=403, detail="Insufficient permissions to view payment summary")
             
-            now = datetime.utcnow()
-            today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            week_start = today_start - timedelta(days=now.weekday())
-            month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            
-            # Initialize default values
-            summary_data = {
-                'today_total': 0.0,
-                'today_count': 0,
-                'week_total': 0.0,
-                'week_count': 0,
-                'month_total': 0.0,
-                'month_count': 0,
-                'total_amount': 0.0
-            }
-            
-            # Today's payments
-            try:
-                today_stmt = select(
-                    func.sum(CustomerPayment.amount), 
-                    func.count(CustomerPayment.id)
-                ).where(
-                    CustomerPayment.reseller_id == user.user_id,
-                    CustomerPayment.payment_date >= today_start,
-                    CustomerPayment.status == PaymentStatus.COMPLETED
-                )
-                today_result = await db.execute(today_stmt)
-                today_data = today_result.first()
-                summary_data['today_total'] = float(today_data[0] or 0)
-                summary_data['today_count'] = today_data[1] or 0
-            except Exception as e:
-                safe_log_error("Error fetching today's payment summary", e, user.user_id)
-            
-            # This week's payments
-            try:
-                week_stmt = select(
-                    func.sum(CustomerPayment.amount), 
-                    func.count(CustomerPayment.id)
-                ).where(
-                    CustomerPayment.reseller_id == user.user_id,
-                    CustomerPayment.payment_date >= week_start,
-                    CustomerPayment.status == PaymentStatus.COMPLETED
-                )
-                week_result = await db.execute(week_stmt)
-                week_data = week_result.first()
-                summary_data['week_total'] = float(week_data[0] or 0)
-                summary_data['week_count'] = week_data[1] or 0
-            except Exception as e:
-                safe_log_error("Error fetching this week's payment summary", e, user.user_id)
-            
-            # This month's payments
-            try:
-                month_stmt = select(
-                    func.sum(CustomerPayment.amount), 
-                    func.count(CustomerPayment.id)
-                ).where(
-                    CustomerPayment.reseller_id == user.user_id,
-                    CustomerPayment.payment_date >= month_start,
-                    CustomerPayment.status == PaymentStatus.COMPLETED
-                )
-                month_result = await db.execute(month_stmt)
-                month_data = month_result.first()
-                summary_data['month_total'] = float(month_data[0] or 0)
-                summary_data['month_count'] = month_data[1] or 0
-            except Exception as e:
-                safe_log_error("Error fetching this month's payment summary", e, user.user_id)
-            
-            # Total payments
-            try:
-                total_stmt = select(func.sum(CustomerPayment.amount)).where(
-                    CustomerPayment.reseller_id == user.user_id,
-                    CustomerPayment.status == PaymentStatus.COMPLETED
-                )
-                total_result = await db.execute(total_stmt)
-                summary_data['total_amount'] = float(total_result.scalar() or 0)
-            except Exception as e:
-                safe_log_error("Error fetching total payment amount", e, user.user_id)
+            # Closed days from the daily rollups, today live, in one statement
+            summary_data = await get_payment_summary(db, user.user_id)
             
             return PaymentSummary(
                 today=summary_data['today_total'],
@@ -794,7 +679,7 @@ class Query:
     @strawberry.field
     async def my_plans_by_router(self, info, router_id: int) -> List[PlanType]:
         """Get plans by router ID for guest users via captive portal"""
-        db: AsyncSession = info.context.get("db")
+        db: AsyncSession = info.context.get("read_db")
         if not db:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
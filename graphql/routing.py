@@ -0,0 +1,28 @@
+from strawberry.extensions import SchemaExtension
+from strawberry.types.graphql import OperationType
+
+from app.core.deps import CurrentUser
+from app.db.database import mark_tenant_write
+from app.graphql.loaders import Loaders
+
+
+class ReadRouting(SchemaExtension):
+    """
+    get_context hands Query resolvers a replica session as "read_db". A
+    mutation must read what it writes, so for mutation operations this points
+    "read_db" and the loaders back at the primary session, and afterwards
+    marks the tenant so its next reads also stay on the primary for
+    DB_READ_YOUR_WRITES_SECONDS. The mark lives in this worker only; another
+    worker can still serve that tenant from the lagging replica.
+    """
+
+    def on_execute(self):
+        context = self.execution_context.context
+        is_mutation = self.execution_context.operation_type == OperationType.MUTATION
+        if is_mutation and context["read_db"] is not context["db"]:
+            context["read_db"] = context["db"]
+            context["loaders"] = Loaders(context["db"])
+        yield
+        user = context.get("user")
+        if is_mutation and isinstance(user, CurrentUser):
+            mark_tenant_write(user.user_id)
@@ -2,5 +2,6 @@
 import strawberry
 from app.graphql.queries import Query
 from app.graphql.mutations import Mutation
+from app.graphql.routing import ReadRouting
 
-schema = strawberry.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
+schema = strawberry.Schema(query=Query, mutation=Mutation, extensions=[ReadRouting])
\ No newline at end of file
@@ -1,4 +1,5 @@
 import strawberry
+from strawberry.types import Info
 from typing import Optional, List
 from datetime import datetime
 
@@ -20,6 +21,25 @@ class PlanType:
     duration_unit: str  # Either "HOURS" or "DAYS"
     connection_type: str
 
+    @classmethod
+    def from_model(cls, plan) -> "PlanType":
+        return cls(
+            id=plan.id,
+            name=plan.name or "Unknown Plan",
+            speed=plan.speed or 0,
+            price=plan.price or 0.0,
+            duration_value=plan.duration_value or 0,
+            duration_unit=plan.duration_unit.value if plan.duration_unit else "HOURS",
+            connection_type=plan.connection_type.value if plan.connection_type else "HOTSPOT"
+        )
+
+@strawberry.type
+class RouterType:
+    id: int
+    name: str
+    ip_address: str
+    port: int
+
 @strawberry.type
 class CustomerType:
     id: int
@@ -30,7 +50,24 @@ class CustomerType:
     static_ip: Optional[str]
     status: str
     expiry: Optional[float]
-    plan: Optional[PlanType]
+    plan_id: strawberry.Private[Optional[int]] = None
+    router_id: strawberry.Private[Optional[int]] = None
+
+    @strawberry.field
+    async def plan(self, info: Info) -> Optional[PlanType]:
+        if self.plan_id is None:
+            return None
+        plan = await info.context["loaders"].plans.load(self.plan_id)
+        return PlanType.from_model(plan) if plan else None
+
+    @strawberry.field
+    async def router(self, info: Info) -> Optional[RouterType]:
+        if self.router_id is None:
+            return None
+        router = await info.context["loaders"].routers.load(self.router_id)
+        if not router:
+            return None
+        return RouterType(id=router.id, name=router.name, ip_address=router.ip_address, port=router.port)
 
 @strawberry.type
 class PaymentType:
@@ -43,7 +80,6 @@ class PaymentType:
 class CustomerPaymentType:
     id: int
     customer_id: int
-    customer_name: str
     amount: float
     payment_method: str
     payment_reference: Optional[str]
@@ -52,6 +88,13 @@ class CustomerPaymentType:
     status: str
     notes: Optional[str]
 
+    @strawberry.field
+    async def customer_name(self, info: Info) -> str:
+        customer = await info.context["loaders"].customers.load(self.customer_id)
+        if customer and customer.name:
+            return customer.name
+        return "Unknown Customer"
+
 @strawberry.type
 class ResellerFinancialSummary:
     total_revenue: float
@@ -96,13 +139,6 @@ class PlanMetricsType:
     customer_count: int
     total_revenue: int
 
-@strawberry.type
-class RouterType:
-    id: int
-    name: str
-    ip_address: str
-    port: int
-
 @strawberry.type
 class ProvisioningLogType:
     id: int
@@ -112,4 +148,28 @@ class ProvisioningLogType:
     status: str
     details: str
     mac_address: Optional[str]
-    log_date: str
\ No newline at end of file
+    log_date: str
+@strawberry.type
+class PageInfo:
+    has_next_page: bool
+    end_cursor: Optional[str]
+
+@strawberry.type
+class CustomerPaymentEdge:
+    cursor: str
+    node: CustomerPaymentType
+
+@strawberry.type
+class CustomerPaymentConnection:
+    edges: List[CustomerPaymentEdge]
+    page_info: PageInfo
+
+@strawberry.type
+class ProvisioningLogEdge:
+    cursor: str
+    node: ProvisioningLogType
+
+@strawberry.type
+class ProvisioningLogConnection:
+    edges: List[ProvisioningLogEdge]
+    page_info: PageInfo
@@ -1,22 +1,42 @@
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, status, Request
+from fastapi import FastAPI, HTTPException, Depends, status, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from strawberry.fastapi import GraphQLRouter
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from app.graphql.schema import schema
-from app.db.database import get_db
+from app.graphql.loaders import Loaders
+from app.db.database import (
+    get_db, LazySession, AsyncSessionLocal, ReplicaSessionLocal, reads_from_primary, has_replica,
+    async_engine, replica_engine, pool_telemetry, replica_pool_telemetry
+)
+from app.core.deps import CurrentUser, decode_token, token_cache
+from app.core.security import password_hasher
 from app.db.models import Router, Customer, Plan, ProvisioningLog, ConnectionType, CustomerStatus, MpesaTransaction, MpesaTransactionStatus
 from app.services.auth import verify_token, get_current_user
 from app.services.billing import make_payment
-from app.services.mikrotik_api import MikroTikAPI, validate_mac_address, normalize_mac_address
+from app.services.mikrotik_api import (
+    validate_mac_address, normalize_mac_address, build_command_words, build_query_words, duration_seconds,
+    bandwidth_ip_for_mac, case_variants
+)
+from app.services.mikrotik_pool import mikrotik_pool
+from app.services.router_state_cache import router_state_cache
+from app.services.provisioning_queue import provisioning_queue
+from app.services.expiry import expiry_scheduler
+from app.services.reseller_payments import run_financials_reconciler
+from app.services.mpesa import get_http_client, close_http_client, daraja_token
 from app.services.mpesa_transactions import update_mpesa_transaction_status
+from app.services.mpesa_reconciliation import mpesa_reconciler
+from app.services.mpesa_payments import apply_completed_payment
+from app.services.exports import EXPORT_FORMATS, payment_export_query, customer_export_query, stream_export
+from app.services.callback_idempotency import callback_idempotency_key, claim_callback, release_callback, recent_callbacks
 from app.config import settings
+import asyncio
 import logging
 from sqlalchemy.orm import selectinload
 import json
 from typing import Dict, Optional, Any
 from datetime import datetime, timedelta
-import hashlib
 from pprint import pformat
 
 # Configure logging
@@ -35,15 +55,41 @@ app.add_middleware(
 )
 
 # Context getter for GraphQL
-async def get_context(request: Request, db: AsyncSession = Depends(get_db)):
+async def get_context(request: Request):
     auth_header = request.headers.get("Authorization")
     token = None
     if auth_header and auth_header.startswith("Bearer "):
         token = auth_header.split(" ")[1]
-    return {
-        "db": db,
-        "user": token
-    }
+    user = token
+    if token:
+        try:
+            # Resolvers and require_role read the decoded claims from here
+            user = decode_token(token)
+        except HTTPException:
+            # Keep the raw token so fields that need auth still raise the 401
+            pass
+    # Queries read from the replica unless this tenant just wrote; the
+    # ReadRouting extension moves mutations back onto the primary
+    tenant_id = user.user_id if isinstance(user, CurrentUser) else None
+    # Sessions open on first use, so login and public requests that never
+    # query don't hold a pooled connection
+    db = LazySession(AsyncSessionLocal)
+    read_db = db if reads_from_primary(tenant_id) else LazySession(ReplicaSessionLocal)
+    failed = False
+    try:
+        yield {
+            "db": db,
+            "read_db": read_db,
+            "user": user,
+            "loaders": Loaders(read_db)
+        }
+    except Exception:
+        failed = True
+        raise
+    finally:
+        await db.finish(failed)
+        if read_db is not db:
+            await read_db.finish(failed)
 
 
 
@@ -245,9 +291,35 @@ app.include_router(graphql_app, prefix="/graphql")
 #         logger.info(f"Payment status for customer {customer.id}: {status} (no action taken)")
 #         return {"ResultCode": 0, "ResultDesc": f"No action taken for status: {status}"}
 @app.post("/api/lipay/callback")
-async def mpesa_callback(payload: dict, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+async def mpesa_callback(payload: dict, db: AsyncSession = Depends(get_db)):
     logger.info(f"--- M-Pesa Callback Received: {json.dumps(payload, indent=2)}")
 
+    # Gateways retry deliveries; apply each transaction outcome exactly once
+    idempotency_key = callback_idempotency_key(payload)
+    if idempotency_key:
+        if idempotency_key in recent_callbacks or not await claim_callback(db, idempotency_key, payload):
+            recent_callbacks.set(idempotency_key, True)
+            logger.info(f"Duplicate callback {idempotency_key} ignored")
+            return {"ResultCode": 0, "ResultDesc": "Duplicate callback ignored"}
+    else:
+        logger.warning("Callback carries no transaction reference; it cannot be de-duplicated")
+
+    try:
+        response = await apply_mpesa_callback(payload, db)
+    except Exception:
+        if idempotency_key:
+            recent_callbacks.delete(idempotency_key)
+        raise
+
+    if idempotency_key:
+        if response.get("ResultCode") == 0:
+            recent_callbacks.set(idempotency_key, True)
+        else:
+            # Rejected deliveries stay retryable (e.g. customer registered later)
+            await release_callback(db, idempotency_key)
+    return response
+
+async def apply_mpesa_callback(payload: dict, db: AsyncSession) -> dict:
     # Extract values from the incoming payload
     mac_address = payload.get("customer_ref")
     status = payload.get("status")
@@ -278,189 +350,13 @@ async def mpesa_callback(payload: dict, background_tasks: BackgroundTasks, db: A
 
     if status == "completed":
         logger.info(f"PAYMENT CONFIRMED for customer {customer.id} ({mac_address})")
-        
-        # 🔥 NEW: Record the transaction in CustomerPayment table
-        try:
-            from app.services.reseller_payments import record_customer_payment
-            from app.db.models import PaymentMethod
-            
-            # Get payment details from pending_update_data or current plan
-            pending_update_data = customer.pending_update_data
-            plan = customer.plan
-            duration_value = None
-            
-            if pending_update_data:
-                if isinstance(pending_update_data, str):
-                    pending_update_data = json.loads(pending_update_data)
-                duration_value = pending_update_data.get("duration_value")
-                plan_id = pending_update_data.get("plan_id")
-                
-                # Fetch the plan if different
-                if plan_id != customer.plan_id:
-                    plan_stmt = select(Plan).where(Plan.id == plan_id)
-                    plan_result = await db.execute(plan_stmt)
-                    plan = plan_result.scalar_one_or_none()
-            
-            if not duration_value and plan:
-                duration_value = plan.duration_value
-            
-            # Convert duration to days for payment record
-            days_paid_for = duration_value
-            if plan and plan.duration_unit.value.upper() == "HOURS":
-                days_paid_for = max(1, duration_value // 24)  # Convert hours to days, minimum 1 day
-            
-            # Record the payment
-            payment = await record_customer_payment(
-                db=db,
-                customer_id=customer.id,
-                reseller_id=customer.user_id,  # Router owner/reseller
-                amount=float(amount),
-                payment_method=PaymentMethod.MOBILE_MONEY,
-                days_paid_for=days_paid_for,
-                payment_reference=receipt_number or tx_no,
-                notes=f"M-Pesa payment via callback. TX: {tx_no}"
-            )
-            
-            logger.info(f"[AUDIT] CustomerPayment record created: ID {payment.id}, Amount: {amount}, Days: {days_paid_for}")
-            
-        except Exception as payment_error:
-            logger.error(f"Failed to record CustomerPayment for customer {customer.id}: {payment_error}")
-            # Continue with customer update even if payment recording fails
-        
-        # 🔥 NEW: Update MpesaTransaction record if it exists
-        if checkout_request_id:
-            try:
-                from app.services.mpesa_transactions import update_mpesa_transaction_status
-                from app.db.models import MpesaTransactionStatus
-                
-                await update_mpesa_transaction_status(
-                    db=db,
-                    checkout_request_id=checkout_request_id,
-                    status=MpesaTransactionStatus.COMPLETED,
-                    receipt_number=receipt_number,
-                    result_code="0",
-                    result_desc="Payment completed successfully"
-                )
-                
-                logger.info(f"[AUDIT] MpesaTransaction updated: {checkout_request_id}")
-                
-            except Exception as mpesa_error:
-                logger.error(f"Failed to update MpesaTransaction {checkout_request_id}: {mpesa_error}")
-
-        # Continue with existing customer update logic...
-        pending_update_data = customer.pending_update_data
-        now = datetime.utcnow()
-        plan = customer.plan
-        router = customer.router
-
-        if pending_update_data:
-            # Handle existing customer with pending update data
-            if isinstance(pending_update_data, str):
-                try:
-                    pending_update_data = json.loads(pending_update_data)
-                    logger.info(f"Parsed pending_update_data for customer {customer.id}: {json.dumps(pending_update_data)}")
-                except json.JSONDecodeError as e:
-                    logger.error(f"Invalid JSON in pending_update_data for customer {customer.id}: {e}")
-                    return {"ResultCode": 1, "ResultDesc": "Invalid pending update data format"}
-
-            duration_value = pending_update_data.get("duration_value")
-            duration_unit = pending_update_data.get("duration_unit")
-            applied_plan_id = pending_update_data.get("plan_id")
-            requested_router_id = pending_update_data.get("router_id")
-
-            if duration_value is None or duration_unit is None or requested_router_id is None:
-                logger.error(f"Missing duration_value, duration_unit, or router_id in pending_update_data for customer {customer.id}")
-                return {"ResultCode": 1, "ResultDesc": "Missing required fields in pending update data"}
-
-            # Convert duration to time limit for MikroTik
-            if duration_unit.upper() == "DAYS":
-                time_limit = f"{int(duration_value)}d"
-            elif duration_unit.upper() == "HOURS":
-                time_limit = f"{int(duration_value)}h"
-            else:
-                logger.error(f"Unsupported duration_unit {duration_unit} for customer {customer.id}")
-                return {"ResultCode": 1, "ResultDesc": f"Unsupported duration unit: {duration_unit}"}
-
-            # Fetch the plan and router from pending_update_data
-            plan_stmt = select(Plan).where(Plan.id == applied_plan_id)
-            plan_result = await db.execute(plan_stmt)
-            plan = plan_result.scalar_one_or_none()
-
-            router_stmt = select(Router).where(Router.id == requested_router_id)
-            router_result = await db.execute(router_stmt)
-            router = router_result.scalar_one_or_none()
-
-            if not plan or not router:
-                logger.error(f"Plan {applied_plan_id} or Router {requested_router_id} not found")
-                return {"ResultCode": 1, "ResultDesc": "Plan or Router not found"}
-
-            # Calculate new expiry
-            if duration_unit.upper() == "DAYS":
-                if customer.expiry and customer.expiry > now:
-                    new_expiry = customer.expiry + timedelta(days=int(duration_value))
-                else:
-                    new_expiry = now + timedelta(days=int(duration_value))
-            elif duration_unit.upper() == "HOURS":
-                if customer.expiry and customer.expiry > now:
-                    new_expiry = customer.expiry + timedelta(hours=int(duration_value))
-                else:
-                    new_expiry = now + timedelta(hours=int(duration_value))
-
-            # Update customer
-            customer.expiry = new_expiry
-            customer.plan_id = applied_plan_id
-            customer.router_id = requested_router_id
-            customer.status = CustomerStatus.ACTIVE
-            customer.pending_update_data = None  # Clear pending data
-
-            logger.info(f"[AUDIT] Applied pending_update_data for customer {customer.id}")
-
-        else:
-            # Handle new customer (no pending_update_data)
-            if not plan or not router:
-                logger.error(f"Customer {customer.id} missing plan or router configuration")
-                return {"ResultCode": 1, "ResultDesc": "Customer missing plan or router configuration"}
-
-            duration_value = plan.duration_value
-            duration_unit = plan.duration_unit.value
-
-            if duration_unit.upper() == "DAYS":
-                time_limit = f"{int(duration_value)}d"
-                new_expiry = now + timedelta(days=int(duration_value))
-            elif duration_unit.upper() == "HOURS":
-                time_limit = f"{int(duration_value)}h"
-                new_expiry = now + timedelta(hours=int(duration_value))
-            else:
-                logger.error(f"Unsupported duration_unit {duration_unit} for customer {customer.id}")
-                return {"ResultCode": 1, "ResultDesc": f"Unsupported duration unit: {duration_unit}"}
-
-            customer.expiry = new_expiry
-            customer.status = CustomerStatus.ACTIVE
-            logger.info(f"[AUDIT] New customer {customer.id} payment processed")
-
-        # Commit customer updates
-        await db.commit()
-
-        # Prepare payload for MikroTik provisioning
-        if router and plan:
-            hotspot_payload = {
-                "mac_address": customer.mac_address,
-                "username": customer.mac_address.replace(":", ""),
-                "password": customer.mac_address.replace(":", ""),
-                "time_limit": time_limit,
-                "bandwidth_limit": f"{plan.speed}",
-                "comment": f"Payment successful for {customer.name} on {datetime.utcnow().isoformat()}",
-                "router_ip": router.ip_address,
-                "router_username": router.username,
-                "router_password": router.password,
-            }
-            logger.info(f"Prepared MikroTik Payload for customer {customer.id}")
-            background_tasks.add_task(call_mikrotik_bypass, hotspot_payload)
-
-        return {
-            "ResultCode": 0,
-            "ResultDesc": f"Customer {customer.id} updated to ACTIVE, payment recorded, and MikroTik user created. New expiry: {customer.expiry}"
-        }
+        response = await apply_completed_payment(
+            db, customer, amount, tx_no=tx_no, checkout_request_id=checkout_request_id, receipt_number=receipt_number
+        )
+        if response["ResultCode"] == 0:
+            await db.commit()
+            provisioning_queue.notify()
+        return response
 
     elif status == "failed":
         # 🔥 NEW: Update transaction records for failed payments
@@ -469,13 +365,15 @@ async def mpesa_callback(payload: dict, background_tasks: BackgroundTasks, db: A
                 from app.services.mpesa_transactions import update_mpesa_transaction_status
                 from app.db.models import MpesaTransactionStatus
                 
-                await update_mpesa_transaction_status(
-                    db=db,
-                    checkout_request_id=checkout_request_id,
-                    status=MpesaTransactionStatus.FAILED,
-                    result_code="1",
-                    result_desc="Payment failed"
-                )
+                async with db.begin_nested():
+                    await update_mpesa_transaction_status(
+                        db=db,
+                        checkout_request_id=checkout_request_id,
+                        status=MpesaTransactionStatus.FAILED,
+                        result_code="1",
+                        result_desc="Payment failed",
+                        commit=False
+                    )
                 
                 logger.info(f"[AUDIT] MpesaTransaction marked as failed: {checkout_request_id}")
                 
@@ -491,36 +389,6 @@ async def mpesa_callback(payload: dict, background_tasks: BackgroundTasks, db: A
         logger.info(f"Payment status for customer {customer.id}: {status} (no action taken)")
         return {"ResultCode": 0, "ResultDesc": f"No action taken for status: {status}"}
     
-async def call_mikrotik_bypass(hotspot_payload: dict):
-    try:
-        api = MikroTikAPI(
-            hotspot_payload["router_ip"],
-            hotspot_payload["router_username"],
-            hotspot_payload["router_password"]
-        )
-
-        if not api.connect():
-            logger.error("Failed to connect to MikroTik router")
-            return
-
-        # 🔴 NO await here!
-        result = api.add_customer_bypass_mode(
-            hotspot_payload["mac_address"],
-            hotspot_payload["username"],
-            hotspot_payload["password"],
-            hotspot_payload["time_limit"],
-            hotspot_payload["bandwidth_limit"],
-            hotspot_payload["comment"],
-            hotspot_payload["router_ip"],
-            hotspot_payload["router_username"],
-            hotspot_payload["router_password"]
-        )
-
-        logger.info(f"MikroTik API Response: {json.dumps(result, indent=2)}")
-        api.disconnect()
-    except Exception as e:
-        logger.error(f"Error while processing MikroTik bypass: {e}")
-
 # MAC address registration endpoint (NO JWT REQUIRED - for guests)
 @app.post("/api/clients/mac-register/{router_id}")
 async def register_mac_address(
@@ -556,19 +424,17 @@ async def register_mac_address(
     username = normalized_mac.replace(":", "")
 
     # Connect to the router
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    api = await mikrotik_pool.acquire(router)
+    if not api:
         logger.error(f"Failed to connect to router {router.name} ({router.ip_address})")
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
     try:
         # Check if MAC address is already registered
-        existing_users = api.send_command("/ip/hotspot/user/print")
+        existing_users = await api.query("/ip/hotspot/user/print", where={"name": case_variants(username)}, proplist=[".id"])
         if existing_users.get("success") and existing_users.get("data"):
-            for user in existing_users["data"]:
-                if user.get("name", "").upper() == username.upper():
-                    logger.warning(f"MAC address {normalized_mac} already registered on router {router.name}")
-                    raise HTTPException(status_code=409, detail="MAC address already registered")
+            logger.warning(f"MAC address {normalized_mac} already registered on router {router.name}")
+            raise HTTPException(status_code=409, detail="MAC address already registered")
 
         # Prepare user arguments
         args = {
@@ -601,56 +467,59 @@ async def register_mac_address(
             # Add router owner info even without time limit
             args["comment"] = f"MAC: {normalized_mac} | Router: {router.name} | Owner: {router.user_id} | Guest"
 
-        # Create hotspot user
-        result = api.send_command("/ip/hotspot/user/add", args)
-        if "error" in result:
-            logger.error(f"Failed to create hotspot user: {result['error']}")
-            raise HTTPException(status_code=400, detail=result["error"])
-
-        # Add IP binding for the MAC address
-        binding_args = {
-            "mac-address": normalized_mac,
-            "type": "bypassed",
-            "comment": f"Auto-registered: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} | Router: {router.name} | Guest"
-        }
-        binding_result = api.send_command("/ip/hotspot/ip-binding/add", binding_args)
-
-        # Handle bandwidth limit and IP assignment if provided
-        queue_result = None
-        dhcp_lease_result = None
+        # User, binding, lease and queue go out as one pipelined batch
+        sentences = [
+            build_command_words("/ip/hotspot/user/add", args),
+            build_command_words("/ip/hotspot/ip-binding/add", {
+                "mac-address": normalized_mac,
+                "type": "bypassed",
+                "comment": f"Auto-registered: {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} | Router: {router.name} | Guest"
+            }),
+        ]
         assigned_ip = None
-
-        if registration.get("bandwidth_limit"):
-            # Generate a consistent IP based on MAC hash
-            mac_hash = int(hashlib.md5(normalized_mac.encode()).hexdigest()[:4], 16)
-            assigned_ip = f"192.168.1.{100 + (mac_hash % 150)}"
-
-            # Add DHCP lease
-            dhcp_lease_args = {
+        bandwidth_limit = registration.get("bandwidth_limit")
+        if bandwidth_limit:
+            # Consistent IP derived from the MAC
+            assigned_ip = bandwidth_ip_for_mac(normalized_mac)
+            sentences.append(build_command_words("/ip/dhcp-server/lease/add", {
                 "mac-address": normalized_mac,
                 "address": assigned_ip,
                 "server": "defconf",
                 "comment": f"Auto-assigned for {username} | Router: {router.name} | Guest"
-            }
-            dhcp_lease_result = api.send_command("/ip/dhcp-server/lease/add", dhcp_lease_args)
-
-            # Add queue rule if DHCP lease was successful
-            if dhcp_lease_result.get("success") and "error" not in dhcp_lease_result:
-                queue_args = {
-                    "name": f"queue_{username}",
-                    "target": f"{assigned_ip}/32",
-                    "max-limit": registration["bandwidth_limit"],
-                    "comment": f"Bandwidth limit for {normalized_mac} | Router: {router.name} | Guest"
-                }
-                queue_result = api.send_command("/queue/simple/add", queue_args)
+            }))
+            sentences.append(build_command_words("/queue/simple/add", {
+                "name": f"queue_{username}",
+                "target": f"{assigned_ip}/32",
+                "max-limit": bandwidth_limit,
+                "comment": f"Bandwidth limit for {normalized_mac} | Router: {router.name} | Guest"
+            }))
+        replies = await api.pipeline(sentences)
+        result, binding_result = replies[0], replies[1]
 
-                if "error" in queue_result:
+        if "error" in result:
+            logger.error(f"Failed to create hotspot user: {result['error']}")
+            # Undo whatever the rest of the batch created
+            await api.remove_bypassed_user(normalized_mac)
+            raise HTTPException(status_code=400, detail=result["error"])
+
+        queue_created = False
+        if bandwidth_limit:
+            dhcp_lease_result, queue_result = replies[2], replies[3]
+            lease_ok, queue_ok = "error" not in dhcp_lease_result, "error" not in queue_result
+            queue_created = lease_ok and queue_ok
+            if lease_ok != queue_ok:
+                # A lease without its queue (or a queue without its lease) is
+                # useless; remove the half that went through
+                if lease_ok:
                     logger.warning(f"Failed to set bandwidth limit: {queue_result['error']}")
-                    # Remove DHCP lease if queue creation failed
-                    if dhcp_lease_result.get("data") and len(dhcp_lease_result["data"]) > 0:
-                        lease_id = dhcp_lease_result["data"][0].get(".id")
-                        if lease_id:
-                            api.send_command("/ip/dhcp-server/lease/remove", {"numbers": lease_id})
+                    orphan, where = "/ip/dhcp-server/lease", {"mac-address": normalized_mac}
+                else:
+                    orphan, where = "/queue/simple", {"name": f"queue_{username}"}
+                found = await api.query(f"{orphan}/print", where=where, proplist=[".id"])
+                await api.pipeline([
+                    build_command_words(f"{orphan}/remove", {"numbers": row[".id"]})
+                    for row in found.get("data", []) if row.get(".id")
+                ])
 
         # Log the registration for the router owner (for billing/tracking)
         logger.info(f"MAC {normalized_mac} registered on router {router.name} (ID: {router_id}, Owner: {router.user_id})")
@@ -669,7 +538,7 @@ async def register_mac_address(
                 "bandwidth_limit": registration.get("bandwidth_limit"),
                 "assigned_ip": assigned_ip,
                 "binding_created": binding_result.get("success", False),
-                "queue_created": queue_result.get("success", False) if queue_result else False
+                "queue_created": queue_created
             }
         }
 
@@ -680,7 +549,8 @@ async def register_mac_address(
         logger.error(f"Unexpected error during MAC registration: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
     finally:
-        api.disconnect()
+        await mikrotik_pool.release(api)
+        router_state_cache.invalidate(router_id)
 
 # Public router info endpoint (no auth required)
 @app.get("/api/public/router/{router_id}")
@@ -727,67 +597,42 @@ async def check_mac_registration_status(
     normalized_mac = normalize_mac_address(mac_address)
     username = normalized_mac.replace(":", "")
 
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    # Answered from the in-memory mirror of the router; it is refreshed in the
+    # background and never older than ROUTER_STATE_MAX_STALENESS_SECONDS
+    snapshot = await router_state_cache.get(router)
+    if not snapshot:
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
-    try:
-        # Check if user exists
-        existing_users = api.send_command("/ip/hotspot/user/print")
-        user_found = False
-        user_details = None
-
-        if existing_users.get("success") and existing_users.get("data"):
-            for user in existing_users["data"]:
-                if user.get("name", "").upper() == username.upper():
-                    user_found = True
-                    user_details = {
-                        "registered": True,
-                        "username": user.get("name"),
-                        "disabled": user.get("disabled") == "true",
-                        "profile": user.get("profile"),
-                        "comment": user.get("comment", ""),
-                        "mac_address": normalized_mac,
-                        "router_id": router_id
-                    }
-                    break
-
-        if not user_found:
-            return {
-                "registered": False,
-                "mac_address": normalized_mac,
-                "router_id": router_id
-            }
-
-        # Check for active sessions
-        active_sessions = api.send_command("/ip/hotspot/active/print")
-        is_active = False
-        session_info = None
-
-        if active_sessions.get("success") and active_sessions.get("data"):
-            for session in active_sessions["data"]:
-                if session.get("user") == username:
-                    is_active = True
-                    session_info = {
-                        "login_time": session.get("login-time"),
-                        "uptime": session.get("uptime"),
-                        "bytes_in": session.get("bytes-in"),
-                        "bytes_out": session.get("bytes-out"),
-                        "address": session.get("address")
-                    }
-                    break
+    user = snapshot.hotspot_user(username)
+    if not user:
+        return {
+            "registered": False,
+            "mac_address": normalized_mac,
+            "router_id": router_id
+        }
 
-        user_details["active_session"] = is_active
-        if session_info:
-            user_details["session_info"] = session_info
+    user_details = {
+        "registered": True,
+        "username": user.get("name"),
+        "disabled": user.get("disabled") == "true",
+        "profile": user.get("profile"),
+        "comment": user.get("comment", ""),
+        "mac_address": normalized_mac,
+        "router_id": router_id
+    }
 
-        return user_details
+    session = snapshot.active_session(username)
+    user_details["active_session"] = session is not None
+    if session:
+        user_details["session_info"] = {
+            "login_time": session.get("login-time"),
+            "uptime": session.get("uptime"),
+            "bytes_in": session.get("bytes-in"),
+            "bytes_out": session.get("bytes-out"),
+            "address": session.get("address")
+        }
 
-    except Exception as e:
-        logger.error(f"Error checking MAC status: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Status check failed: {str(e)}")
-    finally:
-        api.disconnect()
+    return user_details
 
 # Disconnect user endpoint (no auth required - for self-service)
 @app.post("/api/public/disconnect/{router_id}/{mac_address}")
@@ -809,23 +654,22 @@ async def disconnect_user_session(
     normalized_mac = normalize_mac_address(mac_address)
     username = normalized_mac.replace(":", "")
 
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    api = await mikrotik_pool.acquire(router)
+    if not api:
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
     try:
         # Find and disconnect active sessions
-        active_sessions = api.send_command("/ip/hotspot/active/print")
+        active_sessions = await api.query("/ip/hotspot/active/print", where={"user": case_variants(username)}, proplist=[".id"])
         disconnected_sessions = 0
 
         if active_sessions.get("success") and active_sessions.get("data"):
             for session in active_sessions["data"]:
-                if session.get("user") == username:
-                    session_id = session.get(".id")
-                    if session_id:
-                        disconnect_result = api.send_command("/ip/hotspot/active/remove", {"numbers": session_id})
-                        if disconnect_result.get("success", True):  # Success if no error
-                            disconnected_sessions += 1
+                session_id = session.get(".id")
+                if session_id:
+                    disconnect_result = await api.send_command("/ip/hotspot/active/remove", {"numbers": session_id})
+                    if disconnect_result.get("success", True):  # Success if no error
+                        disconnected_sessions += 1
 
         return {
             "success": True,
@@ -838,7 +682,8 @@ async def disconnect_user_session(
         logger.error(f"Error disconnecting user: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Disconnect failed: {str(e)}")
     finally:
-        api.disconnect()
+        await mikrotik_pool.release(api)
+        router_state_cache.invalidate(router_id)
 
 # Router status endpoint (requires auth)
 @app.get("/api/routers")
@@ -865,13 +710,19 @@ async def get_router_users(
     if not router:
         raise HTTPException(status_code=404, detail="Router not found or not accessible")
 
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    api = await mikrotik_pool.acquire(router)
+    if not api:
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
     try:
-        users_result = api.send_command("/ip/hotspot/user/print")
-        active_sessions_result = api.send_command("/ip/hotspot/active/print")
+        users_result = await api.query(
+            "/ip/hotspot/user/print",
+            proplist=["name", "profile", "disabled", "comment", "limit-uptime"]
+        )
+        active_sessions_result = await api.query(
+            "/ip/hotspot/active/print",
+            proplist=["user", "address", "login-time", "uptime", "bytes-in", "bytes-out"]
+        )
 
         users = []
         active_sessions = {}
@@ -921,10 +772,101 @@ async def get_router_users(
         logger.error(f"Error getting router users: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get users: {str(e)}")
     finally:
-        api.disconnect()
+        await mikrotik_pool.release(api)
+
+
+
+
+# Bulk provisioning endpoint (requires auth)
+@app.post("/api/routers/{router_id}/bulk-provision")
+async def bulk_provision_customers(
+    router_id: int,
+    payload: Dict[str, Any],
+    db: AsyncSession = Depends(get_db),
+    token: str = Depends(verify_token)
+):
+    """
+    Provision many customers on one router in a single pooled session.
+
+    Expected payload:
+    {
+        "customers": [
+            {"mac_address": "AA:BB:CC:DD:EE:FF", "time_limit": "7d", "bandwidth_limit": "1M/2M", "comment": "..."},
+            ...
+        ],
+        "dry_run": false
+    }
 
+    Only entries that are missing or differ on the router are written; with
+    dry_run the planned changes are reported without touching the router.
+    """
+    user = await get_current_user(token, db)
+    router = await get_router_by_id(db, router_id, user.user_id, user.role)
+    if not router:
+        raise HTTPException(status_code=404, detail="Router not found or not accessible")
 
+    customers = payload.get("customers") or []
+    if not customers:
+        raise HTTPException(status_code=400, detail="No customers supplied")
+    if len(customers) > settings.BULK_PROVISION_MAX_CUSTOMERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.BULK_PROVISION_MAX_CUSTOMERS} customers per request"
+        )
 
+    # One report per entry, in input order; valid entries are filled in below
+    results = [None] * len(customers)
+    valid = []
+    positions = []
+    seen = set()
+    for position, entry in enumerate(customers):
+        mac_address = entry.get("mac_address")
+        if not mac_address or not validate_mac_address(mac_address) or not entry.get("time_limit"):
+            results[position] = {"mac_address": mac_address, "status": "invalid", "changes": [],
+                                 "errors": ["mac_address and time_limit are required"]}
+            continue
+        normalized_mac = normalize_mac_address(mac_address)
+        if normalized_mac in seen:
+            results[position] = {"mac_address": normalized_mac, "status": "invalid", "changes": [],
+                                 "errors": ["Duplicate MAC address in batch"]}
+            continue
+        try:
+            duration_seconds(str(entry["time_limit"]))
+        except ValueError:
+            results[position] = {"mac_address": normalized_mac, "status": "invalid", "changes": [],
+                                 "errors": [f"Invalid time_limit: {entry['time_limit']}"]}
+            continue
+        seen.add(normalized_mac)
+        valid.append({**entry, "mac_address": normalized_mac})
+        positions.append(position)
+
+    dry_run = bool(payload.get("dry_run"))
+    if valid:
+        api = await mikrotik_pool.acquire(router)
+        if not api:
+            raise HTTPException(status_code=500, detail="Failed to connect to router")
+        try:
+            for position, report in zip(positions, await api.bulk_provision_bypass(valid, dry_run=dry_run)):
+                results[position] = report
+        except Exception as e:
+            logger.error(f"Bulk provisioning failed on router {router_id}: {e}")
+            raise HTTPException(status_code=500, detail=f"Bulk provisioning failed: {str(e)}")
+        finally:
+            await mikrotik_pool.release(api)
+            if not dry_run:
+                router_state_cache.invalidate(router_id)
+
+    summary = {}
+    for result in results:
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    logger.info(f"Bulk provisioning on router {router_id} by user {user.user_id}: {summary}")
+
+    return {
+        "router_id": router_id,
+        "dry_run": dry_run,
+        "summary": summary,
+        "results": results
+    }
 
 @app.delete("/api/routers/{router_id}/users/{username}")
 async def remove_router_user(
@@ -939,34 +881,36 @@ async def remove_router_user(
     if not router:
         raise HTTPException(status_code=404, detail="Router not found or not accessible")
 
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    api = await mikrotik_pool.acquire(router)
+    if not api:
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
     try:
-        # First disconnect any active sessions
-        active_sessions = api.send_command("/ip/hotspot/active/print")
-        if active_sessions.get("success") and active_sessions.get("data"):
-            for session in active_sessions["data"]:
-                if session.get("user") == username:
-                    session_id = session.get(".id")
-                    if session_id:
-                        api.send_command("/ip/hotspot/active/remove", {"numbers": session_id})
-
-        # Remove the user
-        users_result = api.send_command("/ip/hotspot/user/print")
+        # Look up the user and its active sessions in one round-trip
+        active_sessions, users_result = await api.pipeline([
+            build_query_words("/ip/hotspot/active/print", {"user": case_variants(username)}, [".id"]),
+            build_query_words("/ip/hotspot/user/print", {"name": case_variants(username)}, [".id"]),
+        ])
         user_id = None
 
         if users_result.get("success") and users_result.get("data"):
-            for user in users_result["data"]:
-                if user.get("name") == username:
-                    user_id = user.get(".id")
-                    break
+            user_id = users_result["data"][0].get(".id")
+
+        # Disconnect any active sessions and remove the user together
+        removals = []
+        if active_sessions.get("success") and active_sessions.get("data"):
+            for session in active_sessions["data"]:
+                session_id = session.get(".id")
+                if session_id:
+                    removals.append(build_command_words("/ip/hotspot/active/remove", {"numbers": session_id}))
+        if user_id:
+            removals.append(build_command_words("/ip/hotspot/user/remove", {"numbers": user_id}))
+        remove_results = await api.pipeline(removals)
 
         if not user_id:
             raise HTTPException(status_code=404, detail="User not found")
 
-        remove_result = api.send_command("/ip/hotspot/user/remove", {"numbers": user_id})
+        remove_result = remove_results[-1]
 
         if "error" in remove_result:
             raise HTTPException(status_code=400, detail=remove_result["error"])
@@ -974,25 +918,22 @@ async def remove_router_user(
         # Also remove IP bindings and queues if they exist
         # Convert username back to MAC format for cleanup
         if len(username) == 12 and username.isalnum():
-            mac_address = ':'.join(username[i:i+2] for i in range(0, 12, 2))
-
-            # Remove IP bindings
-            bindings_result = api.send_command("/ip/hotspot/ip-binding/print")
-            if bindings_result.get("success") and bindings_result.get("data"):
-                for binding in bindings_result["data"]:
-                    if binding.get("mac-address", "").upper() == mac_address.upper():
-                        binding_id = binding.get(".id")
-                        if binding_id:
-                            api.send_command("/ip/hotspot/ip-binding/remove", {"numbers": binding_id})
-
-            # Remove queues
-            queues_result = api.send_command("/queue/simple/print")
-            if queues_result.get("success") and queues_result.get("data"):
-                for queue in queues_result["data"]:
-                    if queue.get("name") == f"queue_{username}":
-                        queue_id = queue.get(".id")
-                        if queue_id:
-                            api.send_command("/queue/simple/remove", {"numbers": queue_id})
+            mac_address = ':'.join(username[i:i+2] for i in range(0, 12, 2)).upper()
+
+            bindings_result, queues_result = await api.pipeline([
+                build_query_words("/ip/hotspot/ip-binding/print", {"mac-address": mac_address}, [".id"]),
+                build_query_words("/queue/simple/print", {"name": f"queue_{username}"}, [".id"]),
+            ])
+            cleanup = []
+            for rows, remove_command in (
+                (bindings_result, "/ip/hotspot/ip-binding/remove"),
+                (queues_result, "/queue/simple/remove"),
+            ):
+                if rows.get("success") and rows.get("data"):
+                    for row in rows["data"]:
+                        if row.get(".id"):
+                            cleanup.append(build_command_words(remove_command, {"numbers": row[".id"]}))
+            await api.pipeline(cleanup)
 
         return {
             "success": True,
@@ -1007,7 +948,8 @@ async def remove_router_user(
         logger.error(f"Error removing user: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to remove user: {str(e)}")
     finally:
-        api.disconnect()
+        await mikrotik_pool.release(api)
+        router_state_cache.invalidate(router_id)
 
 # Router stats endpoint (requires auth)
 @app.get("/api/router_stats/{router_id}")
@@ -1022,19 +964,22 @@ async def get_router_stats(
     if not router:
         raise HTTPException(status_code=404, detail="Router not found or not accessible")
 
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    api = await mikrotik_pool.acquire(router)
+    if not api:
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
     try:
         # Get hotspot users
-        users_result = api.send_command("/ip/hotspot/user/print")
+        users_result = await api.query("/ip/hotspot/user/print", proplist=[".id"])
         total_users = 0
         if users_result.get("success") and users_result.get("data"):
             total_users = len(users_result["data"])
 
         # Get active sessions
-        active_sessions_result = api.send_command("/ip/hotspot/active/print")
+        active_sessions_result = await api.query(
+            "/ip/hotspot/active/print",
+            proplist=["user", "address", "login-time", "uptime", "bytes-in", "bytes-out"]
+        )
         active_sessions = 0
         active_users = []
 
@@ -1051,7 +996,7 @@ async def get_router_stats(
                 })
 
         # Get router system info
-        system_result = api.send_command("/system/resource/print")
+        system_result = await api.send_command("/system/resource/print")
         system_info = {}
         if system_result.get("success") and system_result.get("data"):
             data = system_result["data"][0] if system_result["data"] else {}
@@ -1080,7 +1025,7 @@ async def get_router_stats(
         logger.error(f"Error getting router stats: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get router stats: {str(e)}")
     finally:
-        api.disconnect()
+        await mikrotik_pool.release(api)
 
 # Sync router users endpoint (requires auth)
 @app.post("/api/routers/{router_id}/sync")
@@ -1095,13 +1040,13 @@ async def sync_router_users_with_database(
     if not router:
         raise HTTPException(status_code=404, detail="Router not found or not accessible")
 
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    api = await mikrotik_pool.acquire(router)
+    if not api:
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
     try:
         # Get all users from router
-        users_result = api.send_command("/ip/hotspot/user/print")
+        users_result = await api.query("/ip/hotspot/user/print", proplist=["name"])
         router_users = []
         if users_result.get("success") and users_result.get("data"):
             router_users = users_result["data"]
@@ -1139,7 +1084,7 @@ async def sync_router_users_with_database(
         logger.error(f"Error syncing router users: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Sync failed: {str(e)}")
     finally:
-        api.disconnect()
+        await mikrotik_pool.release(api)
 
 @app.delete("/api/public/remove-bypassed/{router_id}/{mac_address}")
 async def remove_bypassed_user_public(
@@ -1156,68 +1101,136 @@ async def remove_bypassed_user_public(
         raise HTTPException(status_code=400, detail="Invalid MAC address format")
 
     normalized_mac = normalize_mac_address(mac_address)
-    username = normalized_mac.replace(":", "")
 
     router = await get_router_by_id(db, router_id)
     if not router:
         raise HTTPException(status_code=404, detail="Router not found")
 
-    api = MikroTikAPI(router.ip_address, router.username, router.password, router.port)
-    if not api.connect():
+    api = await mikrotik_pool.acquire(router)
+    if not api:
         raise HTTPException(status_code=500, detail="Failed to connect to router")
 
     try:
-        # Disconnect active sessions
-        active_sessions = api.send_command("/ip/hotspot/active/print")
-        if active_sessions.get("success") and active_sessions.get("data"):
-            for session in active_sessions["data"]:
-                if session.get("user") == username:
-                    sid = session.get(".id")
-                    if sid:
-                        api.send_command("/ip/hotspot/active/remove", {"numbers": sid})
-
-        # Remove hotspot user
-        users = api.send_command("/ip/hotspot/user/print")
-        uid = None
-        if users.get("success") and users.get("data"):
-            for u in users["data"]:
-                if u.get("name") == username:
-                    uid = u.get(".id")
-                    break
-        if uid:
-            api.send_command("/ip/hotspot/user/remove", {"numbers": uid})
-
-        # Clean up IP bindings, queues, DHCP lease
-        bindings = api.send_command("/ip/hotspot/ip-binding/print")
-        if bindings.get("success") and bindings.get("data"):
-            for b in bindings["data"]:
-                if b.get("mac-address", "").upper() == normalized_mac.upper():
-                    api.send_command("/ip/hotspot/ip-binding/remove", {"numbers": b[".id"]})
-
-        queues = api.send_command("/queue/simple/print")
-        if queues.get("success") and queues.get("data"):
-            for q in queues["data"]:
-                if q.get("name") == f"queue_{username}":
-                    api.send_command("/queue/simple/remove", {"numbers": q[".id"]})
-
-        leases = api.send_command("/ip/dhcp-server/lease/print")
-        if leases.get("success") and leases.get("data"):
-            for l in leases["data"]:
-                if l.get("mac-address", "").upper() == normalized_mac.upper():
-                    api.send_command("/ip/dhcp-server/lease/remove", {"numbers": l[".id"]})
+        # One pipelined lookup and one pipelined removal round-trip
+        result = await api.remove_bypassed_user(normalized_mac)
+        if "error" in result:
+            raise HTTPException(status_code=500, detail=result["error"])
 
         return {
             "success": True,
             "message": f"User with MAC {normalized_mac} removed successfully",
             "mac_address": normalized_mac,
-            "router_id": router_id
+            "router_id": router_id,
+            "details": result["details"]
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error removing bypassed user {normalized_mac}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        api.disconnect()
+        await mikrotik_pool.release(api)
+        router_state_cache.invalidate(router_id)
+
+@app.on_event("startup")
+async def start_background_workers():
+    get_http_client()
+    app.state.mikrotik_reaper = asyncio.create_task(mikrotik_pool.run_reaper())
+    app.state.router_state_refresher = asyncio.create_task(router_state_cache.run_refresher())
+    app.state.provisioning_worker = asyncio.create_task(provisioning_queue.run())
+    app.state.expiry_scheduler = asyncio.create_task(expiry_scheduler.run())
+    app.state.financials_reconciler = asyncio.create_task(
+        run_financials_reconciler(settings.FINANCIALS_RECONCILE_INTERVAL_SECONDS)
+    )
+    app.state.mpesa_reconciler = asyncio.create_task(mpesa_reconciler.run())
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    app.state.mpesa_reconciler.cancel()
+    app.state.financials_reconciler.cancel()
+    app.state.expiry_scheduler.cancel()
+    app.state.provisioning_worker.cancel()
+    await provisioning_queue.close()
+    app.state.mikrotik_reaper.cancel()
+    app.state.router_state_refresher.cancel()
+    await router_state_cache.close()
+    await mikrotik_pool.close()
+    password_hasher.close()
+    await close_http_client()
+    await async_engine.dispose()
+    if has_replica():
+        await replica_engine.dispose()
+
+def _export_response(stmt, fmt: str, name: str) -> StreamingResponse:
+    filename = f"{name}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    return StreamingResponse(
+        stream_export(stmt, fmt),
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def _export_user(token: dict, fmt: str) -> int:
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {fmt}. Valid options are: {', '.join(EXPORT_FORMATS)}")
+    if token.get("role") not in ["admin", "reseller"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions to export data")
+    return int(token["user_id"])
+
+# Streaming payment history export (requires auth)
+@app.get("/api/exports/payments")
+async def export_payments(
+    format: str = "csv",
+    customer_id: Optional[int] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    token: dict = Depends(verify_token)
+):
+    user_id = _export_user(token, format)
+    stmt = payment_export_query(user_id, customer_id, start_date, end_date, payment_method)
+    return _export_response(stmt, format, "payments")
+
+# Streaming customer list export (requires auth)
+@app.get("/api/exports/customers")
+async def export_customers(format: str = "csv", status: Optional[str] = None, token: dict = Depends(verify_token)):
+    user_id = _export_user(token, format)
+    return _export_response(customer_export_query(user_id, status), format, "customers")
+
+# Operational metrics (admin only: the figures span every reseller)
+@app.get("/api/metrics")
+async def get_metrics(db: AsyncSession = Depends(get_db), token: dict = Depends(verify_token)):
+    """Connection pool, cache and queue statistics for capacity planning"""
+    if token.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Insufficient permissions to view metrics")
+    return {
+        "db_pool": pool_telemetry.stats(),
+        "db_replica_pool": replica_pool_telemetry.stats() if has_replica() else None,
+        "mikrotik_pool": mikrotik_pool.stats(),
+        "router_state_cache": router_state_cache.stats(),
+        "provisioning_queue": {
+            **provisioning_queue.stats(),
+            "jobs": await provisioning_queue.depth(db),
+        },
+        "expiry_scheduler": expiry_scheduler.stats(),
+        "recent_callbacks": recent_callbacks.stats(),
+        "auth_token_cache": token_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "daraja_token": daraja_token.stats(),
+        "mpesa_reconciler": mpesa_reconciler.stats(),
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+# Retry a dead-lettered provisioning job (admins: any job, resellers: jobs on their own routers)
+@app.post("/api/provisioning/jobs/{job_id}/retry")
+async def retry_provisioning_job(job_id: int, db: AsyncSession = Depends(get_db), token: dict = Depends(verify_token)):
+    role = token.get("role")
+    if role not in ["admin", "reseller"]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions to retry provisioning jobs")
+    owner_id = None if role == "admin" else int(token["user_id"])
+    if not await provisioning_queue.requeue(db, job_id, owner_id):
+        raise HTTPException(status_code=404, detail="No dead-lettered job with that id")
+    return {"success": True, "job_id": job_id}
 
 @app.get("/")
 def read_root():
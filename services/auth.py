@@ -5,11 +5,10 @@ from sqlalchemy import select
 from jose import jwt, JWTError
 from datetime import datetime, timedelta
 import random
-from passlib.context import CryptContext
 from app.db.models import User, UserRole
 from app.db.database import get_db
 from app.config import settings
-from app.core.security import ALGORITHM
+from app.core.security import ALGORITHM, password_hasher
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,8 +16,6 @@ logger = logging.getLogger(__name__)
 # OAuth2 scheme for extracting the token from the Authorization header
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/graphql")  # Matches GraphQL login endpoint
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 async def generate_unique_user_code(db: AsyncSession) -> int:
     while True:
         user_code = random.randint(100000, 999999)
@@ -28,7 +25,7 @@ async def generate_unique_user_code(db: AsyncSession) -> int:
             return user_code
 
 async def create_user(db: AsyncSession, email: str, password: str, role: UserRole, organization_name: str, created_by: int = None):
-    hashed_password = pwd_context.hash(password)
+    hashed_password = await password_hasher.hash(password)
     user_code = await generate_unique_user_code(db)
     user = User(
         user_code=user_code,
@@ -48,8 +45,15 @@ async def authenticate_user(db: AsyncSession, email: str, password: str):
     stmt = select(User).filter(User.email == email)
     result = await db.execute(stmt)
     user = result.scalar_one_or_none()
-    if not user or not pwd_context.verify(password, user.password_hash):
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    valid, new_hash = await password_hasher.verify_and_update(password, user.password_hash)
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Stored with a different BCRYPT_ROUNDS; upgrade while we have the password
+        user.password_hash = new_hash
+        await db.commit()
 
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     
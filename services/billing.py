@@ -10,15 +10,59 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+def parse_date_filter(value: Optional[str], name: str) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        # Convert to offset-naive by removing tzinfo
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} format. Use ISO format")
+
+def filter_payments(
+    stmt,
+    customer_id: Optional[int] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    payment_method: Optional[str] = None
+):
+    """Validate payment filter arguments (my_payments, exports) and apply them to stmt"""
+    if customer_id is not None and customer_id <= 0:
+        raise HTTPException(status_code=400, detail="Customer ID must be a positive integer")
+
+    start_dt = parse_date_filter(start_date, "start_date")
+    end_dt = parse_date_filter(end_date, "end_date")
+    if start_dt and end_dt and start_dt > end_dt:
+        raise HTTPException(status_code=400, detail="Start date cannot be after end date")
+
+    if customer_id:
+        stmt = stmt.where(CustomerPayment.customer_id == customer_id)
+    if start_dt:
+        stmt = stmt.where(CustomerPayment.payment_date >= start_dt)
+    if end_dt:
+        stmt = stmt.where(CustomerPayment.payment_date <= end_dt)
+
+    if payment_method:
+        # Match case-insensitively with lowercase enum values
+        method_enum = next((method for method in PaymentMethod if method.value.lower() == payment_method.lower()), None)
+        if method_enum is None:
+            valid_methods = [method.value for method in PaymentMethod]
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid payment method: {payment_method}. Valid options are: {', '.join(valid_methods)}"
+            )
+        stmt = stmt.where(CustomerPayment.payment_method == method_enum)
+    return stmt
+
 async def get_customers_by_user(db: AsyncSession, user_id: int, role: str):
     """
     Fetch customers for a user, filtered by user_id for resellers.
     """
-    stmt = select(Customer).options(joinedload(Customer.plan))
+    stmt = select(Customer)
     if role != "admin":
         stmt = stmt.filter(Customer.user_id == user_id)
     result = await db.execute(stmt)
-    return result.scalars().unique().all()
+    return result.scalars().all()
 
 async def get_plans_by_user(db: AsyncSession, user_id: int, role: str):
     """
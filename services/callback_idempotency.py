@@ -0,0 +1,81 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.core.cache import TTLCache
+from app.db.models import ProcessedCallback
+
+logger = logging.getLogger(__name__)
+
+# Keys this process has already seen applied; saves the database round-trip
+# for the common case of a gateway retrying the same delivery back-to-back
+recent_callbacks = TTLCache(maxsize=settings.CALLBACK_RECENT_KEYS, ttl=settings.CALLBACK_RECENT_TTL_SECONDS)
+
+
+def callback_idempotency_key(payload: dict) -> Optional[str]:
+    """
+    Key identifying one payment outcome. The status is part of the key so a
+    pending -> completed transition for the same transaction is still applied.
+    """
+    reference = payload.get("lipay_tx_no") or payload.get("checkout_request_id") or payload.get("receipt_number")
+    if not reference:
+        return None
+    return f"lipay:{reference}:{payload.get('status')}"
+
+
+async def claim_callback(db: AsyncSession, key: str, payload: dict) -> bool:
+    """
+    Atomically record the key in the caller's transaction.
+    Returns False if another delivery already claimed it. A concurrent
+    delivery of the same key blocks on the unique index until this
+    transaction finishes, so only one of them can ever apply the payment.
+    """
+    result = await db.execute(
+        insert(ProcessedCallback)
+        .values(
+            idempotency_key=key,
+            customer_ref=payload.get("customer_ref"),
+            status=payload.get("status")
+        )
+        .on_conflict_do_nothing(index_elements=["idempotency_key"])
+        .returning(ProcessedCallback.id)
+    )
+    return result.scalar() is not None
+
+
+async def release_callback(db: AsyncSession, key: str):
+    """Forget a claim so the gateway's next retry is processed again"""
+    recent_callbacks.delete(key)
+    await db.execute(delete(ProcessedCallback).where(ProcessedCallback.idempotency_key == key))
+
+
+async def prune_processed_callbacks(
+    db: AsyncSession,
+    retention: timedelta = timedelta(days=settings.CALLBACK_RETENTION_DAYS),
+    batch_size: int = settings.CALLBACK_PRUNE_BATCH_SIZE,
+) -> int:
+    """
+    Delete claims older than the retention window, batch_size rows per
+    transaction so the table is never locked for long. A gateway stops
+    retrying long before then, so an old key can no longer be redelivered.
+    Returns how many rows were deleted.
+    """
+    cutoff = datetime.utcnow() - retention
+    deleted = 0
+    while True:
+        batch = (
+            select(ProcessedCallback.id)
+            .where(ProcessedCallback.created_at < cutoff)
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        result = await db.execute(delete(ProcessedCallback).where(ProcessedCallback.id.in_(batch)))
+        await db.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
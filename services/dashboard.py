@@ -0,0 +1,90 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Iterable
+
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.core.cache import TTLCache
+from app.db.models import Customer, CustomerPayment, CustomerStatus, Subscription
+from app.services.reseller_payments import TOUCHED_RESELLERS
+
+logger = logging.getLogger(__name__)
+
+ADMIN_TENANT = "admin"
+
+# Per-tenant dashboard figures; dropped on commit of any payment or customer
+# status or expiry change for the tenant, otherwise they live DASHBOARD_CACHE_TTL_SECONDS
+dashboard_cache = TTLCache(maxsize=settings.DASHBOARD_CACHE_MAX_TENANTS, ttl=settings.DASHBOARD_CACHE_TTL_SECONDS)
+
+
+def invalidate_dashboards(reseller_ids: Iterable[int]):
+    reseller_ids = list(reseller_ids)
+    if not reseller_ids:
+        return
+    for reseller_id in reseller_ids:
+        if reseller_id is not None:
+            dashboard_cache.delete(reseller_id)
+    # Admin figures cover every reseller
+    dashboard_cache.delete(ADMIN_TENANT)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session: Session):
+    invalidate_dashboards(session.info.pop(TOUCHED_RESELLERS, ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session):
+    session.info.pop(TOUCHED_RESELLERS, None)
+
+
+async def get_dashboard_metrics(db: AsyncSession, user_id: int, role: str) -> Dict[str, float]:
+    """Customer counts, revenue and subscription days for a tenant in one round-trip"""
+    tenant = ADMIN_TENANT if role == "admin" else user_id
+    cached = dashboard_cache.get(tenant)
+    if cached is not None:
+        return cached
+
+    now = datetime.utcnow()
+    revenue = select(func.coalesce(func.sum(CustomerPayment.amount), 0)).join(Customer).correlate(None)
+    if role != "admin":
+        revenue = revenue.where(Customer.user_id == user_id)
+
+    columns = [
+        func.count().label("total_customers"),
+        func.count().filter(Customer.status == CustomerStatus.ACTIVE).label("active_customers"),
+        func.count().filter(Customer.status == CustomerStatus.INACTIVE).label("inactive_customers"),
+        func.count().filter(
+            Customer.status == CustomerStatus.ACTIVE,
+            Customer.expiry <= now + timedelta(days=7),
+            Customer.expiry >= now
+        ).label("expiring_soon"),
+        revenue.scalar_subquery().label("total_revenue"),
+    ]
+    if role != "admin":
+        columns.append(
+            select(func.max(Subscription.expires_on))
+            .where(Subscription.user_id == user_id, Subscription.is_active == True)
+            .scalar_subquery()
+            .label("subscription_expires_on")
+        )
+
+    stmt = select(*columns).select_from(Customer)
+    if role != "admin":
+        stmt = stmt.where(Customer.user_id == user_id)
+    row = (await db.execute(stmt)).one()
+
+    subscription_expires_on = getattr(row, "subscription_expires_on", None)
+    metrics = {
+        "total_customers": row.total_customers or 0,
+        "active_customers": row.active_customers or 0,
+        "inactive_customers": row.inactive_customers or 0,
+        "total_revenue": float(row.total_revenue or 0),
+        "expiring_soon": row.expiring_soon or 0,
+        "subscription_days_left": max(0, (subscription_expires_on - now).days) if subscription_expires_on else 0,
+    }
+    dashboard_cache.set(tenant, metrics)
+    return metrics
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select, update
+
+from app.config import settings
+from app.db.database import async_session
+from app.db.models import Customer, CustomerStatus, ProvisioningJob, ProvisioningJobStatus, ProvisioningLog, Router
+from app.services.mikrotik_api import normalize_mac_address
+from app.services.mikrotik_pool import mikrotik_pool
+from app.services.provisioning_queue import HOTSPOT_TEARDOWN, provisioning_queue
+from app.services.reseller_payments import adjust_active_customers, mark_touched
+from app.services.router_state_cache import router_state_cache
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """
+    Deactivates customers whose expiry has passed and removes their bypass
+    entries from the routers.
+
+    Due customers are found through the (status, expiry) index, so each pass
+    costs the number of expirations rather than the number of customers. The
+    scheduler sleeps until the next expiry (capped at EXPIRY_MAX_SLEEP_SECONDS)
+    and tears down each router's batch over one pooled, pipelined session.
+    Every expired customer also gets a HOTSPOT_TEARDOWN job in the same
+    transaction as the expiry, so a failed or interrupted teardown is retried
+    by the provisioning queue.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = settings.EXPIRY_BATCH_SIZE,
+        max_sleep: int = settings.EXPIRY_MAX_SLEEP_SECONDS,
+        teardown_grace: int = settings.EXPIRY_TEARDOWN_GRACE_SECONDS,
+    ):
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        self.teardown_grace = teardown_grace
+        self.counters = {"expired": 0, "torn_down": 0, "teardown_deferred": 0, "passes": 0}
+
+    async def _expire_batch(self) -> List[Tuple[int, int, str, Optional[int]]]:
+        """
+        Flip one batch of due customers to INACTIVE and queue their teardowns
+        in the same transaction; returns (id, router_id, mac_address, job_id),
+        with no job for customers that have no router or MAC address.
+        The jobs are held back for EXPIRY_TEARDOWN_GRACE_SECONDS while _handle
+        tears down directly, so they only run if that fails or never happens.
+        """
+        now = datetime.utcnow()
+        due = (
+            select(Customer.id)
+            .where(Customer.status == CustomerStatus.ACTIVE, Customer.expiry <= now)
+            .order_by(Customer.expiry)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with async_session() as db:
+            result = await db.execute(
+                update(Customer)
+                .where(Customer.id.in_(due.scalar_subquery()))
+                .values(status=CustomerStatus.INACTIVE)
+                .returning(Customer.id, Customer.router_id, Customer.mac_address, Customer.user_id)
+                .execution_options(synchronize_session=False)
+            )
+            rows = result.all()
+            # Bulk UPDATEs skip the ORM flush hook, so adjust the counters here
+            deactivated = defaultdict(int)
+            for row in rows:
+                deactivated[row.user_id] -= 1
+            await adjust_active_customers(db, deactivated)
+            # Dropped from the dashboard cache once this commits
+            mark_touched(db.sync_session, deactivated)
+            jobs = {
+                row.id: provisioning_queue.enqueue(
+                    db, row.id, row.router_id, {"mac_address": row.mac_address},
+                    action=HOTSPOT_TEARDOWN, delay=self.teardown_grace
+                )
+                for row in rows if row.router_id and row.mac_address
+            }
+            await db.commit()
+        expired = [
+            (row.id, row.router_id, row.mac_address, jobs[row.id].id if row.id in jobs else None) for row in rows
+        ]
+        self.counters["expired"] += len(expired)
+        return expired
+
+    async def _teardown(self, router: Router, customers: List[Tuple[int, str]]) -> Dict[int, str]:
+        """Remove a router's expired customers in one session; returns errors by customer id"""
+        async with mikrotik_pool.session(router) as api:
+            if not api:
+                return {customer_id: "Failed to connect to router" for customer_id, _ in customers}
+            results = await api.bulk_remove_bypassed([mac for _, mac in customers])
+        router_state_cache.invalidate(router.id)
+        errors = {}
+        for customer_id, mac in customers:
+            outcome = results.get(normalize_mac_address(mac), {})
+            if "error" in outcome:
+                errors[customer_id] = outcome["error"]
+        return errors
+
+    async def _handle(self, expired: List[Tuple[int, int, str, Optional[int]]]):
+        """
+        Fast path for the queued teardowns: one pipelined session per router.
+        No database connection is held during the router I/O. Customers that
+        renewed since _expire_batch are skipped, as the queued handler would.
+        """
+        job_ids = {customer_id: job_id for customer_id, _, _, job_id in expired if job_id is not None}
+        if not job_ids:
+            return
+        async with async_session() as db:
+            renewed = set((await db.execute(
+                select(Customer.id).where(
+                    Customer.id.in_(list(job_ids)),
+                    Customer.status == CustomerStatus.ACTIVE,
+                    Customer.expiry > datetime.utcnow()
+                )
+            )).scalars())
+            by_router: Dict[int, List[Tuple[int, str]]] = defaultdict(list)
+            for customer_id, router_id, mac_address, job_id in expired:
+                if job_id is not None and customer_id not in renewed:
+                    by_router[router_id].append((customer_id, mac_address))
+            routers = {}
+            if by_router:
+                rows = await db.execute(select(Router).where(Router.id.in_(list(by_router))))
+                routers = {router.id: router for router in rows.scalars()}
+
+        async def teardown(router_id: int, customers: List[Tuple[int, str]]) -> Dict[int, str]:
+            router = routers.get(router_id)
+            if router is None:
+                return {customer_id: f"Router {router_id} not found" for customer_id, _ in customers}
+            try:
+                return await self._teardown(router, customers)
+            except Exception as e:
+                return {customer_id: str(e) for customer_id, _ in customers}
+
+        outcomes = await asyncio.gather(*(
+            teardown(router_id, customers) for router_id, customers in by_router.items()
+        ))
+
+        now = datetime.utcnow()
+        done = [job_ids[customer_id] for customer_id in renewed]
+        failed = []
+        async with async_session() as db:
+            for (router_id, customers), errors in zip(by_router.items(), outcomes):
+                for customer_id, mac_address in customers:
+                    error = errors.get(customer_id)
+                    if error:
+                        failed.append(job_ids[customer_id])
+                        self.counters["teardown_deferred"] += 1
+                    else:
+                        done.append(job_ids[customer_id])
+                        self.counters["torn_down"] += 1
+                    db.add(ProvisioningLog(
+                        customer_id=customer_id,
+                        router_id=router_id,
+                        mac_address=mac_address,
+                        action="EXPIRE",
+                        status="FAILED" if error else "SUCCESS",
+                        error=error[:255] if error else None,
+                        details="Teardown queued for retry" if error else "Expired and removed from router",
+                        log_date=now
+                    ))
+            pending = (ProvisioningJob.status == ProvisioningJobStatus.PENDING, ProvisioningJob.attempts == 0)
+            if done:
+                await db.execute(
+                    update(ProvisioningJob)
+                    .where(ProvisioningJob.id.in_(done), *pending)
+                    .values(status=ProvisioningJobStatus.SUCCEEDED)
+                )
+            if failed:
+                # Hand the failures to the queue now rather than after the grace period
+                await db.execute(
+                    update(ProvisioningJob)
+                    .where(ProvisioningJob.id.in_(failed), *pending)
+                    .values(next_attempt_at=now)
+                )
+            await db.commit()
+        if failed:
+            provisioning_queue.notify()
+
+    async def run_once(self) -> int:
+        """Expire everything that is due now; returns the number of customers expired"""
+        total = 0
+        while True:
+            expired = await self._expire_batch()
+            if expired:
+                logger.info(f"Expired {len(expired)} customer(s)")
+                await self._handle(expired)
+            total += len(expired)
+            if len(expired) < self.batch_size:
+                return total
+
+    async def _seconds_until_next_expiry(self) -> float:
+        async with async_session() as db:
+            next_expiry = (await db.execute(
+                select(func.min(Customer.expiry)).where(Customer.status == CustomerStatus.ACTIVE)
+            )).scalar()
+        if next_expiry is None:
+            return self.max_sleep
+        return min(max((next_expiry - datetime.utcnow()).total_seconds(), 1), self.max_sleep)
+
+    async def run(self):
+        """Background task that enforces expiry"""
+        while True:
+            delay = self.max_sleep
+            try:
+                self.counters["passes"] += 1
+                await self.run_once()
+                delay = await self._seconds_until_next_expiry()
+            except Exception as e:
+                logger.error(f"Expiry scheduler error: {e}")
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return dict(self.counters)
+
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,123 @@
+import csv
+import enum
+import io
+import json
+import logging
+from datetime import date, datetime
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import select
+
+from app.config import settings
+from app.db.database import ReplicaSessionLocal
+from app.db.models import Customer, CustomerPayment, CustomerStatus, Plan
+from app.services.billing import filter_payments
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def payment_export_query(
+    reseller_id: int,
+    customer_id: Optional[int] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    payment_method: Optional[str] = None
+):
+    """Column select for a reseller's payments with the my_payments filters; raises 400 on bad filters"""
+    stmt = (
+        select(
+            CustomerPayment.id,
+            CustomerPayment.customer_id,
+            Customer.name.label("customer_name"),
+            Customer.phone.label("customer_phone"),
+            CustomerPayment.amount,
+            CustomerPayment.payment_method,
+            CustomerPayment.payment_reference,
+            CustomerPayment.payment_date,
+            CustomerPayment.days_paid_for,
+            CustomerPayment.status,
+            CustomerPayment.notes,
+        )
+        .outerjoin(Customer, Customer.id == CustomerPayment.customer_id)
+        .where(CustomerPayment.reseller_id == reseller_id)
+    )
+    stmt = filter_payments(stmt, customer_id, start_date, end_date, payment_method)
+    # Walks ix_customer_payments_reseller_date_id
+    return stmt.order_by(CustomerPayment.payment_date.desc(), CustomerPayment.id.desc())
+
+
+def customer_export_query(user_id: int, status: Optional[str] = None):
+    """Column select for a reseller's customers, optionally by status; raises 400 on an unknown status"""
+    stmt = (
+        select(
+            Customer.id,
+            Customer.name,
+            Customer.phone,
+            Customer.mac_address,
+            Customer.pppoe_username,
+            Customer.static_ip,
+            Customer.status,
+            Customer.expiry,
+            Plan.name.label("plan_name"),
+            Customer.router_id,
+            Customer.created_at,
+        )
+        .outerjoin(Plan, Plan.id == Customer.plan_id)
+        .where(Customer.user_id == user_id)
+    )
+    if status:
+        status_enum = next((s for s in CustomerStatus if s.value == status.lower()), None)
+        if status_enum is None:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid status: {status}. Valid options are: {', '.join(s.value for s in CustomerStatus)}"
+            )
+        stmt = stmt.where(Customer.status == status_enum)
+    return stmt.order_by(Customer.id)
+
+
+def _plain(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+async def stream_export(stmt, fmt: str, batch_size: int = settings.EXPORT_BATCH_SIZE) -> AsyncIterator[str]:
+    """
+    Yield stmt's rows as CSV (with a header line) or NDJSON, one chunk per
+    batch. Rows come from a server-side cursor on the read replica in
+    batches of batch_size, so memory stays flat however large the export.
+    The session is opened here, not in a request dependency, because the body
+    is still being sent after the endpoint has returned.
+    """
+    sent = 0
+    async with ReplicaSessionLocal() as session:
+        result = await session.stream(stmt.execution_options(yield_per=batch_size))
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fmt == "csv":
+            writer.writerow(columns)
+        async for rows in result.partitions():
+            for row in rows:
+                values = [_plain(value) for value in row]
+                if fmt == "csv":
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, values)), default=str))
+                    buffer.write("\n")
+            sent += len(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if fmt == "csv" and not sent:
+            yield buffer.getvalue()
+    logger.info(f"Export finished: {sent} rows as {fmt}")
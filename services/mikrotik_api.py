@@ -3,7 +3,7 @@ import struct
 import re
 import hashlib
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Union
 from datetime import datetime
 import json  # Ensure you import json for serializing logs
 
@@ -22,6 +22,119 @@ def normalize_mac_address(mac: str) -> str:
     clean_mac = re.sub(r'[:-]', '', mac.upper())
     return ':'.join(clean_mac[i:i+2] for i in range(0, 12, 2))
 
+def encode_length(length: int) -> bytes:
+    """Encode a word length using the RouterOS API variable-length scheme"""
+    if length < 0x80:
+        return struct.pack('B', length)
+    elif length < 0x4000:
+        length |= 0x8000
+        return struct.pack('>H', length)
+    elif length < 0x200000:
+        length |= 0xC00000
+        return struct.pack('>I', length)[1:]
+    elif length < 0x10000000:
+        length |= 0xE0000000
+        return struct.pack('>I', length)
+    else:
+        return struct.pack('B', 0xF0) + struct.pack('>I', length)
+
+def parse_attributes(words: List[str]) -> Dict[str, str]:
+    """Turn the =key=value words of a reply sentence into a dict"""
+    data = {}
+    for item in words:
+        if item.startswith("="):
+            key_value = item[1:].split("=", 1)
+            if len(key_value) == 2:
+                data[key_value[0]] = key_value[1]
+    return data
+
+def build_command_words(command: str, arguments: Optional[Dict[str, str]] = None) -> List[str]:
+    """Build a command sentence from its =key=value arguments"""
+    words = [command]
+    if arguments:
+        for key, value in arguments.items():
+            words.append(f"={key}={value}")
+    return words
+
+def build_query_words(
+    command: str,
+    where: Optional[Dict[str, Union[str, List[str]]]] = None,
+    proplist: Optional[List[str]] = None
+) -> List[str]:
+    """
+    Build a filtered print sentence, e.g.
+    build_query_words("/ip/hotspot/user/print", {"name": "AABBCC"}, [".id", "name"])
+    -> ["/ip/hotspot/user/print", "=.proplist=.id,name", "?name=AABBCC"]
+
+    RouterOS evaluates the ?key=value query words on the router and ANDs them
+    together, so only matching rows (and only the listed columns) come back.
+    A list value matches any of its entries (ORed with ?#|).
+    """
+    words = [command]
+    if proplist:
+        words.append(f"=.proplist={','.join(proplist)}")
+    if where:
+        for key, value in where.items():
+            if isinstance(value, str):
+                words.append(f"?{key}={value}")
+                continue
+            words += [f"?{key}={alternative}" for alternative in value]
+            words += ["?#|"] * (len(value) - 1)
+    return words
+
+def case_variants(value: str) -> List[str]:
+    """
+    Upper- and lower-case spellings of a name for query words. RouterOS
+    matches ?name= exactly, while names derived from MACs may have been
+    stored in either case; mixed-case spellings are not matched.
+    """
+    return list(dict.fromkeys([value.upper(), value.lower()]))
+
+def bandwidth_ip_for_mac(mac_address: str) -> str:
+    """Deterministic DHCP address used to pin a MAC to its bandwidth queue"""
+    mac_hash = int(hashlib.md5(mac_address.encode()).hexdigest()[:4], 16)
+    return f"192.168.1.{100 + (mac_hash % 150)}"
+
+DURATION_UNITS = {"w": 604800, "d": 86400, "h": 3600, "m": 60, "s": 1}
+DURATION_PATTERN = re.compile(r"((?:\d+[wdhms])*)(?:(\d+):(\d+):(\d+))?")
+
+def duration_seconds(value: Optional[str]) -> int:
+    """
+    Parse RouterOS durations such as "1d", "2w3d", "12:00:00" or
+    "4w2d12:00:00" into seconds; raises ValueError on anything else
+    """
+    if not value:
+        return 0
+    match = DURATION_PATTERN.fullmatch(value.strip())
+    if not match:
+        raise ValueError(f"Invalid RouterOS duration: {value!r}")
+    units, hours, minutes, seconds = match.groups()
+    total = sum(int(amount) * DURATION_UNITS[unit] for amount, unit in re.findall(r"(\d+)([wdhms])", units))
+    if hours is not None:
+        total += int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    return total
+
+def same_duration(current: Optional[str], wanted: Optional[str]) -> bool:
+    """True when two RouterOS durations are equal; a value that doesn't parse never matches"""
+    try:
+        return duration_seconds(current) == duration_seconds(wanted)
+    except ValueError:
+        return False
+
+def rate_bps(value: Optional[str]) -> str:
+    """Normalize an upload/download rate pair ("1M/2M" or "1000000/2000000") to bits per second"""
+    if not value:
+        return ""
+    multipliers = {"k": 1000, "K": 1000, "M": 1000000, "G": 1000000000}
+    rates = []
+    for part in value.split("/"):
+        part = part.strip()
+        if part and part[-1] in multipliers:
+            rates.append(str(int(float(part[:-1]) * multipliers[part[-1]])))
+        else:
+            rates.append(part)
+    return "/".join(rates)
+
 class MikroTikAPI:
     def __init__(self, host: str, username: str, password: str, port: int = 8728):
         self.host = host
@@ -51,19 +164,7 @@ class MikroTikAPI:
             self.connected = False
 
     def encode_length(self, length: int) -> bytes:
-        if length < 0x80:
-            return struct.pack('B', length)
-        elif length < 0x4000:
-            length |= 0x8000
-            return struct.pack('>H', length)
-        elif length < 0x200000:
-            length |= 0xC00000
-            return struct.pack('>I', length)[1:]
-        elif length < 0x10000000:
-            length |= 0xE0000000
-            return struct.pack('>I', length)
-        else:
-            return struct.pack('B', 0xF0) + struct.pack('>I', length)
+        return encode_length(length)
 
     def decode_length(self) -> int:
         c = struct.unpack('B', self.sock.recv(1))[0]
@@ -118,16 +219,23 @@ class MikroTikAPI:
             return False
 
     def send_command(self, command: str, arguments: Dict[str, str] = None) -> Dict[str, Any]:
+        return self.send_words(build_command_words(command, arguments))
+
+    def query(
+        self,
+        command: str,
+        where: Optional[Dict[str, str]] = None,
+        proplist: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        """Run a print command filtered and projected on the router side"""
+        return self.send_words(build_query_words(command, where, proplist))
+
+    def send_words(self, words: List[str]) -> Dict[str, Any]:
         if not self.connected:
             return {"error": "Not connected"}
-        
+        command = words[0]
+
         try:
-            # Prepare command
-            words = [command]
-            if arguments:
-                for key, value in arguments.items():
-                    words.append(f"={key}={value}")
-            
             # Send command
             self.send_sentence(words)
             
@@ -143,13 +251,7 @@ class MikroTikAPI:
                     break
                 elif sentence[0] == "!re":
                     # Parse response data
-                    data = {}
-                    for item in sentence[1:]:
-                        if item.startswith("="):
-                            key_value = item[1:].split("=", 1)
-                            if len(key_value) == 2:
-                                data[key_value[0]] = key_value[1]
-                    responses.append(data)
+                    responses.append(parse_attributes(sentence[1:]))
                 elif sentence[0] == "!trap":
                     error_msg = ""
                     for item in sentence[1:]:
@@ -160,6 +262,9 @@ class MikroTikAPI:
             return {"success": True, "data": responses}
         except Exception as e:
             logger.error(f"Command execution error on {self.host}: {e}")
+            if isinstance(e, (OSError, struct.error)):
+                # Socket is broken or out of sync; force a fresh login next time
+                self.connected = False
             return {"error": str(e)}
 
     def add_customer_bypass_mode(
@@ -223,8 +328,7 @@ class MikroTikAPI:
             queue_result = None
             assigned_ip = None
             if bandwidth_limit:
-                mac_hash = int(hashlib.md5(mac_address.encode()).hexdigest()[:4], 16)
-                assigned_ip = f"192.168.1.{100 + (mac_hash % 150)}"
+                assigned_ip = bandwidth_ip_for_mac(mac_address)
                 dhcp_lease_args = {
                     "mac-address": mac_address,
                     "address": assigned_ip,
@@ -280,60 +384,58 @@ class MikroTikAPI:
             results = {}
 
             # 1. Remove IP binding
-            bindings = self.send_command("/ip/hotspot/ip-binding/print")
+            bindings = self.query(
+                "/ip/hotspot/ip-binding/print",
+                where={"mac-address": normalized_mac, "type": "bypassed"},
+                proplist=[".id"]
+            )
             results["ip_binding_removed"] = False
             if bindings.get("success") and bindings.get("data"):
                 for binding in bindings["data"]:
-                    if binding.get("mac-address", "").upper() == normalized_mac.upper() and \
-                    binding.get("type", "").lower() == "bypassed":
-                        binding_id = binding.get(".id")
-                        if binding_id:
-                            self.send_command("/ip/hotspot/ip-binding/remove", {"numbers": binding_id})
-                            results["ip_binding_removed"] = True
+                    binding_id = binding.get(".id")
+                    if binding_id:
+                        self.send_command("/ip/hotspot/ip-binding/remove", {"numbers": binding_id})
+                        results["ip_binding_removed"] = True
 
             # 2. Remove Hotspot user
-            users = self.send_command("/ip/hotspot/user/print")
+            users = self.query("/ip/hotspot/user/print", where={"name": case_variants(username)}, proplist=[".id"])
             results["hotspot_user_removed"] = False
             if users.get("success") and users.get("data"):
                 for user in users["data"]:
-                    if user.get("name", "").upper() == username.upper():
-                        user_id = user.get(".id")
-                        if user_id:
-                            self.send_command("/ip/hotspot/user/remove", {"numbers": user_id})
-                            results["hotspot_user_removed"] = True
+                    user_id = user.get(".id")
+                    if user_id:
+                        self.send_command("/ip/hotspot/user/remove", {"numbers": user_id})
+                        results["hotspot_user_removed"] = True
 
             # 3. Remove simple queue
-            queues = self.send_command("/queue/simple/print")
+            queues = self.query("/queue/simple/print", where={"name": f"queue_{username}"}, proplist=[".id"])
             results["queue_removed"] = False
             if queues.get("success") and queues.get("data"):
                 for queue in queues["data"]:
-                    if queue.get("name") == f"queue_{username}":
-                        queue_id = queue.get(".id")
-                        if queue_id:
-                            self.send_command("/queue/simple/remove", {"numbers": queue_id})
-                            results["queue_removed"] = True
+                    queue_id = queue.get(".id")
+                    if queue_id:
+                        self.send_command("/queue/simple/remove", {"numbers": queue_id})
+                        results["queue_removed"] = True
 
             # 4. Remove DHCP lease
-            leases = self.send_command("/ip/dhcp-server/lease/print")
+            leases = self.query("/ip/dhcp-server/lease/print", where={"mac-address": normalized_mac}, proplist=[".id"])
             results["dhcp_lease_removed"] = False
             if leases.get("success") and leases.get("data"):
                 for lease in leases["data"]:
-                    if lease.get("mac-address", "").upper() == normalized_mac.upper():
-                        lease_id = lease.get(".id")
-                        if lease_id:
-                            self.send_command("/ip/dhcp-server/lease/remove", {"numbers": lease_id})
-                            results["dhcp_lease_removed"] = True
+                    lease_id = lease.get(".id")
+                    if lease_id:
+                        self.send_command("/ip/dhcp-server/lease/remove", {"numbers": lease_id})
+                        results["dhcp_lease_removed"] = True
 
             # 5. Disconnect active sessions
-            active_sessions = self.send_command("/ip/hotspot/active/print")
+            active_sessions = self.query("/ip/hotspot/active/print", where={"user": case_variants(username)}, proplist=[".id"])
             results["sessions_disconnected"] = 0
             if active_sessions.get("success") and active_sessions.get("data"):
                 for session in active_sessions["data"]:
-                    if session.get("user", "").upper() == username.upper():
-                        session_id = session.get(".id")
-                        if session_id:
-                            self.send_command("/ip/hotspot/active/remove", {"numbers": session_id})
-                            results["sessions_disconnected"] += 1
+                    session_id = session.get(".id")
+                    if session_id:
+                        self.send_command("/ip/hotspot/active/remove", {"numbers": session_id})
+                        results["sessions_disconnected"] += 1
 
             return {"success": True, "details": results}
         except Exception as e:
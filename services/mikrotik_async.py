@@ -0,0 +1,604 @@
+import asyncio
+import itertools
+import json
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from app.config import settings
+from app.services.mikrotik_api import (
+    bandwidth_ip_for_mac, build_command_words, build_query_words, encode_length,
+    case_variants, normalize_mac_address, parse_attributes, rate_bps, same_duration
+)
+
+logger = logging.getLogger("mikrotik_api")
+
+
+class _PendingReply:
+    """Collects the !re/!trap/!done sentences that belong to one tagged command"""
+
+    def __init__(self, command: str, future: asyncio.Future, on_row: Optional[Callable[[Dict[str, str]], None]] = None):
+        self.command = command
+        self.future = future
+        self.on_row = on_row
+        self.data: List[Dict[str, str]] = []
+        self.error: Optional[str] = None
+
+
+class AsyncMikroTikAPI:
+    """
+    asyncio implementation of the RouterOS API client.
+
+    Mirrors the MikroTikAPI surface (connect/send_command/add_customer_bypass_mode/
+    remove_bypassed_user) but never blocks the event loop: every command runs
+    under its own deadline, so one unresponsive router only delays the request
+    that is talking to it.
+
+    Every command carries a .tag and a single reader task routes replies back
+    to per-tag futures, so several commands can be in flight on one session.
+    pipeline() uses this to send a batch back-to-back and pay roughly one
+    round-trip for all of it.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        username: str,
+        password: str,
+        port: int = 8728,
+        connect_timeout: float = settings.MIKROTIK_CONNECT_TIMEOUT_SECONDS,
+        command_timeout: float = settings.MIKROTIK_COMMAND_TIMEOUT_SECONDS,
+    ):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connected = False
+        self._tags = itertools.count(1)
+        self._pending: Dict[str, _PendingReply] = {}
+        self._reader_task: Optional[asyncio.Task] = None
+        self._drain_lock = asyncio.Lock()
+
+    async def connect(self) -> bool:
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                timeout=self.connect_timeout
+            )
+            if not await self.login():
+                return False
+            self._reader_task = asyncio.create_task(self._dispatch_replies())
+            return True
+        except Exception as e:
+            logger.error(f"Connection failed to {self.host}: {e}")
+            return False
+
+    async def disconnect(self):
+        self.connected = False
+        if self._reader_task:
+            self._reader_task.cancel()
+            self._reader_task = None
+        self._fail_pending("Connection closed")
+        if self.writer:
+            try:
+                self.writer.close()
+                await asyncio.wait_for(self.writer.wait_closed(), timeout=1)
+            except Exception:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def decode_length(self) -> int:
+        c = (await self.reader.readexactly(1))[0]
+        if (c & 0x80) == 0:
+            return c
+        elif (c & 0xC0) == 0x80:
+            return ((c & ~0xC0) << 8) + (await self.reader.readexactly(1))[0]
+        elif (c & 0xE0) == 0xC0:
+            return ((c & ~0xE0) << 16) + int.from_bytes(await self.reader.readexactly(2), "big")
+        elif (c & 0xF0) == 0xE0:
+            return ((c & ~0xF0) << 24) + int.from_bytes(await self.reader.readexactly(3), "big")
+        elif (c & 0xF8) == 0xF0:
+            return int.from_bytes(await self.reader.readexactly(4), "big")
+
+    async def read_word(self) -> str:
+        length = await self.decode_length()
+        if length == 0:
+            return ""
+        return (await self.reader.readexactly(length)).decode('utf-8')
+
+    async def read_sentence(self) -> List[str]:
+        sentence = []
+        while True:
+            word = await self.read_word()
+            if word == "":
+                break
+            sentence.append(word)
+        return sentence
+
+    def _write_sentence(self, words: List[str]):
+        payload = bytearray()
+        for word in words:
+            encoded_word = word.encode('utf-8')
+            payload += encode_length(len(encoded_word)) + encoded_word
+        payload += encode_length(0)
+        self.writer.write(bytes(payload))
+
+    async def send_sentence(self, words: List[str]):
+        self._write_sentence(words)
+        async with self._drain_lock:
+            await self.writer.drain()
+
+    async def login(self) -> bool:
+        try:
+            await asyncio.wait_for(
+                self.send_sentence(["/login", f"=name={self.username}", f"=password={self.password}"]),
+                timeout=self.command_timeout
+            )
+            response = await asyncio.wait_for(self.read_sentence(), timeout=self.command_timeout)
+            if response and response[0] == "!done":
+                self.connected = True
+                logger.info(f"Successfully logged in to {self.host}")
+                return True
+            else:
+                logger.error(f"Login failed to {self.host}: {response}")
+                return False
+        except Exception as e:
+            logger.error(f"Login error to {self.host}: {e}")
+            return False
+
+    def _fail_pending(self, message: str):
+        pending, self._pending = self._pending, {}
+        for reply in pending.values():
+            if not reply.future.done():
+                reply.future.set_result({"error": message})
+
+    async def _dispatch_replies(self):
+        """Read replies for the lifetime of the session and route them by .tag"""
+        try:
+            while True:
+                sentence = await self.read_sentence()
+                if not sentence:
+                    continue
+                if sentence[0] == "!fatal":
+                    logger.error(f"Fatal reply from {self.host}: {sentence[1:]}")
+                    break
+
+                tag = next((word[5:] for word in sentence[1:] if word.startswith(".tag=")), None)
+                reply = self._pending.get(tag) if tag else None
+                if reply is None:
+                    # Untagged, or the caller already gave up on this tag
+                    continue
+
+                if sentence[0] == "!re":
+                    row = parse_attributes(sentence[1:])
+                    if reply.on_row:
+                        try:
+                            reply.on_row(row)
+                        except Exception as e:
+                            logger.error(f"Stream handler for {reply.command} on {self.host} failed: {e}")
+                    else:
+                        reply.data.append(row)
+                elif sentence[0] == "!trap":
+                    reply.error = parse_attributes(sentence[1:]).get("message") or "Command failed"
+                elif sentence[0] == "!done":
+                    del self._pending[tag]
+                    if not reply.future.done():
+                        if reply.error is not None:
+                            reply.future.set_result({"error": reply.error})
+                        else:
+                            reply.future.set_result({"success": True, "data": reply.data})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Reply reader for {self.host} stopped: {e}")
+        self.connected = False
+        self._fail_pending("Connection lost")
+
+    def _submit(self, words: List[str], on_row: Optional[Callable[[Dict[str, str]], None]] = None) -> str:
+        """Write a tagged sentence without waiting for the reply"""
+        tag = str(next(self._tags))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[tag] = _PendingReply(words[0], future, on_row)
+        self._write_sentence(words + [f".tag={tag}"])
+        return tag
+
+    async def _await_reply(self, tag: str, deadline: float) -> Dict[str, Any]:
+        reply = self._pending.get(tag)
+        if reply is None:
+            return {"error": "Connection lost"}
+        try:
+            return await asyncio.wait_for(asyncio.shield(reply.future), timeout=deadline)
+        except asyncio.TimeoutError:
+            # Abandon the tag and ask the router to stop working on it; any late
+            # reply is dropped by the dispatcher, so the session stays usable.
+            self._pending.pop(tag, None)
+            if self.connected:
+                try:
+                    self._write_sentence(["/cancel", f"=tag={tag}"])
+                except Exception:
+                    pass
+            logger.error(f"Command {reply.command} on {self.host} timed out after {deadline}s")
+            return {"error": f"Command timed out after {deadline}s"}
+
+    async def send_command(
+        self,
+        command: str,
+        arguments: Dict[str, str] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        return await self.send_words(build_command_words(command, arguments), timeout)
+
+    async def query(
+        self,
+        command: str,
+        where: Optional[Dict[str, str]] = None,
+        proplist: Optional[List[str]] = None,
+        timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """Run a print command filtered and projected on the router side"""
+        return await self.send_words(build_query_words(command, where, proplist), timeout)
+
+    async def send_words(self, words: List[str], timeout: Optional[float] = None) -> Dict[str, Any]:
+        results = await self.pipeline([words], timeout)
+        return results[0]
+
+    async def pipeline(self, sentences: List[List[str]], timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Send several command sentences back-to-back and wait for all replies.
+        Results come back in the same order as the sentences. The commands run
+        concurrently on the router, so only batch commands that do not depend
+        on each other.
+        """
+        if not sentences:
+            return []
+        if not self.connected:
+            return [{"error": "Not connected"} for _ in sentences]
+
+        deadline = timeout or self.command_timeout
+        try:
+            tags = [self._submit(words) for words in sentences]
+            async with self._drain_lock:
+                await asyncio.wait_for(self.writer.drain(), timeout=deadline)
+        except Exception as e:
+            logger.error(f"Command execution error on {self.host}: {e}")
+            self.connected = False
+            self._fail_pending(str(e) or "Connection lost")
+            return [{"error": str(e) or "Connection lost"} for _ in sentences]
+
+        return list(await asyncio.gather(*(self._await_reply(tag, deadline) for tag in tags)))
+
+    async def stream(self, words: List[str], on_row: Callable[[Dict[str, str]], None]) -> Dict[str, Any]:
+        """
+        Run a long-lived command such as "print =follow-only=" and call on_row
+        for every !re as it arrives. Returns once the router ends the command
+        or the session drops; cancelling the awaiting task sends /cancel.
+        """
+        if not self.connected:
+            return {"error": "Not connected"}
+        tag = self._submit(words, on_row)
+        reply = self._pending[tag]
+        try:
+            async with self._drain_lock:
+                await self.writer.drain()
+            return await asyncio.shield(reply.future)
+        except asyncio.CancelledError:
+            self._pending.pop(tag, None)
+            if self.connected:
+                try:
+                    self._write_sentence(["/cancel", f"=tag={tag}"])
+                except Exception:
+                    pass
+            raise
+        except Exception as e:
+            self._pending.pop(tag, None)
+            self.connected = False
+            return {"error": str(e)}
+
+    async def add_customer_bypass_mode(
+        self, mac_address: str, username: str, password: str,
+        time_limit: str, bandwidth_limit: str, comment: str,
+        router_ip: str, router_username: str, router_password: str
+    ) -> Dict[str, Any]:
+        try:
+            payload = {
+                'mac_address': mac_address,
+                'username': username,
+                'time_limit': time_limit,
+                'bandwidth_limit': bandwidth_limit,
+                'comment': comment,
+                'router_ip': router_ip,
+            }
+            logger.info(f"Sending the following payload to MikroTik: {json.dumps(payload, indent=2)}")
+
+            user_args = {
+                "name": username,
+                "password": password,
+                "profile": "default",
+                "limit-uptime": time_limit,
+                "comment": comment
+            }
+            binding_args = {
+                "mac-address": mac_address,
+                "type": "bypassed",
+                "comment": f"Auto-registered (bypassed): {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            }
+            sentences = [
+                build_command_words("/ip/hotspot/user/add", user_args),
+                build_command_words("/ip/hotspot/ip-binding/add", binding_args),
+            ]
+
+            assigned_ip = None
+            queue_args = None
+            if bandwidth_limit:
+                assigned_ip = bandwidth_ip_for_mac(mac_address)
+                dhcp_lease_args = {
+                    "mac-address": mac_address,
+                    "address": assigned_ip,
+                    "server": "defconf",
+                    "comment": f"Auto-assigned for bandwidth control: {mac_address}"
+                }
+                queue_args = {
+                    "name": f"queue_{username}",
+                    "target": f"{assigned_ip}/32",
+                    "max-limit": bandwidth_limit,
+                    "comment": f"Bandwidth limit for MAC: {mac_address} -> IP: {assigned_ip}"
+                }
+                sentences.append(build_command_words("/ip/dhcp-server/lease/add", dhcp_lease_args))
+                sentences.append(build_command_words("/queue/simple/set", queue_args))
+
+            # Round-trip 1: user, binding, lease and queue go out together
+            replies = await self.pipeline(sentences)
+            result, binding_result = replies[0], replies[1]
+            dhcp_lease_result = replies[2] if bandwidth_limit else None
+            queue_result = replies[3] if bandwidth_limit else None
+
+            # 1. Hotspot user
+            follow_ups = []
+            if "error" in result:
+                if "already have user with this name" in result["error"]:
+                    # Update limit/comment if already exists
+                    update_args = {
+                        "numbers": username,
+                        "limit-uptime": time_limit,
+                        "comment": comment
+                    }
+                    follow_ups.append(("user_set", build_command_words("/ip/hotspot/user/set", update_args)))
+                else:
+                    logger.error(f"Hotspot user add error: {result['error']}")
+                    return {"error": result["error"]}
+
+            # 2. IP binding (bypassed)
+            if "error" in binding_result:
+                if "such client already exists" in binding_result["error"]:
+                    logger.info(f"IP binding already exists for {mac_address}")
+                else:
+                    logger.error(f"IP binding error: {binding_result['error']}")
+                    return {"error": binding_result["error"]}
+
+            # 3. Bandwidth control (DHCP + queue)
+            if dhcp_lease_result and "error" in dhcp_lease_result:
+                if "already have" in dhcp_lease_result["error"]:
+                    logger.info(f"DHCP lease already exists for {mac_address}")
+                else:
+                    logger.error(f"DHCP lease error: {dhcp_lease_result['error']}")
+                    return {"error": dhcp_lease_result["error"]}
+            if queue_result and "error" in queue_result and "no such item" in queue_result["error"]:
+                follow_ups.append(("queue_add", build_command_words("/queue/simple/add", queue_args)))
+
+            # Round-trip 2 (only when something already existed or was missing)
+            if follow_ups:
+                follow_up_replies = await self.pipeline([words for _, words in follow_ups])
+                for (step, _), reply in zip(follow_ups, follow_up_replies):
+                    if step == "user_set":
+                        logger.info(f"User {username} exists. Updated: {reply}")
+                    elif step == "queue_add":
+                        queue_result = reply
+
+            return {
+                "message": f"MAC address {mac_address} registered/updated successfully with bypassed authentication",
+                "user_details": {
+                    "username": username,
+                    "mac_address": mac_address,
+                    "time_limit": time_limit,
+                    "bandwidth_limit": bandwidth_limit,
+                    "assigned_ip": assigned_ip
+                },
+                "hotspot_user_result": result,
+                "ip_binding_result": binding_result,
+                "dhcp_lease_result": dhcp_lease_result,
+                "queue_result": queue_result
+            }
+
+        except Exception as e:
+            logger.error(f"Error while adding customer in bypass mode: {e}")
+            return {"error": str(e)}
+
+    async def remove_bypassed_user(self, mac_address: str) -> dict:
+        results = await self.bulk_remove_bypassed([mac_address])
+        return results[normalize_mac_address(mac_address)]
+
+    async def bulk_remove_bypassed(self, mac_addresses: List[str], chunk_size: int = 200) -> Dict[str, dict]:
+        """
+        Tear down the binding, hotspot user, queue, DHCP lease and active
+        sessions of several MACs: one pipelined lookup round-trip and one
+        pipelined removal round-trip per chunk. Returns a result per
+        normalized MAC in the same shape as remove_bypassed_user.
+        """
+        if not self.connected:
+            return {normalize_mac_address(mac): {"error": "Not connected"} for mac in mac_addresses}
+
+        outcome = {}
+        for start in range(0, len(mac_addresses), chunk_size):
+            macs = [normalize_mac_address(mac) for mac in mac_addresses[start:start + chunk_size]]
+            try:
+                outcome.update(await self._remove_bypassed_chunk(macs))
+            except Exception as e:
+                logger.error(f"Error removing bypassed users {macs}: {e}")
+                outcome.update({mac: {"error": str(e)} for mac in macs})
+        return outcome
+
+    async def _remove_bypassed_chunk(self, macs: List[str]) -> Dict[str, dict]:
+        # (mac, result key, print command, query, remove command)
+        lookups = []
+        for normalized_mac in macs:
+            username = normalized_mac.replace(":", "")
+            lookups += [
+                (normalized_mac, "ip_binding_removed", "/ip/hotspot/ip-binding/print",
+                 {"mac-address": normalized_mac, "type": "bypassed"}, "/ip/hotspot/ip-binding/remove"),
+                (normalized_mac, "hotspot_user_removed", "/ip/hotspot/user/print",
+                 {"name": case_variants(username)}, "/ip/hotspot/user/remove"),
+                (normalized_mac, "queue_removed", "/queue/simple/print",
+                 {"name": f"queue_{username}"}, "/queue/simple/remove"),
+                (normalized_mac, "dhcp_lease_removed", "/ip/dhcp-server/lease/print",
+                 {"mac-address": normalized_mac}, "/ip/dhcp-server/lease/remove"),
+                (normalized_mac, "sessions_disconnected", "/ip/hotspot/active/print",
+                 {"user": case_variants(username)}, "/ip/hotspot/active/remove"),
+            ]
+
+        # Round-trip 1: find everything that belongs to these MACs
+        found = await self.pipeline([
+            build_query_words(print_command, where, [".id"])
+            for _, _, print_command, where, _ in lookups
+        ])
+
+        # Round-trip 2: remove it all
+        removals = []
+        for (mac, key, _, _, remove_command), rows in zip(lookups, found):
+            if rows.get("success") and rows.get("data"):
+                for row in rows["data"]:
+                    if row.get(".id"):
+                        removals.append((mac, key, build_command_words(remove_command, {"numbers": row[".id"]})))
+        removed = await self.pipeline([words for _, _, words in removals])
+
+        results = {}
+        for mac in macs:
+            results[mac] = {key: False for _, key, _, _, _ in lookups[:5]}
+            results[mac]["sessions_disconnected"] = 0
+        for (mac, key, _), reply in zip(removals, removed):
+            if "error" in reply:
+                logger.warning(f"Failed {key} for {mac}: {reply['error']}")
+                continue
+            if key == "sessions_disconnected":
+                results[mac][key] += 1
+            else:
+                results[mac][key] = True
+
+        if not self.connected:
+            return {mac: {"error": "Connection lost"} for mac in macs}
+        return {mac: {"success": True, "details": details} for mac, details in results.items()}
+
+    async def bulk_provision_bypass(
+        self, customers: List[Dict[str, Any]], dry_run: bool = False, chunk_size: int = 200
+    ) -> List[Dict[str, Any]]:
+        """
+        Provision many bypass-mode customers at once.
+
+        Each customer is a dict with mac_address, time_limit and optionally
+        bandwidth_limit and comment. The four tables involved are read once
+        (projected, pipelined), compared with what each customer needs, and only
+        the missing or changed entries are written, pipelined in chunks. Returns
+        one report per customer, in input order.
+        """
+        tables = {
+            "users": ("/ip/hotspot/user/print", [".id", "name", "limit-uptime", "disabled"], "name"),
+            "bindings": ("/ip/hotspot/ip-binding/print", [".id", "mac-address", "type"], "mac-address"),
+            "leases": ("/ip/dhcp-server/lease/print", [".id", "mac-address", "address"], "mac-address"),
+            "queues": ("/queue/simple/print", [".id", "name", "target", "max-limit"], "name"),
+        }
+        replies = await self.pipeline([
+            build_query_words(command, proplist=columns) for command, columns, _ in tables.values()
+        ])
+        state = {}
+        for (name, (_, _, key)), reply in zip(tables.items(), replies):
+            if "error" in reply:
+                return [
+                    {"mac_address": customer.get("mac_address"), "status": "failed", "changes": [],
+                     "errors": [f"Could not read {name}: {reply['error']}"]}
+                    for customer in customers
+                ]
+            state[name] = {row.get(key, "").upper(): row for row in reply.get("data", [])}
+
+        reports = []
+        writes = []  # (report index, change name, sentence)
+        for customer in customers:
+            mac_address = normalize_mac_address(customer["mac_address"])
+            username = mac_address.replace(":", "")
+            time_limit = customer["time_limit"]
+            bandwidth_limit = customer.get("bandwidth_limit")
+            comment = customer.get("comment") or f"Bulk provisioned: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            index = len(reports)
+            reports.append({"mac_address": mac_address, "username": username, "status": "unchanged", "changes": [], "errors": []})
+
+            def write(change: str, command: str, arguments: Dict[str, str]):
+                writes.append((index, change, build_command_words(command, arguments)))
+
+            user = state["users"].get(username.upper())
+            if user is None:
+                write("user_add", "/ip/hotspot/user/add", {
+                    "name": username, "password": username, "profile": "default",
+                    "limit-uptime": time_limit, "comment": comment
+                })
+            elif not same_duration(user.get("limit-uptime"), time_limit) or user.get("disabled") == "true":
+                write("user_set", "/ip/hotspot/user/set", {
+                    "numbers": user[".id"], "limit-uptime": time_limit, "disabled": "no", "comment": comment
+                })
+
+            binding = state["bindings"].get(mac_address)
+            if binding is None:
+                write("binding_add", "/ip/hotspot/ip-binding/add", {
+                    "mac-address": mac_address, "type": "bypassed",
+                    "comment": f"Auto-registered (bypassed): {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+                })
+            elif binding.get("type") != "bypassed":
+                write("binding_set", "/ip/hotspot/ip-binding/set", {"numbers": binding[".id"], "type": "bypassed"})
+
+            if bandwidth_limit:
+                lease = state["leases"].get(mac_address)
+                if lease is None:
+                    assigned_ip = bandwidth_ip_for_mac(mac_address)
+                    write("lease_add", "/ip/dhcp-server/lease/add", {
+                        "mac-address": mac_address, "address": assigned_ip, "server": "defconf",
+                        "comment": f"Auto-assigned for bandwidth control: {mac_address}"
+                    })
+                else:
+                    assigned_ip = lease.get("address")
+                reports[index]["assigned_ip"] = assigned_ip
+
+                queue = state["queues"].get(f"queue_{username}".upper())
+                target = f"{assigned_ip}/32"
+                if queue is None:
+                    write("queue_add", "/queue/simple/add", {
+                        "name": f"queue_{username}", "target": target, "max-limit": bandwidth_limit,
+                        "comment": f"Bandwidth limit for MAC: {mac_address} -> IP: {assigned_ip}"
+                    })
+                elif rate_bps(queue.get("max-limit")) != rate_bps(bandwidth_limit) or queue.get("target") != target:
+                    write("queue_set", "/queue/simple/set", {
+                        "numbers": queue[".id"], "target": target, "max-limit": bandwidth_limit
+                    })
+
+        for index, change, _ in writes:
+            reports[index]["changes"].append(change)
+        if dry_run:
+            for report in reports:
+                if report["changes"]:
+                    report["status"] = "pending"
+            return reports
+
+        for start in range(0, len(writes), chunk_size):
+            chunk = writes[start:start + chunk_size]
+            results = await self.pipeline([words for _, _, words in chunk])
+            for (index, change, _), result in zip(chunk, results):
+                if "error" in result:
+                    reports[index]["errors"].append(f"{change}: {result['error']}")
+
+        for report in reports:
+            if report["errors"]:
+                report["status"] = "failed"
+            elif report["changes"]:
+                report["status"] = "applied"
+        return reports
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from app.config import settings
+from app.services.mikrotik_async import AsyncMikroTikAPI
+
+logger = logging.getLogger(__name__)
+
+
+class RouterCredentials(NamedTuple):
+    router_id: int
+    host: str
+    username: str
+    password: str
+    port: int = 8728
+
+    @classmethod
+    def from_router(cls, router) -> "RouterCredentials":
+        """Build credentials from a Router model (or anything shaped like one)"""
+        return cls(router.id, router.ip_address, router.username, router.password, router.port or 8728)
+
+
+class RouterConnectionPool:
+    """Warm, authenticated sessions for a single router"""
+
+    def __init__(self, credentials: RouterCredentials, max_sessions: int):
+        self.credentials = credentials
+        self.semaphore = asyncio.Semaphore(max_sessions)
+        self.idle: List[Tuple[AsyncMikroTikAPI, float]] = []  # (session, last_used)
+        self.in_use = 0
+
+
+class MikroTikConnectionPool:
+    """
+    Process-wide pool of MikroTik API sessions keyed by Router.id.
+
+    Sessions stay logged in between requests, are health-checked when they
+    have been idle for a while, evicted once idle for too long and silently
+    replaced when the router drops them. Concurrency per router is capped so
+    a burst of portal logins cannot open dozens of sockets to one device.
+    """
+
+    def __init__(
+        self,
+        max_sessions_per_router: int = settings.MIKROTIK_POOL_MAX_SESSIONS_PER_ROUTER,
+        idle_timeout: int = settings.MIKROTIK_POOL_IDLE_TIMEOUT_SECONDS,
+        health_check_interval: int = settings.MIKROTIK_POOL_HEALTH_CHECK_INTERVAL_SECONDS,
+        acquire_timeout: float = settings.MIKROTIK_POOL_ACQUIRE_TIMEOUT_SECONDS,
+    ):
+        self.max_sessions_per_router = max_sessions_per_router
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._pools: Dict[int, RouterConnectionPool] = {}
+        self._checked_out: Dict[int, RouterConnectionPool] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "reconnects": 0,
+            "evictions": 0,
+            "health_check_failures": 0,
+            "connect_failures": 0,
+            "acquire_timeouts": 0,
+        }
+
+    def _router_pool(self, credentials: RouterCredentials) -> RouterConnectionPool:
+        pool = self._pools.get(credentials.router_id)
+        if pool is None or pool.credentials != credentials:
+            if pool is not None:
+                # Router was edited (IP, port or login changed); drop the stale sessions
+                logger.info(f"Credentials changed for router {credentials.router_id}, resetting its pool")
+                self._spawn(self._close_idle(pool))
+            pool = RouterConnectionPool(credentials, self.max_sessions_per_router)
+            self._pools[credentials.router_id] = pool
+        return pool
+
+    def _spawn(self, coro):
+        # Keep a reference so the task isn't garbage-collected mid-run and its errors get logged
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"MikroTik pool cleanup error: {task.exception()}")
+
+    async def _close_idle(self, pool: RouterConnectionPool):
+        idle, pool.idle = pool.idle, []
+        for api, _ in idle:
+            await api.disconnect()
+
+    async def _is_healthy(self, api: AsyncMikroTikAPI, last_used: float) -> bool:
+        if not api.connected:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        result = await api.send_command("/system/identity/print")
+        return "error" not in result
+
+    async def acquire(self, router) -> Optional[AsyncMikroTikAPI]:
+        """
+        Check out a logged-in session for the router.
+        Returns None if the router cannot be reached or the pool is saturated.
+        """
+        credentials = router if isinstance(router, RouterCredentials) else RouterCredentials.from_router(router)
+        pool = self._router_pool(credentials)
+
+        try:
+            await asyncio.wait_for(pool.semaphore.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.counters["acquire_timeouts"] += 1
+            logger.error(f"Timed out waiting for a free session on router {credentials.router_id}")
+            return None
+
+        # Until a session is handed out, any failure or cancellation must
+        # give the slot back or the router's capacity shrinks for good
+        api = None
+        try:
+            reconnecting = False
+            while pool.idle:
+                api, last_used = pool.idle.pop()
+                if await self._is_healthy(api, last_used):
+                    self.counters["hits"] += 1
+                    pool.in_use += 1
+                    self._checked_out[id(api)] = pool
+                    return api
+                self.counters["health_check_failures"] += 1
+                candidate, api = api, None
+                await candidate.disconnect()
+                reconnecting = True
+
+            self.counters["misses"] += 1
+            if reconnecting:
+                self.counters["reconnects"] += 1
+            api = AsyncMikroTikAPI(credentials.host, credentials.username, credentials.password, credentials.port)
+            if not await api.connect():
+                self.counters["connect_failures"] += 1
+                candidate, api = api, None
+                await candidate.disconnect()
+                pool.semaphore.release()
+                return None
+        except BaseException:
+            pool.semaphore.release()
+            if api is not None:
+                self._spawn(api.disconnect())
+            raise
+
+        pool.in_use += 1
+        self._checked_out[id(api)] = pool
+        return api
+
+    async def release(self, api: AsyncMikroTikAPI):
+        """Return a session to its router pool, discarding it if it went bad"""
+        pool = self._checked_out.pop(id(api), None)
+        if pool is None:
+            await api.disconnect()
+            return
+        pool.in_use -= 1
+        if api.connected and self._pools.get(pool.credentials.router_id) is pool:
+            pool.idle.append((api, time.monotonic()))
+        else:
+            await api.disconnect()
+        pool.semaphore.release()
+
+    @asynccontextmanager
+    async def session(self, router):
+        """Context-manager form of acquire/release; yields None when the router is unreachable"""
+        api = await self.acquire(router)
+        try:
+            yield api
+        finally:
+            if api is not None:
+                await self.release(api)
+
+    async def evict_idle(self) -> int:
+        """Close sessions that have sat idle longer than the idle timeout"""
+        now = time.monotonic()
+        evicted = 0
+        for pool in list(self._pools.values()):
+            stale = [(api, last_used) for api, last_used in pool.idle if now - last_used > self.idle_timeout]
+            if not stale:
+                continue
+            pool.idle = [entry for entry in pool.idle if entry not in stale]
+            for api, _ in stale:
+                await api.disconnect()
+                evicted += 1
+        self.counters["evictions"] += evicted
+        return evicted
+
+    async def run_reaper(self):
+        """Background task that periodically evicts idle sessions"""
+        interval = max(1, min(self.idle_timeout // 2, 30))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                evicted = await self.evict_idle()
+                if evicted:
+                    logger.info(f"Evicted {evicted} idle MikroTik session(s)")
+            except Exception as e:
+                logger.error(f"MikroTik pool reaper error: {e}")
+
+    async def close(self):
+        pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            await self._close_idle(pool)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hit_ratio": round(self.counters["hits"] / lookups, 4) if lookups else 0.0,
+            "routers": {
+                router_id: {"idle": len(pool.idle), "in_use": pool.in_use}
+                for router_id, pool in self._pools.items()
+            },
+        }
+
+
+mikrotik_pool = MikroTikConnectionPool()
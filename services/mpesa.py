@@ -1,11 +1,15 @@
+import asyncio
 import base64
+import time
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Tuple
 import logging
 
 import httpx
 from fastapi import HTTPException
 
+from app.config import settings
+
 logger = logging.getLogger(__name__)
 
 # --- CONFIGURATION ---
@@ -14,30 +18,128 @@ MPESA_PASSKEY = "bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c91
 MPESA_CALLBACK_URL = "https://your-ngrok-subdomain.ngrok.io/api/mpesa/callback"
 BASE64_ENCODED_CREDENTIALS = "dko5RmppdVBPZUFDaE5sRkdBN2c5a1lzeXZ2SVZOSk9RamliZTNaTEhnM1c0R1JUOk1CVGNWZFQ4TnRoRExwM1BjMjhScFlaR0prR2NKOXg0c3Bob3k1aGZDQkpEa0hubm1NQVFqRUlZbGJVdDhzb24="
 
+# --- Shared HTTP client ---
+_http_client: Optional[httpx.AsyncClient] = None
+
+def _http2_available() -> bool:
+    if not settings.MPESA_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401  (httpx[http2] extra)
+        return True
+    except ImportError:
+        logger.warning("MPESA_HTTP2 is enabled but the h2 package is not installed; using HTTP/1.1")
+        return False
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Process-wide client for Daraja and the payment microservice. Reusing it
+    keeps TLS connections alive between payments instead of handshaking per
+    call. Opened on startup; created lazily if used outside the app.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=_http2_available(),
+            timeout=settings.MPESA_HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=settings.MPESA_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.MPESA_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=settings.MPESA_HTTP_KEEPALIVE_EXPIRY_SECONDS
+            )
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 # --- Direct M-Pesa logic (for legacy/backup use) ---
 class StkPushResponse:
     def __init__(self, checkout_request_id: str, merchant_request_id: str):
         self.checkout_request_id = checkout_request_id
         self.merchant_request_id = merchant_request_id
 
+async def _fetch_access_token() -> Tuple[str, int]:
+    response = await get_http_client().get(
+        f"{settings.MPESA_DARAJA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
+        headers={"Authorization": f"Basic {BASE64_ENCODED_CREDENTIALS}"}
+    )
+    response.raise_for_status()
+    data = response.json()
+    return data["access_token"], int(data.get("expires_in", 3599))
+
+class DarajaTokenCache:
+    """
+    Holds the Daraja OAuth token (valid for about an hour) and fetches a new
+    one refresh_margin seconds before it expires. Fetches are single-flight:
+    concurrent callers wait on one request, and while a refresh is in
+    progress callers keep using the still-valid current token.
+    """
+
+    def __init__(self, refresh_margin: int = settings.MPESA_TOKEN_REFRESH_MARGIN_SECONDS):
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+        self.counters = {"hits": 0, "fetches": 0, "fetch_errors": 0}
+
+    def _fresh(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_margin
+
+    async def get(self) -> str:
+        if self._fresh():
+            self.counters["hits"] += 1
+            return self._token
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        if self._lock.locked() and self._token is not None and time.monotonic() < self._expires_at:
+            self.counters["hits"] += 1
+            return self._token
+
+        async with self._lock:
+            if self._fresh():
+                self.counters["hits"] += 1
+                return self._token
+            try:
+                token, expires_in = await _fetch_access_token()
+            except Exception:
+                self.counters["fetch_errors"] += 1
+                raise
+            self.counters["fetches"] += 1
+            self._token = token
+            self._expires_at = time.monotonic() + expires_in
+            return token
+
+    def invalidate(self):
+        self._token = None
+        self._expires_at = 0.0
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "seconds_to_expiry": max(int(self._expires_at - time.monotonic()), 0) if self._token else 0,
+        }
+
+daraja_token = DarajaTokenCache()
+
 async def get_access_token() -> str:
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials",
-                headers={"Authorization": f"Basic {BASE64_ENCODED_CREDENTIALS}"}
-            )
-            response.raise_for_status()
-            return response.json()["access_token"]
+        return await daraja_token.get()
     except Exception as e:
         logger.error(f"Failed to get M-Pesa access token: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get M-Pesa access token: {str(e)}")
 
+def _stk_password() -> Tuple[str, str]:
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    password = base64.b64encode(f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}".encode()).decode()
+    return timestamp, password
+
 async def initiate_stk_push_direct(phone_number: str, amount: float, reference: str) -> Optional[StkPushResponse]:
     try:
-        access_token = await get_access_token()
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        password = base64.b64encode(f"{MPESA_SHORTCODE}{MPESA_PASSKEY}{timestamp}".encode()).decode()
+        timestamp, password = _stk_password()
         
         payload = {
             "BusinessShortCode": MPESA_SHORTCODE,
@@ -53,26 +155,70 @@ async def initiate_stk_push_direct(phone_number: str, amount: float, reference:
             "TransactionDesc": "Payment via STK Push"
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest",
+        for attempt in range(2):
+            access_token = await get_access_token()
+            response = await get_http_client().post(
+                f"{settings.MPESA_DARAJA_BASE_URL}/mpesa/stkpush/v1/processrequest",
                 json=payload,
                 headers={
                     "Authorization": f"Bearer {access_token}",
                     "Content-Type": "application/json"
                 }
             )
-            response.raise_for_status()
-            result = response.json()
-            logger.info(f"STK Push initiated: {result}")
-            return StkPushResponse(
-                checkout_request_id=result["CheckoutRequestID"],
-                merchant_request_id=result["MerchantRequestID"]
-            )
+            if response.status_code == 401 and attempt == 0:
+                # Token revoked before its expiry; fetch a new one and retry once
+                daraja_token.invalidate()
+                continue
+            break
+        response.raise_for_status()
+        result = response.json()
+        logger.info(f"STK Push initiated: {result}")
+        return StkPushResponse(
+            checkout_request_id=result["CheckoutRequestID"],
+            merchant_request_id=result["MerchantRequestID"]
+        )
     except Exception as e:
         logger.error(f"STK Push initiation failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"STK Push initiation failed: {str(e)}")
 
+# Daraja answers a status query for an STK push that is still waiting on the
+# customer with HTTP 500 and this error code
+STK_QUERY_PROCESSING = "500.001.1001"
+
+async def query_stk_push_status_direct(checkout_request_id: str) -> Optional[Tuple[str, str]]:
+    """
+    Ask Daraja for the outcome of an STK push it issued. Returns (ResultCode,
+    ResultDesc) once it is final ("0" means paid) or None while the customer
+    has not responded yet. Other errors raise.
+    """
+    timestamp, password = _stk_password()
+    payload = {
+        "BusinessShortCode": MPESA_SHORTCODE,
+        "Password": password,
+        "Timestamp": timestamp,
+        "CheckoutRequestID": checkout_request_id
+    }
+    for attempt in range(2):
+        access_token = await get_access_token()
+        response = await get_http_client().post(
+            f"{settings.MPESA_DARAJA_BASE_URL}/mpesa/stkpushquery/v1/query",
+            json=payload,
+            headers={"Authorization": f"Bearer {access_token}"}
+        )
+        if response.status_code == 401 and attempt == 0:
+            daraja_token.invalidate()
+            continue
+        break
+
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    if data.get("errorCode") == STK_QUERY_PROCESSING:
+        return None
+    response.raise_for_status()
+    return str(data["ResultCode"]), data.get("ResultDesc", "")
+
 # --- GraphQL Microservice Logic ---
 async def initiate_stk_push_via_graphql_microservice(
     merchant_id: int,
@@ -80,7 +226,7 @@ async def initiate_stk_push_via_graphql_microservice(
     phone_number: str,
     lipay_tx_no: str,
     customer_ref: str,
-    graphql_url: str = "https://finance.lipay.store/graphql"
+    graphql_url: Optional[str] = None
 ) -> dict:
     """
     Calls the initiateOpenPayment GraphQL mutation on the payment microservice.
@@ -111,20 +257,49 @@ async def initiate_stk_push_via_graphql_microservice(
         "customerRef": customer_ref
     }
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            graphql_url,
-            json={"query": mutation, "variables": variables},
-            timeout=20
-        )
-        response.raise_for_status()
-        data = response.json()
-        if "errors" in data:
-            raise Exception(f"GraphQL Error: {data['errors']}")
-        result = data["data"]["initiateOpenPayment"]
-        if result.get("errorMessage"):
-            raise Exception(f"Payment microservice error: {result['errorMessage']}")
-        return result
+    response = await get_http_client().post(
+        graphql_url or settings.LIPAY_GRAPHQL_URL,
+        json={"query": mutation, "variables": variables},
+        timeout=20
+    )
+    response.raise_for_status()
+    data = response.json()
+    if "errors" in data:
+        raise Exception(f"GraphQL Error: {data['errors']}")
+    result = data["data"]["initiateOpenPayment"]
+    if result.get("errorMessage"):
+        raise Exception(f"Payment microservice error: {result['errorMessage']}")
+    return result
+
+async def query_stk_push_status_via_graphql_microservice(
+    checkout_request_id: str,
+    graphql_url: Optional[str] = None
+) -> Optional[Tuple[str, str]]:
+    """
+    Ask the payment microservice for the outcome of an STK push it issued.
+    Same contract as query_stk_push_status_direct: (ResultCode, ResultDesc)
+    once final, None while the customer has not responded yet.
+    """
+    query = """
+    query paymentStatus($checkoutRequestId: String!) {
+      paymentStatus(checkoutRequestId: $checkoutRequestId) {
+        resultCode
+        resultDesc
+      }
+    }
+    """
+    response = await get_http_client().post(
+        graphql_url or settings.LIPAY_GRAPHQL_URL,
+        json={"query": query, "variables": {"checkoutRequestId": checkout_request_id}}
+    )
+    response.raise_for_status()
+    data = response.json()
+    if "errors" in data:
+        raise Exception(f"GraphQL Error: {data['errors']}")
+    result = data["data"]["paymentStatus"] or {}
+    if result.get("resultCode") is None:
+        return None
+    return str(result["resultCode"]), result.get("resultDesc") or ""
 
 # --- Unified Payment Initiator ---
 async def initiate_stk_push(
@@ -155,3 +330,11 @@ async def initiate_stk_push(
             amount=amount,
             reference=reference
         )
+
+async def query_stk_push_status(checkout_request_id: str, use_microservice: bool = True) -> Optional[Tuple[str, str]]:
+    """
+    Outcome of an STK push, asked of the service that issued its checkout id.
+    """
+    if use_microservice:
+        return await query_stk_push_status_via_graphql_microservice(checkout_request_id)
+    return await query_stk_push_status_direct(checkout_request_id)
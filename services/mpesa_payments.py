@@ -0,0 +1,165 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import Customer, CustomerStatus, MpesaTransactionStatus, PaymentMethod, Plan, Router
+from app.services.mpesa_transactions import update_mpesa_transaction_status
+from app.services.provisioning_queue import provisioning_queue
+from app.services.reseller_payments import record_customer_payment
+
+logger = logging.getLogger(__name__)
+
+
+async def apply_completed_payment(
+    db: AsyncSession,
+    customer: Customer,
+    amount,
+    tx_no: Optional[str] = None,
+    checkout_request_id: Optional[str] = None,
+    receipt_number: Optional[str] = None,
+    source: str = "callback"
+) -> dict:
+    """
+    Credit a confirmed M-Pesa payment: record it, apply any pending plan
+    change, extend the expiry, mark the transaction COMPLETED and queue
+    MikroTik provisioning. customer must have plan and router loaded.
+
+    Nothing is committed here. Returns a callback-style response; on
+    ResultCode 1 nothing has been written and the caller should give up
+    its idempotency claim, on 0 it commits and notifies provisioning_queue.
+    Used by the payment callback and by the reconciler for payments whose
+    callback never arrived.
+    """
+    # Validate everything before writing anything: a rejected payment releases
+    # its idempotency claim, so it must leave nothing behind
+    pending_update_data = customer.pending_update_data
+    now = datetime.utcnow()
+    plan = customer.plan
+    router = customer.router
+
+    if pending_update_data:
+        # Handle existing customer with pending update data
+        if isinstance(pending_update_data, str):
+            try:
+                pending_update_data = json.loads(pending_update_data)
+                logger.info(f"Parsed pending_update_data for customer {customer.id}: {json.dumps(pending_update_data)}")
+            except json.JSONDecodeError as e:
+                logger.error(f"Invalid JSON in pending_update_data for customer {customer.id}: {e}")
+                return {"ResultCode": 1, "ResultDesc": "Invalid pending update data format"}
+
+        duration_value = pending_update_data.get("duration_value")
+        duration_unit = pending_update_data.get("duration_unit")
+        applied_plan_id = pending_update_data.get("plan_id")
+        requested_router_id = pending_update_data.get("router_id")
+
+        if duration_value is None or duration_unit is None or requested_router_id is None:
+            logger.error(f"Missing duration_value, duration_unit, or router_id in pending_update_data for customer {customer.id}")
+            return {"ResultCode": 1, "ResultDesc": "Missing required fields in pending update data"}
+
+        # Fetch the plan and router from pending_update_data
+        plan_stmt = select(Plan).where(Plan.id == applied_plan_id)
+        plan_result = await db.execute(plan_stmt)
+        plan = plan_result.scalar_one_or_none()
+
+        router_stmt = select(Router).where(Router.id == requested_router_id)
+        router_result = await db.execute(router_stmt)
+        router = router_result.scalar_one_or_none()
+
+        if not plan or not router:
+            logger.error(f"Plan {applied_plan_id} or Router {requested_router_id} not found")
+            return {"ResultCode": 1, "ResultDesc": "Plan or Router not found"}
+    else:
+        # Handle new customer (no pending_update_data)
+        if not plan or not router:
+            logger.error(f"Customer {customer.id} missing plan or router configuration")
+            return {"ResultCode": 1, "ResultDesc": "Customer missing plan or router configuration"}
+
+        duration_value = plan.duration_value
+        duration_unit = plan.duration_unit.value
+
+    # Convert duration to time limit for MikroTik
+    if duration_unit.upper() == "DAYS":
+        time_limit = f"{int(duration_value)}d"
+        duration = timedelta(days=int(duration_value))
+        days_paid_for = int(duration_value)
+    elif duration_unit.upper() == "HOURS":
+        time_limit = f"{int(duration_value)}h"
+        duration = timedelta(hours=int(duration_value))
+        days_paid_for = max(1, int(duration_value) // 24)  # Convert hours to days, minimum 1 day
+    else:
+        logger.error(f"Unsupported duration_unit {duration_unit} for customer {customer.id}")
+        return {"ResultCode": 1, "ResultDesc": f"Unsupported duration unit: {duration_unit}"}
+
+    # Calculate new expiry from the expiry as it stands before this payment;
+    # record_customer_payment extends it too, and that is overwritten below
+    if pending_update_data and customer.expiry and customer.expiry > now:
+        new_expiry = customer.expiry + duration
+    else:
+        new_expiry = now + duration
+
+    # Payment, transaction status and activation are only flushed; the caller
+    # commits them together, so a failure at any step leaves no payment behind
+    if customer.user_id is not None:
+        payment = await record_customer_payment(
+            db=db,
+            customer_id=customer.id,
+            reseller_id=customer.user_id,  # Router owner/reseller
+            amount=float(amount),
+            payment_method=PaymentMethod.MOBILE_MONEY,
+            days_paid_for=days_paid_for,
+            payment_reference=receipt_number or tx_no,
+            notes=f"M-Pesa payment via {source}. TX: {tx_no}",
+            commit=False,
+            plan_id=plan.id  # The plan paid for, not the one being replaced
+        )
+        logger.info(f"[AUDIT] CustomerPayment record created: ID {payment.id}, Amount: {amount}, Days: {days_paid_for}")
+    else:
+        logger.warning(f"Customer {customer.id} has no reseller; no CustomerPayment recorded")
+
+    if checkout_request_id:
+        try:
+            # A savepoint, so a failed update does not undo the payment
+            async with db.begin_nested():
+                await update_mpesa_transaction_status(
+                    db=db,
+                    checkout_request_id=checkout_request_id,
+                    status=MpesaTransactionStatus.COMPLETED,
+                    receipt_number=receipt_number,
+                    result_code="0",
+                    result_desc="Payment completed successfully",
+                    commit=False
+                )
+            logger.info(f"[AUDIT] MpesaTransaction updated: {checkout_request_id}")
+        except Exception as mpesa_error:
+            logger.error(f"Failed to update MpesaTransaction {checkout_request_id}: {mpesa_error}")
+
+    # Update customer
+    customer.expiry = new_expiry
+    customer.status = CustomerStatus.ACTIVE
+    if pending_update_data:
+        customer.plan_id = applied_plan_id
+        customer.router_id = requested_router_id
+        customer.pending_update_data = None  # Clear pending data
+        logger.info(f"[AUDIT] Applied pending_update_data for customer {customer.id}")
+    else:
+        logger.info(f"[AUDIT] New customer {customer.id} payment processed")
+
+    # Queue MikroTik provisioning in the same transaction as the activation,
+    # so a worker restart or router outage cannot lose it
+    if router and plan:
+        provisioning_queue.enqueue(db, customer.id, router.id, {
+            "mac_address": customer.mac_address,
+            "time_limit": time_limit,
+            "bandwidth_limit": f"{plan.speed}",
+            "comment": f"Payment successful for {customer.name} on {datetime.utcnow().isoformat()}",
+        })
+        logger.info(f"Queued MikroTik provisioning for customer {customer.id}")
+
+    return {
+        "ResultCode": 0,
+        "ResultDesc": f"Customer {customer.id} updated to ACTIVE, payment recorded, and MikroTik provisioning queued. New expiry: {customer.expiry}"
+    }
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from app.config import settings
+from app.db.database import async_session
+from app.db.models import Customer, MpesaTransaction, MpesaTransactionStatus
+from app.services.callback_idempotency import (
+    callback_idempotency_key, claim_callback, prune_processed_callbacks, recent_callbacks
+)
+from app.services.mpesa import query_stk_push_status
+from app.services.mpesa_payments import apply_completed_payment
+from app.services.mpesa_transactions import (
+    MpesaStatusUpdate, bulk_update_mpesa_transaction_status, get_pending_mpesa_transactions
+)
+from app.services.provisioning_queue import provisioning_queue
+
+logger = logging.getLogger(__name__)
+
+EXPIRED_RESULT = ("TIMEOUT", "Transaction expired due to timeout")
+
+
+class MpesaReconciler:
+    """
+    Settles mpesa_transactions rows whose callback never arrived.
+
+    Pending rows older than MPESA_RECONCILE_MIN_AGE_SECONDS (so the callback
+    has had its chance) are walked oldest first in batches through the
+    (status, created_at) index. Each one is checked with a status query to
+    the service that issued its checkout id (the payment microservice when
+    the row has a lipay_tx_no, Daraja otherwise), at most
+    MPESA_RECONCILE_CONCURRENCY at a time. Failed and expired outcomes are
+    written with a single UPDATE ... FROM (VALUES ...); a row that is still
+    unresolved after MPESA_RECONCILE_EXPIRE_AFTER_SECONDS is marked EXPIRED.
+    The UPDATE only touches rows that are still PENDING, so a callback that
+    lands at the same time wins.
+
+    A confirmed payment goes through the callback's own path: it is claimed
+    under the key the callback would use and credited (payment, expiry,
+    provisioning) in the same transaction that marks it COMPLETED. One that
+    cannot be credited yet stays pending and is retried each pass until it
+    is old enough to expire, when it is marked COMPLETED and logged for
+    follow-up.
+
+    Every CALLBACK_PRUNE_INTERVAL_SECONDS the loop also deletes
+    processed_callbacks claims older than CALLBACK_RETENTION_DAYS.
+    """
+
+    def __init__(
+        self,
+        interval: int = settings.MPESA_RECONCILE_INTERVAL_SECONDS,
+        min_age: int = settings.MPESA_RECONCILE_MIN_AGE_SECONDS,
+        expire_after: int = settings.MPESA_RECONCILE_EXPIRE_AFTER_SECONDS,
+        batch_size: int = settings.MPESA_RECONCILE_BATCH_SIZE,
+        concurrency: int = settings.MPESA_RECONCILE_CONCURRENCY,
+        prune_interval: int = settings.CALLBACK_PRUNE_INTERVAL_SECONDS,
+    ):
+        self.interval = interval
+        self.min_age = min_age
+        self.expire_after = expire_after
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+        self.counters = {
+            "checked": 0,
+            "completed": 0,
+            "credited": 0,
+            "uncredited": 0,
+            "failed": 0,
+            "expired": 0,
+            "still_pending": 0,
+            "query_errors": 0,
+            "passes": 0,
+            "callbacks_pruned": 0,
+        }
+
+    async def _query(self, semaphore: asyncio.Semaphore, transaction: MpesaTransaction) -> Optional[Tuple[str, str]]:
+        async with semaphore:
+            try:
+                return await query_stk_push_status(
+                    transaction.checkout_request_id, use_microservice=bool(transaction.lipay_tx_no)
+                )
+            except Exception as e:
+                self.counters["query_errors"] += 1
+                logger.warning(f"STK status query failed for {transaction.checkout_request_id}: {e}")
+                return None
+
+    def _outcome(self, transaction: MpesaTransaction, result: Optional[Tuple[str, str]], now: datetime):
+        """(status, result_code, result_desc) to apply, or None to leave it pending"""
+        if result is not None:
+            code, desc = result
+            if code == "0":
+                return MpesaTransactionStatus.COMPLETED, code, desc[:255]
+            return MpesaTransactionStatus.FAILED, code[:20], desc[:255]
+        if transaction.created_at and transaction.created_at < now - timedelta(seconds=self.expire_after):
+            return (MpesaTransactionStatus.EXPIRED, *EXPIRED_RESULT)
+        return None
+
+    async def _settle_status(self, db, transaction: MpesaTransaction, code: str, desc: str) -> bool:
+        update = MpesaStatusUpdate(transaction.checkout_request_id, MpesaTransactionStatus.COMPLETED, None, code, desc)
+        if await bulk_update_mpesa_transaction_status(db, [update], only_pending=True):
+            self.counters["completed"] += 1
+            return True
+        return False
+
+    async def _credit(self, transaction: MpesaTransaction, code: str, desc: str, now: datetime):
+        """Apply a payment the status query confirmed, exactly once"""
+        payload = {
+            "lipay_tx_no": transaction.lipay_tx_no,
+            "checkout_request_id": transaction.checkout_request_id,
+            "status": "completed",
+        }
+        key = callback_idempotency_key(payload)
+        async with async_session() as db:
+            # Blocks behind a callback that is settling the same row
+            current = await db.scalar(
+                select(MpesaTransaction.status)
+                .where(MpesaTransaction.id == transaction.id)
+                .with_for_update()
+            )
+            if current != MpesaTransactionStatus.PENDING:
+                return
+            customer = None
+            if transaction.customer_id:
+                customer = await db.scalar(
+                    select(Customer)
+                    .options(selectinload(Customer.plan), selectinload(Customer.router))
+                    .where(Customer.id == transaction.customer_id)
+                )
+            claim = {**payload, "customer_ref": customer.mac_address if customer else None}
+            if key in recent_callbacks or not await claim_callback(db, key, claim):
+                # The callback already applied it; only the status is left
+                await self._settle_status(db, transaction, code, desc)
+                return
+
+            if customer is None:
+                response = {"ResultCode": 1, "ResultDesc": "Transaction is not linked to a customer"}
+            else:
+                response = await apply_completed_payment(
+                    db, customer, transaction.amount, tx_no=transaction.lipay_tx_no,
+                    checkout_request_id=transaction.checkout_request_id, source="reconciliation"
+                )
+            if response["ResultCode"] == 0:
+                await db.commit()
+                recent_callbacks.set(key, True)
+                provisioning_queue.notify()
+                self.counters["completed"] += 1
+                self.counters["credited"] += 1
+                logger.info(f"[AUDIT] M-Pesa payment {transaction.checkout_request_id} confirmed without a callback and credited")
+                return
+            # Drops the claim with everything else
+            await db.rollback()
+
+            if transaction.created_at and transaction.created_at < now - timedelta(seconds=self.expire_after):
+                if await self._settle_status(db, transaction, code, desc):
+                    self.counters["uncredited"] += 1
+                    logger.warning(
+                        f"[AUDIT] M-Pesa payment {transaction.checkout_request_id} confirmed but not credited: "
+                        f"{response['ResultDesc']}; needs follow-up"
+                    )
+                return
+        self.counters["still_pending"] += 1
+        logger.warning(f"Confirmed M-Pesa payment {transaction.checkout_request_id} not credited yet: {response['ResultDesc']}")
+
+    async def _reconcile_batch(self, transactions: List[MpesaTransaction]):
+        now = datetime.utcnow()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._query(semaphore, transaction) for transaction in transactions))
+        self.counters["checked"] += len(transactions)
+
+        updates = []
+        confirmed = []
+        for transaction, result in zip(transactions, results):
+            outcome = self._outcome(transaction, result, now)
+            if outcome is None:
+                self.counters["still_pending"] += 1
+            elif outcome[0] == MpesaTransactionStatus.COMPLETED:
+                confirmed.append((transaction, outcome))
+            else:
+                status, code, desc = outcome
+                updates.append(MpesaStatusUpdate(transaction.checkout_request_id, status, None, code, desc))
+
+        if updates:
+            async with async_session() as db:
+                updated = set(await bulk_update_mpesa_transaction_status(db, updates, only_pending=True))
+            for update in updates:
+                if update.checkout_request_id in updated:
+                    self.counters[update.status.value] += 1
+
+        # One transaction each, so one customer's bad data can't hold up the rest
+        for transaction, (_, code, desc) in confirmed:
+            try:
+                await self._credit(transaction, code, desc, now)
+            except Exception as e:
+                logger.error(f"Failed to credit confirmed M-Pesa payment {transaction.checkout_request_id}: {e}")
+
+    async def run_once(self) -> int:
+        """Check every pending transaction that is due; returns how many were checked"""
+        created_before = datetime.utcnow() - timedelta(seconds=self.min_age)
+        after = None
+        checked = 0
+        while True:
+            async with async_session() as db:
+                batch = await get_pending_mpesa_transactions(
+                    db, created_before=created_before, after=after, limit=self.batch_size
+                )
+            if not batch:
+                return checked
+            await self._reconcile_batch(batch)
+            checked += len(batch)
+            after = (batch[-1].created_at, batch[-1].id)
+            if len(batch) < self.batch_size:
+                return checked
+
+    async def prune_callbacks(self) -> int:
+        """Drop expired callback claims, at most once per prune_interval"""
+        now = time.monotonic()
+        if self._last_prune and now - self._last_prune < self.prune_interval:
+            return 0
+        self._last_prune = now
+        async with async_session() as db:
+            pruned = await prune_processed_callbacks(db)
+        self.counters["callbacks_pruned"] += pruned
+        return pruned
+
+    async def run(self):
+        """Background task that reconciles pending transactions"""
+        while True:
+            try:
+                self.counters["passes"] += 1
+                checked = await self.run_once()
+                if checked:
+                    logger.info(f"Reconciled {checked} pending M-Pesa transaction(s)")
+            except Exception as e:
+                logger.error(f"M-Pesa reconciliation error: {e}")
+            try:
+                pruned = await self.prune_callbacks()
+                if pruned:
+                    logger.info(f"Pruned {pruned} processed callback record(s)")
+            except Exception as e:
+                logger.error(f"Processed callback pruning error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return dict(self.counters)
+
+
+mpesa_reconciler = MpesaReconciler()
@@ -1,6 +1,6 @@
-from typing import Optional, List
+from typing import Optional, List, NamedTuple, Sequence, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
+from sqlalchemy import Integer, String, case, cast, column, func, select, tuple_, update, values
 from sqlalchemy.exc import IntegrityError
 from app.db.models import MpesaTransaction, MpesaTransactionStatus
 from datetime import datetime
@@ -8,16 +8,27 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+class MpesaStatusUpdate(NamedTuple):
+    checkout_request_id: str
+    status: MpesaTransactionStatus
+    receipt_number: Optional[str] = None
+    result_code: Optional[str] = None
+    result_desc: Optional[str] = None
+
 async def save_mpesa_transaction(
     db: AsyncSession, 
     checkout_request_id: str, 
     phone_number: str, 
     amount: float, 
     reference: str,
-    merchant_request_id: str = None
+    merchant_request_id: str = None,
+    customer_id: int = None,
+    lipay_tx_no: str = None
 ) -> MpesaTransaction:
     """
-    Save a new M-Pesa transaction to the database.
+    Save a new M-Pesa transaction to the database, already linked to the
+    customer when customer_id is given. lipay_tx_no is set for pushes issued
+    through the payment microservice.
     """
     try:
         transaction = MpesaTransaction(
@@ -26,6 +37,8 @@ async def save_mpesa_transaction(
             amount=amount,
             reference=reference,
             merchant_request_id=merchant_request_id,
+            customer_id=customer_id,
+            lipay_tx_no=lipay_tx_no,
             status=MpesaTransactionStatus.PENDING,  # Use uppercase enum
             created_at=datetime.utcnow(),
             updated_at=datetime.utcnow()
@@ -65,7 +78,8 @@ async def update_mpesa_transaction_status(
     status: MpesaTransactionStatus, 
     receipt_number: str = None,
     result_code: str = None,
-    result_desc: str = None
+    result_desc: str = None,
+    commit: bool = True
 ) -> bool:
     """
     Update the status of an M-Pesa transaction.
@@ -77,6 +91,7 @@ async def update_mpesa_transaction_status(
         receipt_number: M-Pesa receipt number (for successful transactions)
         result_code: Result code from M-Pesa callback
         result_desc: Result description from M-Pesa callback
+        commit: Commit here; with False the update joins the caller's transaction
     """
     try:
         values = {
@@ -99,7 +114,8 @@ async def update_mpesa_transaction_status(
         ).values(**values)
         
         result = await db.execute(stmt)
-        await db.commit()
+        if commit:
+            await db.commit()
         
         if result.rowcount == 0:
             logger.warning(f"No transaction found with checkout_request_id {checkout_request_id}")
@@ -108,24 +124,137 @@ async def update_mpesa_transaction_status(
         logger.info(f"Updated M-Pesa transaction status: {checkout_request_id} to {status.value}")
         return True
     except Exception as e:
-        await db.rollback()
+        if commit:
+            await db.rollback()
         logger.error(f"Error updating M-Pesa transaction status {checkout_request_id}: {str(e)}")
         raise
 
 async def get_pending_mpesa_transactions(
-    db: AsyncSession
+    db: AsyncSession,
+    created_before: Optional[datetime] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    limit: Optional[int] = None
 ) -> List[MpesaTransaction]:
     """
-    Retrieve all pending M-Pesa transactions.
+    Retrieve pending M-Pesa transactions, oldest first.
+
+    Args:
+        created_before: Only transactions created before this time
+        after: (created_at, id) of the last row of the previous batch
+        limit: Batch size
     """
     try:
         stmt = select(MpesaTransaction).where(MpesaTransaction.status == MpesaTransactionStatus.PENDING)
+        if created_before:
+            stmt = stmt.where(MpesaTransaction.created_at < created_before)
+        if after:
+            stmt = stmt.where(tuple_(MpesaTransaction.created_at, MpesaTransaction.id) > after)
+        stmt = stmt.order_by(MpesaTransaction.created_at, MpesaTransaction.id)
+        if limit:
+            stmt = stmt.limit(limit)
         result = await db.execute(stmt)
         return result.scalars().all()
     except Exception as e:
         logger.error(f"Error retrieving pending M-Pesa transactions: {str(e)}")
         raise
 
+async def bulk_update_mpesa_transaction_status(
+    db: AsyncSession,
+    updates: Sequence[MpesaStatusUpdate],
+    only_pending: bool = False,
+    commit: bool = True
+) -> List[str]:
+    """
+    Apply many status updates in one UPDATE ... FROM (VALUES ...) statement.
+
+    Args:
+        db: Database session
+        updates: One MpesaStatusUpdate per transaction (a receipt number,
+            result code or description left as None keeps the stored value)
+        only_pending: Skip rows that are no longer PENDING, e.g. because a
+            callback settled them first
+        commit: Commit once after the statement
+
+    Returns the checkout_request_ids that were updated.
+    """
+    if not updates:
+        return []
+    status_type = MpesaTransaction.__table__.c.status.type
+    rows = values(
+        column("checkout_request_id", String),
+        column("status", status_type),
+        column("receipt_number", String),
+        column("result_code", String),
+        column("result_desc", String),
+        name="updates"
+    ).data([tuple(update_) for update_ in updates])
+    now = datetime.utcnow()
+
+    stmt = (
+        update(MpesaTransaction)
+        .where(MpesaTransaction.checkout_request_id == rows.c.checkout_request_id)
+        .values(
+            status=cast(rows.c.status, status_type),
+            mpesa_receipt_number=func.coalesce(rows.c.receipt_number, MpesaTransaction.mpesa_receipt_number),
+            transaction_date=case(
+                (rows.c.receipt_number.isnot(None), now),
+                else_=MpesaTransaction.transaction_date
+            ),
+            result_code=func.coalesce(rows.c.result_code, MpesaTransaction.result_code),
+            result_desc=func.coalesce(rows.c.result_desc, MpesaTransaction.result_desc),
+            updated_at=now
+        )
+        .returning(MpesaTransaction.checkout_request_id)
+        .execution_options(synchronize_session=False)
+    )
+    if only_pending:
+        stmt = stmt.where(MpesaTransaction.status == MpesaTransactionStatus.PENDING)
+
+    try:
+        result = await db.execute(stmt)
+        updated = list(result.scalars())
+        if commit:
+            await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Error bulk updating {len(updates)} M-Pesa transaction(s): {str(e)}")
+        raise
+
+    if len(updated) < len(updates):
+        logger.warning(f"Bulk M-Pesa status update matched {len(updated)} of {len(updates)} transaction(s)")
+    return updated
+
+async def bulk_link_transactions_to_customers(
+    db: AsyncSession,
+    links: Sequence[Tuple[str, int]],
+    commit: bool = True
+) -> int:
+    """
+    Link many (checkout_request_id, customer_id) pairs in one statement.
+    Returns the number of transactions linked.
+    """
+    if not links:
+        return 0
+    rows = values(
+        column("checkout_request_id", String),
+        column("customer_id", Integer),
+        name="links"
+    ).data(list(links))
+    try:
+        result = await db.execute(
+            update(MpesaTransaction)
+            .where(MpesaTransaction.checkout_request_id == rows.c.checkout_request_id)
+            .values(customer_id=rows.c.customer_id, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        if commit:
+            await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Error linking {len(links)} M-Pesa transaction(s) to customers: {str(e)}")
+        raise
+    return result.rowcount
+
 async def link_transaction_to_customer(
     db: AsyncSession, 
     checkout_request_id: str, 
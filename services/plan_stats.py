@@ -0,0 +1,204 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, inspect, literal, select, update, event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.db.models import Customer, CustomerPayment, Plan, PlanStats, PaymentStatus
+from app.db.database import old_value
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PlanDelta:
+    """Change to one plan's counters produced by a single flush"""
+
+    def __init__(self):
+        self.customers = 0
+        self.revenue = 0.0
+
+    def __bool__(self):
+        return bool(self.customers or self.revenue)
+
+
+def _delta_update(plan_id: int, delta: PlanDelta):
+    table = PlanStats.__table__
+    return (
+        update(table)
+        .where(table.c.plan_id == plan_id)
+        .values(
+            customer_count=table.c.customer_count + delta.customers,
+            total_revenue=table.c.total_revenue + delta.revenue,
+            updated_at=datetime.utcnow()
+        )
+    )
+
+
+def _expected_counts(plan_id):
+    customers = select(func.count(Customer.id)).where(Customer.plan_id == plan_id).scalar_subquery()
+    revenue = select(func.coalesce(func.sum(CustomerPayment.amount), 0)).where(
+        CustomerPayment.plan_id == plan_id,
+        CustomerPayment.status == PaymentStatus.COMPLETED
+    ).scalar_subquery()
+    return customers, revenue
+
+
+def _bootstrap_insert(plan_id: int, delta: PlanDelta):
+    """
+    First counters for a plan: aggregate the rows already in the database
+    once, add the pending delta, and tolerate a concurrent bootstrap.
+    """
+    table = PlanStats.__table__
+    customers, revenue = _expected_counts(plan_id)
+    stmt = insert(table).from_select(
+        ["plan_id", "customer_count", "total_revenue", "updated_at"],
+        select(literal(plan_id), customers + delta.customers, revenue + delta.revenue, literal(datetime.utcnow()))
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.plan_id],
+        set_={
+            "customer_count": table.c.customer_count + delta.customers,
+            "total_revenue": table.c.total_revenue + delta.revenue,
+            "updated_at": datetime.utcnow()
+        }
+    )
+
+
+def _customer_plan(session: Session, customer_id: Optional[int]) -> Optional[int]:
+    # Usually already in the identity map (with any plan change pending in
+    # this flush); otherwise one lookup by primary key
+    if not customer_id:
+        return None
+    customer = session.get(Customer, customer_id)
+    return customer.plan_id if customer else None
+
+
+def _collect_deltas(session: Session) -> Dict[int, PlanDelta]:
+    deltas: Dict[int, PlanDelta] = defaultdict(PlanDelta)
+
+    def revenue(plan_id, status, amount, sign):
+        # Column defaults are not applied until the INSERT, so mirror them here
+        if plan_id and (status or PaymentStatus.COMPLETED) == PaymentStatus.COMPLETED:
+            deltas[plan_id].revenue += sign * (amount or 0)
+
+    for obj in session.new:
+        if isinstance(obj, Customer):
+            if obj.plan_id:
+                deltas[obj.plan_id].customers += 1
+        elif isinstance(obj, CustomerPayment):
+            if obj.plan_id is None:
+                obj.plan_id = _customer_plan(session, obj.customer_id)
+            revenue(obj.plan_id, obj.status, obj.amount, 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, Customer):
+            old_plan = old_value(obj, "plan_id")
+            if old_plan:
+                deltas[old_plan].customers -= 1
+        elif isinstance(obj, CustomerPayment):
+            revenue(old_value(obj, "plan_id"), old_value(obj, "status"), old_value(obj, "amount"), -1)
+
+    for obj in session.dirty:
+        if isinstance(obj, Customer):
+            if not inspect(obj).attrs.plan_id.history.has_changes():
+                continue
+            old_plan = old_value(obj, "plan_id")
+            if old_plan:
+                deltas[old_plan].customers -= 1
+            if obj.plan_id:
+                deltas[obj.plan_id].customers += 1
+        elif isinstance(obj, CustomerPayment):
+            state = inspect(obj)
+            if not any(state.attrs[name].history.has_changes() for name in ("status", "amount", "plan_id")):
+                continue
+            revenue(old_value(obj, "plan_id"), old_value(obj, "status"), old_value(obj, "amount"), -1)
+            revenue(obj.plan_id, obj.status, obj.amount, 1)
+
+    return deltas
+
+
+@event.listens_for(Session, "before_flush")
+def _apply_plan_deltas(session: Session, flush_context, instances):
+    """
+    Keep PlanStats in step with customers joining, leaving or switching plans
+    and with payments recorded against them, in the flush's own transaction.
+    New payments without a plan are stamped with the customer's plan so
+    revenue stays with the plan it was earned under.
+    """
+    for plan_id, delta in _collect_deltas(session).items():
+        if not delta:
+            continue
+        if session.execute(_delta_update(plan_id, delta)).rowcount == 0:
+            session.execute(_bootstrap_insert(plan_id, delta))
+
+
+async def update_plan_stats(db: AsyncSession, reseller_id: int) -> int:
+    """
+    Recompute the counters of a reseller's plans and repair any that drifted.
+    The existing rows are locked first so no delta can interleave. Returns
+    how many plans needed a repair.
+    """
+    table = PlanStats.__table__
+    stored = {
+        row.plan_id: row for row in (await db.execute(
+            select(PlanStats)
+            .join(Plan, Plan.id == PlanStats.plan_id)
+            .where(Plan.user_id == reseller_id)
+            .with_for_update(of=PlanStats)
+        )).scalars()
+    }
+    customer_counts = dict((await db.execute(
+        select(Customer.plan_id, func.count(Customer.id))
+        .join(Plan, Plan.id == Customer.plan_id)
+        .where(Plan.user_id == reseller_id)
+        .group_by(Customer.plan_id)
+    )).all())
+    revenue = dict((await db.execute(
+        select(CustomerPayment.plan_id, func.sum(CustomerPayment.amount))
+        .join(Plan, Plan.id == CustomerPayment.plan_id)
+        .where(Plan.user_id == reseller_id, CustomerPayment.status == PaymentStatus.COMPLETED)
+        .group_by(CustomerPayment.plan_id)
+    )).all())
+    plan_ids = (await db.execute(select(Plan.id).where(Plan.user_id == reseller_id))).scalars().all()
+
+    repaired = 0
+    for plan_id in plan_ids:
+        expected = {
+            "customer_count": customer_counts.get(plan_id, 0),
+            "total_revenue": float(revenue.get(plan_id) or 0),
+        }
+        row = stored.get(plan_id)
+        if row is not None and row.customer_count == expected["customer_count"] \
+                and round(row.total_revenue or 0, 2) == round(expected["total_revenue"], 2):
+            continue
+        if row is None and not any(expected.values()):
+            # Plans without customers or payments simply have no row yet
+            continue
+        logger.warning(f"Repairing plan stats for plan {plan_id}: {expected}")
+        stmt = insert(table).values(plan_id=plan_id, **expected, updated_at=datetime.utcnow())
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.plan_id],
+            set_={**expected, "updated_at": datetime.utcnow()}
+        ))
+        repaired += 1
+    return repaired
+
+
+async def get_plan_metrics(db: AsyncSession, user_id: int, role: str) -> List:
+    """(id, name, customer_count, total_revenue) per plan, read from plan_stats"""
+    stmt = (
+        select(
+            Plan.id,
+            Plan.name,
+            func.coalesce(PlanStats.customer_count, 0).label("customer_count"),
+            func.coalesce(PlanStats.total_revenue, 0).label("total_revenue")
+        )
+        .outerjoin(PlanStats, PlanStats.plan_id == Plan.id)
+    )
+    if role != "admin":
+        stmt = stmt.where(Plan.user_id == user_id)
+    return (await db.execute(stmt.order_by(Plan.id))).all()
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings
+from app.db.database import async_session
+from app.db.models import Customer, CustomerStatus, ProvisioningJob, ProvisioningJobStatus, ProvisioningLog, Router
+from app.services.mikrotik_pool import mikrotik_pool
+from app.services.router_state_cache import router_state_cache
+
+logger = logging.getLogger(__name__)
+
+HOTSPOT_BYPASS = "HOTSPOT_BYPASS"
+HOTSPOT_TEARDOWN = "HOTSPOT_TEARDOWN"
+
+
+async def _provision_hotspot_bypass(router: Router, payload: Dict[str, Any]) -> Dict[str, Any]:
+    async with mikrotik_pool.session(router) as api:
+        if not api:
+            return {"error": "Failed to connect to router"}
+        username = payload["mac_address"].replace(":", "")
+        return await api.add_customer_bypass_mode(
+            payload["mac_address"],
+            username,
+            username,
+            payload["time_limit"],
+            payload["bandwidth_limit"],
+            payload["comment"],
+            router.ip_address,
+            router.username,
+            router.password
+        )
+
+
+async def _teardown_hotspot_bypass(router: Router, payload: Dict[str, Any]) -> Dict[str, Any]:
+    # The customer may have renewed while this job waited for a retry
+    async with async_session() as db:
+        customer = (await db.execute(
+            select(Customer).where(Customer.mac_address == payload["mac_address"])
+        )).scalar_one_or_none()
+    if customer and customer.status == CustomerStatus.ACTIVE and customer.expiry and customer.expiry > datetime.utcnow():
+        return {"skipped": "Customer is active again"}
+
+    async with mikrotik_pool.session(router) as api:
+        if not api:
+            return {"error": "Failed to connect to router"}
+        return await api.remove_bypassed_user(payload["mac_address"])
+
+
+JOB_HANDLERS = {
+    HOTSPOT_BYPASS: _provision_hotspot_bypass,
+    HOTSPOT_TEARDOWN: _teardown_hotspot_bypass,
+}
+
+
+class ProvisioningQueue:
+    """
+    Database-backed queue for router provisioning work.
+
+    Jobs are inserted in the same transaction as the payment that triggers
+    them, so a crash or a router outage cannot lose them. Workers claim due
+    jobs with FOR UPDATE SKIP LOCKED (safe with several app instances), run
+    at most PROVISIONING_WORKERS_PER_ROUTER jobs per router at a time, retry
+    failures with exponential backoff and dead-letter a job once it runs out
+    of attempts. Every attempt is recorded in ProvisioningLog.
+    """
+
+    def __init__(
+        self,
+        poll_interval: float = settings.PROVISIONING_POLL_INTERVAL_SECONDS,
+        max_in_flight: int = settings.PROVISIONING_MAX_IN_FLIGHT,
+        workers_per_router: int = settings.PROVISIONING_WORKERS_PER_ROUTER,
+        max_attempts: int = settings.PROVISIONING_MAX_ATTEMPTS,
+        retry_base: float = settings.PROVISIONING_RETRY_BASE_SECONDS,
+        retry_max: float = settings.PROVISIONING_RETRY_MAX_SECONDS,
+        lock_timeout: int = settings.PROVISIONING_LOCK_TIMEOUT_SECONDS,
+    ):
+        self.poll_interval = poll_interval
+        self.max_in_flight = max_in_flight
+        self.workers_per_router = workers_per_router
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.lock_timeout = lock_timeout
+        self._wakeup = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+        self._router_in_flight: Dict[int, int] = {}
+        self._last_stale_check = 0.0
+        self._durations: Deque[float] = deque(maxlen=500)
+        self.counters = {
+            "enqueued": 0,
+            "claimed": 0,
+            "succeeded": 0,
+            "retried": 0,
+            "dead_lettered": 0,
+            "requeued_stale": 0,
+        }
+
+    def enqueue(
+        self, db: AsyncSession, customer_id: int, router_id: int,
+        payload: Dict[str, Any], action: str = HOTSPOT_BYPASS, delay: float = 0
+    ) -> ProvisioningJob:
+        """
+        Add a job to the caller's session. It becomes visible to workers when
+        the caller commits; call notify() afterwards to skip the poll delay.
+        A delay holds the job back, e.g. while the caller tries the work itself.
+        """
+        job = ProvisioningJob(
+            customer_id=customer_id,
+            router_id=router_id,
+            action=action,
+            payload=payload,
+            status=ProvisioningJobStatus.PENDING,
+            attempts=0,
+            max_attempts=self.max_attempts,
+            next_attempt_at=datetime.utcnow() + timedelta(seconds=delay)
+        )
+        db.add(job)
+        self.counters["enqueued"] += 1
+        return job
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def requeue(self, db: AsyncSession, job_id: int, owner_id: Optional[int] = None) -> bool:
+        """Give a dead-lettered job a fresh set of attempts; with owner_id, only a job on that reseller's router"""
+        stmt = update(ProvisioningJob).where(
+            ProvisioningJob.id == job_id, ProvisioningJob.status == ProvisioningJobStatus.DEAD
+        )
+        if owner_id is not None:
+            stmt = stmt.where(ProvisioningJob.router_id.in_(select(Router.id).where(Router.user_id == owner_id)))
+        result = await db.execute(
+            stmt.values(status=ProvisioningJobStatus.PENDING, attempts=0, next_attempt_at=datetime.utcnow(), locked_at=None)
+        )
+        await db.commit()
+        if result.rowcount:
+            self.notify()
+        return bool(result.rowcount)
+
+    async def _requeue_stale(self):
+        """Return jobs whose worker died mid-attempt to the queue"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lock_timeout)
+        async with async_session() as db:
+            result = await db.execute(
+                update(ProvisioningJob)
+                .where(ProvisioningJob.status == ProvisioningJobStatus.RUNNING, ProvisioningJob.locked_at < cutoff)
+                .values(status=ProvisioningJobStatus.PENDING, locked_at=None)
+            )
+            await db.commit()
+        if result.rowcount:
+            self.counters["requeued_stale"] += result.rowcount
+            logger.warning(f"Requeued {result.rowcount} stale provisioning job(s)")
+
+    async def _claim(self, limit: int) -> List[Tuple[int, int]]:
+        """Lock due jobs, keeping within the per-router limit, and mark them running"""
+        now = datetime.utcnow()
+        busy = [router_id for router_id, count in self._router_in_flight.items() if count >= self.workers_per_router]
+        stmt = (
+            select(ProvisioningJob)
+            .where(
+                ProvisioningJob.status == ProvisioningJobStatus.PENDING,
+                ProvisioningJob.next_attempt_at <= now
+            )
+            .order_by(ProvisioningJob.next_attempt_at)
+            .limit(limit * self.workers_per_router)
+            .with_for_update(skip_locked=True)
+        )
+        if busy:
+            stmt = stmt.where(ProvisioningJob.router_id.notin_(busy))
+
+        claimed = []
+        async with async_session() as db:
+            jobs = (await db.execute(stmt)).scalars().all()
+            slots = {}
+            for job in jobs:
+                taken = slots.get(job.router_id, self._router_in_flight.get(job.router_id, 0))
+                if taken >= self.workers_per_router or len(claimed) >= limit:
+                    continue
+                slots[job.router_id] = taken + 1
+                job.status = ProvisioningJobStatus.RUNNING
+                job.locked_at = now
+                job.attempts += 1
+                claimed.append((job.id, job.router_id))
+            await db.commit()
+        self.counters["claimed"] += len(claimed)
+        return claimed
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.retry_base * (2 ** (attempts - 1)), self.retry_max)
+        # Jitter so jobs that failed together (router outage) don't retry in lockstep
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _run_job(self, job_id: int):
+        started = time.monotonic()
+        # Load what the handler needs and give the connection back before
+        # talking to the router; a slow router must not hold a pooled
+        # connection idle in transaction
+        async with async_session() as db:
+            job = await db.get(ProvisioningJob, job_id)
+            router = await db.get(Router, job.router_id)
+        mac_address = job.payload.get("mac_address")
+
+        error = None
+        give_up = False
+        try:
+            handler = JOB_HANDLERS.get(job.action)
+            if handler is None:
+                error = f"Unknown provisioning action {job.action}"
+                give_up = True
+            elif router is None:
+                error = f"Router {job.router_id} not found"
+                give_up = True
+            else:
+                result = await handler(router, job.payload)
+                error = result.get("error")
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+
+        async with async_session() as db:
+            job = await db.get(ProvisioningJob, job_id)
+            if give_up:
+                job.attempts = job.max_attempts
+            job.locked_at = None
+            if error is None:
+                job.status = ProvisioningJobStatus.SUCCEEDED
+                job.last_error = None
+                log_status, details = "SUCCESS", f"Provisioned on attempt {job.attempts}"
+                self.counters["succeeded"] += 1
+            elif job.attempts >= job.max_attempts:
+                job.status = ProvisioningJobStatus.DEAD
+                job.last_error = error[:255]
+                log_status, details = "FAILED", f"Gave up after {job.attempts} attempt(s)"
+                self.counters["dead_lettered"] += 1
+                logger.error(f"Provisioning job {job.id} dead-lettered: {error}")
+            else:
+                delay = self._backoff(job.attempts)
+                job.status = ProvisioningJobStatus.PENDING
+                job.last_error = error[:255]
+                job.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+                log_status, details = "RETRYING", f"Attempt {job.attempts} failed, retrying in {int(delay)}s"
+                self.counters["retried"] += 1
+                logger.warning(f"Provisioning job {job.id} attempt {job.attempts} failed: {error}")
+
+            db.add(ProvisioningLog(
+                customer_id=job.customer_id,
+                router_id=job.router_id,
+                mac_address=mac_address,
+                action=job.action,
+                status=log_status,
+                error=error[:255] if error else None,
+                details=details,
+                log_date=datetime.utcnow()
+            ))
+            await db.commit()
+
+        router_state_cache.invalidate(job.router_id)
+        self._durations.append(time.monotonic() - started)
+
+    def _spawn(self, job_id: int, router_id: int):
+        self._router_in_flight[router_id] = self._router_in_flight.get(router_id, 0) + 1
+        task = asyncio.create_task(self._run_job(job_id))
+        self._tasks.add(task)
+
+        def done(finished: asyncio.Task):
+            self._tasks.discard(finished)
+            remaining = self._router_in_flight.get(router_id, 1) - 1
+            if remaining:
+                self._router_in_flight[router_id] = remaining
+            else:
+                self._router_in_flight.pop(router_id, None)
+            if not finished.cancelled() and finished.exception():
+                logger.error(f"Provisioning job {job_id} crashed: {finished.exception()}")
+            # A slot just freed up; look for more work straight away
+            self._wakeup.set()
+
+        task.add_done_callback(done)
+
+    async def run(self):
+        """Background task that claims and executes due jobs"""
+        while True:
+            try:
+                if time.monotonic() - self._last_stale_check > self.lock_timeout / 2:
+                    self._last_stale_check = time.monotonic()
+                    await self._requeue_stale()
+                free = self.max_in_flight - len(self._tasks)
+                if free > 0:
+                    for job_id, router_id in await self._claim(free):
+                        self._spawn(job_id, router_id)
+            except Exception as e:
+                logger.error(f"Provisioning queue error: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def close(self, grace_period: float = 10.0):
+        """Let running jobs finish; anything still running is picked up again after the lock timeout"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=grace_period)
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def depth(self, db: AsyncSession) -> Dict[str, int]:
+        """Number of jobs per status"""
+        result = await db.execute(
+            select(ProvisioningJob.status, func.count()).group_by(ProvisioningJob.status)
+        )
+        return {status.value: count for status, count in result.all()}
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "in_flight": len(self._tasks),
+            "in_flight_per_router": dict(self._router_in_flight),
+            "avg_job_seconds": round(sum(self._durations) / len(self._durations), 3) if self._durations else 0.0,
+        }
+
+
+provisioning_queue = ProvisioningQueue()
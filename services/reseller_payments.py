@@ -1,9 +1,29 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func
-from sqlalchemy.orm import joinedload
-from datetime import datetime, timedelta
+from sqlalchemy import select, func, update, delete, literal, event, inspect, true
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import joinedload, Session
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
 from fastapi import HTTPException
-from app.db.models import Customer, CustomerPayment, ResellerFinancials, Payment, PaymentMethod, CustomerStatus, PaymentStatus
+from app.db.database import old_value
+from app.db.models import Customer, CustomerPayment, ResellerFinancials, Payment, PaymentMethod, CustomerStatus, PaymentStatus, PaymentDailyRollup
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# session.info key listing the resellers whose customers or payments changed
+# in the current transaction (read by cache invalidation after commit)
+TOUCHED_RESELLERS = "touched_resellers"
+
+
+def mark_touched(session: Session, reseller_ids: Iterable[Optional[int]]):
+    """
+    Record resellers whose dashboard figures this transaction changes; None
+    stands for customers without a reseller, which only the admin figures see.
+    """
+    session.info.setdefault(TOUCHED_RESELLERS, set()).update(reseller_ids)
 
 async def record_customer_payment(
     db: AsyncSession,
@@ -13,9 +33,15 @@ async def record_customer_payment(
     payment_method: PaymentMethod,
     days_paid_for: int,
     payment_reference: str = None,
-    notes: str = None
+    notes: str = None,
+    commit: bool = True,
+    plan_id: Optional[int] = None
 ) -> CustomerPayment:
-    """Record a payment made by customer to reseller"""
+    """
+    Record a payment made by customer to reseller. With commit=False the rows
+    are only flushed and commit or roll back with the caller's transaction.
+    plan_id is the plan paid for; left out, it is the customer's current plan.
+    """
     
     stmt = select(Customer).where(
         Customer.id == customer_id,
@@ -34,7 +60,8 @@ async def record_customer_payment(
         payment_method=payment_method,
         payment_reference=payment_reference,
         days_paid_for=days_paid_for,
-        notes=notes
+        notes=notes,
+        plan_id=plan_id
     )
     
     db.add(payment)
@@ -53,51 +80,368 @@ async def record_customer_payment(
     )
     db.add(existing_payment)
     
-    await update_reseller_financials(db, reseller_id)
-    
+    # ResellerFinancials is adjusted by the flush hook below
+    if not commit:
+        await db.flush()
+        return payment
     await db.commit()
     await db.refresh(payment)
     
     return payment
 
-async def update_reseller_financials(db: AsyncSession, reseller_id: int):
-    """Update reseller's financial summary"""
-    
-    stmt = select(ResellerFinancials).where(ResellerFinancials.user_id == reseller_id)
-    result = await db.execute(stmt)
-    financials = result.scalar_one_or_none()
-    
-    if not financials:
-        financials = ResellerFinancials(user_id=reseller_id)
-        db.add(financials)
-    
-    total_revenue_stmt = select(func.sum(CustomerPayment.amount)).where(
+class FinancialsDelta:
+    """Change to one reseller's counters produced by a single flush"""
+
+    def __init__(self):
+        self.revenue = 0.0
+        self.customers = 0
+        self.active = 0
+        self.last_payment_date: Optional[datetime] = None
+        # (day, payment method) -> [amount, count] for payment_daily_rollups
+        self.daily: Dict[Tuple[date, PaymentMethod], List] = defaultdict(lambda: [0.0, 0])
+
+    def paid(self, amount: float, paid_on: datetime, method: PaymentMethod, sign: int, new: bool):
+        self.revenue += sign * amount
+        bucket = self.daily[(paid_on.date(), method)]
+        bucket[0] += sign * amount
+        bucket[1] += sign
+        # Edits (e.g. a refund) move revenue but not the last payment date
+        if new and (self.last_payment_date is None or paid_on > self.last_payment_date):
+            self.last_payment_date = paid_on
+
+    def __bool__(self):
+        return bool(
+            self.revenue or self.customers or self.active or self.last_payment_date
+            or any(amount or count for amount, count in self.daily.values())
+        )
+
+
+def _delta_update(reseller_id: int, delta: FinancialsDelta):
+    table = ResellerFinancials.__table__
+    return (
+        update(table)
+        .where(table.c.user_id == reseller_id)
+        .values(
+            total_revenue=table.c.total_revenue + delta.revenue,
+            total_customers=table.c.total_customers + delta.customers,
+            active_customers=table.c.active_customers + delta.active,
+            last_payment_date=func.greatest(table.c.last_payment_date, delta.last_payment_date),
+            updated_at=datetime.utcnow()
+        )
+    )
+
+
+def _bootstrap_insert(reseller_id: int, delta: FinancialsDelta):
+    """
+    First counters for a reseller: aggregate the rows already in the database
+    once, add the pending delta, and tolerate a concurrent bootstrap.
+    """
+    table = ResellerFinancials.__table__
+    revenue = select(func.coalesce(func.sum(CustomerPayment.amount), 0)).where(
         CustomerPayment.reseller_id == reseller_id,
         CustomerPayment.status == PaymentStatus.COMPLETED
-    )
-    total_revenue_result = await db.execute(total_revenue_stmt)
-    total_revenue = total_revenue_result.scalar() or 0
-    
-    total_customers_stmt = select(func.count(Customer.id)).where(
-        Customer.user_id == reseller_id
-    )
-    total_customers_result = await db.execute(total_customers_stmt)
-    total_customers = total_customers_result.scalar() or 0
-    
-    active_customers_stmt = select(func.count(Customer.id)).where(
+    ).scalar_subquery()
+    customers = select(func.count(Customer.id)).where(Customer.user_id == reseller_id).scalar_subquery()
+    active = select(func.count(Customer.id)).where(
         Customer.user_id == reseller_id,
         Customer.status == CustomerStatus.ACTIVE
-    )
-    active_customers_result = await db.execute(active_customers_stmt)
-    active_customers = active_customers_result.scalar() or 0
-    
-    last_payment_stmt = select(func.max(CustomerPayment.payment_date)).where(
+    ).scalar_subquery()
+    last_payment = select(func.max(CustomerPayment.payment_date)).where(
         CustomerPayment.reseller_id == reseller_id
+    ).scalar_subquery()
+
+    stmt = insert(table).from_select(
+        ["user_id", "total_revenue", "total_customers", "active_customers", "last_payment_date", "updated_at"],
+        select(
+            literal(reseller_id),
+            revenue + delta.revenue,
+            customers + delta.customers,
+            active + delta.active,
+            func.greatest(last_payment, delta.last_payment_date),
+            literal(datetime.utcnow())
+        )
     )
-    last_payment_result = await db.execute(last_payment_stmt)
-    last_payment_date = last_payment_result.scalar()
-    
-    financials.total_revenue = total_revenue
-    financials.total_customers = total_customers
-    financials.active_customers = active_customers
-    financials.last_payment_date = last_payment_date
\ No newline at end of file
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id],
+        set_={
+            "total_revenue": table.c.total_revenue + delta.revenue,
+            "total_customers": table.c.total_customers + delta.customers,
+            "active_customers": table.c.active_customers + delta.active,
+            "last_payment_date": func.greatest(table.c.last_payment_date, delta.last_payment_date),
+            "updated_at": datetime.utcnow()
+        }
+    )
+
+
+def _rollup_upserts(reseller_id: int, delta: FinancialsDelta):
+    table = PaymentDailyRollup.__table__
+    for (day, method), (amount, count) in delta.daily.items():
+        if not amount and not count:
+            continue
+        stmt = insert(table).values(
+            reseller_id=reseller_id, day=day, payment_method=method, total_amount=amount, payment_count=count
+        )
+        yield stmt.on_conflict_do_update(
+            index_elements=[table.c.reseller_id, table.c.day, table.c.payment_method],
+            set_={
+                "total_amount": table.c.total_amount + stmt.excluded.total_amount,
+                "payment_count": table.c.payment_count + stmt.excluded.payment_count,
+            }
+        )
+
+
+def _collect_deltas(session: Session) -> Dict[int, FinancialsDelta]:
+    deltas: Dict[int, FinancialsDelta] = defaultdict(FinancialsDelta)
+
+    def customer_counts(owner, status, sign):
+        if owner:
+            deltas[owner].customers += sign
+            if status == CustomerStatus.ACTIVE:
+                deltas[owner].active += sign
+
+    def payment_counts(payment, sign, new=False, old=False):
+        value = (lambda name: old_value(payment, name)) if old else (lambda name: getattr(payment, name))
+        reseller_id = value("reseller_id")
+        # Column defaults are not applied until the INSERT, so mirror them here
+        status = value("status") or PaymentStatus.COMPLETED
+        if reseller_id and status == PaymentStatus.COMPLETED:
+            if new and payment.payment_date is None:
+                payment.payment_date = datetime.utcnow()
+            deltas[reseller_id].paid(
+                value("amount") or 0,
+                value("payment_date") or datetime.utcnow(),
+                value("payment_method") or PaymentMethod.CASH,
+                sign,
+                new
+            )
+
+    for obj in session.new:
+        if isinstance(obj, Customer):
+            customer_counts(obj.user_id, obj.status, 1)
+        elif isinstance(obj, CustomerPayment):
+            payment_counts(obj, 1, new=True)
+
+    for obj in session.deleted:
+        if isinstance(obj, Customer):
+            customer_counts(obj.user_id, obj.status, -1)
+        elif isinstance(obj, CustomerPayment):
+            payment_counts(obj, -1, old=True)
+
+    for obj in session.dirty:
+        if isinstance(obj, Customer):
+            state = inspect(obj)
+            if state.attrs.expiry.history.has_changes():
+                # No counter moves, but the dashboard's expiring-soon figure does
+                mark_touched(session, [obj.user_id])
+            if not (state.attrs.status.history.has_changes() or state.attrs.user_id.history.has_changes()):
+                continue
+            customer_counts(old_value(obj, "user_id"), old_value(obj, "status"), -1)
+            customer_counts(obj.user_id, obj.status, 1)
+        elif isinstance(obj, CustomerPayment):
+            state = inspect(obj)
+            tracked = ("status", "amount", "reseller_id", "payment_date", "payment_method")
+            if not any(state.attrs[name].history.has_changes() for name in tracked):
+                continue
+            payment_counts(obj, -1, old=True)
+            payment_counts(obj, 1)
+
+    # Includes resellers whose changes cancel out (e.g. PENDING -> INACTIVE)
+    return deltas
+
+
+@event.listens_for(Session, "before_flush")
+def _apply_financials_deltas(session: Session, flush_context, instances):
+    """
+    Keep ResellerFinancials in step with customer and payment writes made
+    through the ORM. The deltas run in the same transaction as the flush, so
+    a rollback discards them together with the change that caused them.
+    """
+    deltas = _collect_deltas(session)
+    mark_touched(session, deltas)
+    for reseller_id, delta in deltas.items():
+        if not delta:
+            continue
+        if session.execute(_delta_update(reseller_id, delta)).rowcount == 0:
+            session.execute(_bootstrap_insert(reseller_id, delta))
+        for stmt in _rollup_upserts(reseller_id, delta):
+            session.execute(stmt)
+
+
+async def adjust_active_customers(db: AsyncSession, changes: Dict[int, int]):
+    """
+    Apply active-customer deltas for writes that bypass the ORM (bulk
+    UPDATEs). Resellers without a counters row are left to the reconciler.
+    """
+    for reseller_id, change in changes.items():
+        if not reseller_id or not change:
+            continue
+        delta = FinancialsDelta()
+        delta.active = change
+        await db.execute(_delta_update(reseller_id, delta))
+        mark_touched(db.sync_session, [reseller_id])
+
+
+async def rebuild_payment_rollups(db: AsyncSession, reseller_id: int):
+    """Regenerate a reseller's daily rollups from customer_payments"""
+    day = func.date(CustomerPayment.payment_date)
+    await db.execute(delete(PaymentDailyRollup).where(PaymentDailyRollup.reseller_id == reseller_id))
+    await db.execute(
+        insert(PaymentDailyRollup.__table__).from_select(
+            ["reseller_id", "day", "payment_method", "total_amount", "payment_count"],
+            select(
+                CustomerPayment.reseller_id,
+                day,
+                CustomerPayment.payment_method,
+                func.sum(CustomerPayment.amount),
+                func.count(CustomerPayment.id)
+            )
+            .where(
+                CustomerPayment.reseller_id == reseller_id,
+                CustomerPayment.status == PaymentStatus.COMPLETED
+            )
+            .group_by(CustomerPayment.reseller_id, day, CustomerPayment.payment_method)
+        )
+    )
+
+
+async def get_payment_summary(db: AsyncSession, reseller_id: int) -> Dict[str, float]:
+    """
+    Today / this week / this month / all-time payment totals in one statement.
+    Closed days come from payment_daily_rollups (a few rows per day); the
+    current day is read live from customer_payments.
+    """
+    now = datetime.utcnow()
+    today = now.date()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    week_start = today - timedelta(days=now.weekday())
+    month_start = today.replace(day=1)
+
+    live_today = (
+        select(
+            func.coalesce(func.sum(CustomerPayment.amount), 0).label("today_amount"),
+            func.count(CustomerPayment.id).label("today_count")
+        )
+        .where(
+            CustomerPayment.reseller_id == reseller_id,
+            CustomerPayment.payment_date >= today_start,
+            CustomerPayment.status == PaymentStatus.COMPLETED
+        )
+        .subquery()
+    )
+    closed_days = (
+        select(
+            func.coalesce(func.sum(PaymentDailyRollup.total_amount).filter(PaymentDailyRollup.day >= week_start), 0).label("week_amount"),
+            func.coalesce(func.sum(PaymentDailyRollup.payment_count).filter(PaymentDailyRollup.day >= week_start), 0).label("week_count"),
+            func.coalesce(func.sum(PaymentDailyRollup.total_amount).filter(PaymentDailyRollup.day >= month_start), 0).label("month_amount"),
+            func.coalesce(func.sum(PaymentDailyRollup.payment_count).filter(PaymentDailyRollup.day >= month_start), 0).label("month_count"),
+            func.coalesce(func.sum(PaymentDailyRollup.total_amount), 0).label("total_amount")
+        )
+        .where(PaymentDailyRollup.reseller_id == reseller_id, PaymentDailyRollup.day < today)
+        .subquery()
+    )
+    # Both sides are single-row aggregates; the explicit join on true keeps
+    # SQLAlchemy from warning about a cartesian product
+    row = (await db.execute(
+        select(live_today, closed_days).select_from(live_today.join(closed_days, true()))
+    )).one()
+
+    today_amount = float(row.today_amount or 0)
+    today_count = row.today_count or 0
+    return {
+        "today_total": today_amount,
+        "today_count": today_count,
+        "week_total": float(row.week_amount) + today_amount,
+        "week_count": int(row.week_count) + today_count,
+        "month_total": float(row.month_amount) + today_amount,
+        "month_count": int(row.month_count) + today_count,
+        "total_amount": float(row.total_amount) + today_amount,
+    }
+
+
+async def update_reseller_financials(db: AsyncSession, reseller_id: int) -> bool:
+    """
+    Recompute a reseller's counters from scratch and repair them if they
+    drifted. The counters row is locked first so no delta can interleave.
+    Returns True if a repair was needed.
+    """
+    stmt = select(ResellerFinancials).where(ResellerFinancials.user_id == reseller_id).with_for_update()
+    financials = (await db.execute(stmt)).scalar_one_or_none()
+    if not financials:
+        await db.execute(_bootstrap_insert(reseller_id, FinancialsDelta()))
+        await rebuild_payment_rollups(db, reseller_id)
+        return True
+
+    payments = (await db.execute(
+        select(
+            func.coalesce(func.sum(CustomerPayment.amount).filter(CustomerPayment.status == PaymentStatus.COMPLETED), 0),
+            func.max(CustomerPayment.payment_date)
+        ).where(CustomerPayment.reseller_id == reseller_id)
+    )).one()
+    customers = (await db.execute(
+        select(
+            func.count(Customer.id),
+            func.count(Customer.id).filter(Customer.status == CustomerStatus.ACTIVE)
+        ).where(Customer.user_id == reseller_id)
+    )).one()
+
+    expected = {
+        "total_revenue": float(payments[0] or 0),
+        "total_customers": customers[0] or 0,
+        "active_customers": customers[1] or 0,
+        "last_payment_date": payments[1],
+    }
+    drifted = {
+        name: (getattr(financials, name), value) for name, value in expected.items()
+        if (round(getattr(financials, name) or 0, 2) != round(value or 0, 2) if name == "total_revenue"
+            else getattr(financials, name) != value)
+    }
+    rollup_total = (await db.execute(
+        select(func.coalesce(func.sum(PaymentDailyRollup.total_amount), 0))
+        .where(PaymentDailyRollup.reseller_id == reseller_id)
+    )).scalar()
+    if round(float(rollup_total or 0), 2) != round(expected["total_revenue"], 2):
+        logger.warning(f"Rebuilding daily payment rollups for reseller {reseller_id}")
+        await rebuild_payment_rollups(db, reseller_id)
+        drifted["payment_daily_rollups"] = (rollup_total, expected["total_revenue"])
+
+    if drifted:
+        logger.warning(f"Repairing financial counters for reseller {reseller_id}: {drifted}")
+        await db.execute(
+            update(ResellerFinancials.__table__)
+            .where(ResellerFinancials.__table__.c.user_id == reseller_id)
+            .values(**expected, updated_at=datetime.utcnow())
+        )
+    return bool(drifted)
+
+
+async def reconcile_reseller_financials() -> int:
+    """Verify every reseller's counters and plan stats; returns how many resellers were repaired"""
+    from app.db.database import async_session
+    from app.services.plan_stats import update_plan_stats
+
+    async with async_session() as db:
+        reseller_ids = set((await db.execute(select(ResellerFinancials.user_id))).scalars())
+        reseller_ids |= set((await db.execute(
+            select(Customer.user_id).where(Customer.user_id.isnot(None)).distinct()
+        )).scalars())
+
+    repaired = 0
+    for reseller_id in reseller_ids:
+        async with async_session() as db:
+            financials_drifted = await update_reseller_financials(db, reseller_id)
+            if financials_drifted or await update_plan_stats(db, reseller_id):
+                repaired += 1
+            await db.commit()
+    return repaired
+
+
+async def run_financials_reconciler(interval: int):
+    """Background task that repairs counter drift (bulk SQL, manual edits, crashes)"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            repaired = await reconcile_reseller_financials()
+            if repaired:
+                logger.warning(f"Reconciled financial counters for {repaired} reseller(s)")
+        except Exception as e:
+            logger.error(f"Financials reconciliation error: {e}")
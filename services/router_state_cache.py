@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.mikrotik_api import build_query_words
+from app.services.mikrotik_async import AsyncMikroTikAPI
+from app.services.mikrotik_pool import RouterCredentials, mikrotik_pool
+
+logger = logging.getLogger(__name__)
+
+# table -> (print command, projected columns, indexed columns)
+ROUTER_TABLES: Dict[str, Tuple[str, List[str], List[str]]] = {
+    "users": (
+        "/ip/hotspot/user/print",
+        [".id", "name", "profile", "disabled", "comment", "limit-uptime"],
+        ["name"],
+    ),
+    "active": (
+        "/ip/hotspot/active/print",
+        [".id", "user", "mac-address", "address", "login-time", "uptime", "bytes-in", "bytes-out"],
+        ["user", "mac-address"],
+    ),
+    "bindings": (
+        "/ip/hotspot/ip-binding/print",
+        [".id", "mac-address", "type", "comment"],
+        ["mac-address"],
+    ),
+    "queues": (
+        "/queue/simple/print",
+        [".id", "name", "target", "max-limit"],
+        ["name"],
+    ),
+    "leases": (
+        "/ip/dhcp-server/lease/print",
+        [".id", "mac-address", "address"],
+        ["mac-address"],
+    ),
+}
+
+
+def _is_dead(row: Dict[str, str]) -> bool:
+    # =follow= replies mark removed items with .dead
+    return row.get(".dead") in ("yes", "true")
+
+
+class RouterTable:
+    """Rows of one router table keyed by .id, with hash indexes on lookup columns"""
+
+    def __init__(self, indexed_columns: List[str]):
+        self.rows: Dict[str, Dict[str, str]] = {}
+        self.indexes: Dict[str, Dict[str, str]] = {column: {} for column in indexed_columns}
+
+    def _unindex(self, row: Dict[str, str]):
+        for column, index in self.indexes.items():
+            value = row.get(column)
+            if value is not None and index.get(value.upper()) == row.get(".id"):
+                del index[value.upper()]
+
+    def upsert(self, row: Dict[str, str]):
+        row_id = row.get(".id")
+        if not row_id:
+            return
+        previous = self.rows.get(row_id)
+        if previous:
+            self._unindex(previous)
+            if not _is_dead(row):
+                # Change notifications may carry only the modified columns
+                row = {**previous, **row}
+        if _is_dead(row):
+            self.rows.pop(row_id, None)
+            return
+        self.rows[row_id] = row
+        for column, index in self.indexes.items():
+            value = row.get(column)
+            if value is not None:
+                index[value.upper()] = row_id
+
+    def get(self, column: str, value: str) -> Optional[Dict[str, str]]:
+        row_id = self.indexes[column].get(value.upper())
+        return self.rows.get(row_id) if row_id else None
+
+
+class RouterStateSnapshot:
+    """In-memory mirror of a router's hotspot users, sessions, bindings, queues and leases"""
+
+    def __init__(self, router_id: int):
+        self.router_id = router_id
+        self.tables = {name: RouterTable(indexed) for name, (_, _, indexed) in ROUTER_TABLES.items()}
+        self.refreshed_at = 0.0
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.refreshed_at
+
+    def hotspot_user(self, username: str) -> Optional[Dict[str, str]]:
+        return self.tables["users"].get("name", username)
+
+    def active_session(self, username: str) -> Optional[Dict[str, str]]:
+        return self.tables["active"].get("user", username)
+
+    def active_session_by_mac(self, mac_address: str) -> Optional[Dict[str, str]]:
+        return self.tables["active"].get("mac-address", mac_address)
+
+    def ip_binding(self, mac_address: str) -> Optional[Dict[str, str]]:
+        return self.tables["bindings"].get("mac-address", mac_address)
+
+    def queue(self, name: str) -> Optional[Dict[str, str]]:
+        return self.tables["queues"].get("name", name)
+
+    def dhcp_lease(self, mac_address: str) -> Optional[Dict[str, str]]:
+        return self.tables["leases"].get("mac-address", mac_address)
+
+
+class RouterStateCache:
+    """
+    Keeps a RouterStateSnapshot per router so status lookups are answered from
+    memory instead of logging in and printing whole tables on every request.
+
+    Routers are tracked once somebody asks about them and dropped again after
+    ROUTER_STATE_IDLE_SECONDS without lookups. Tracked routers are refreshed
+    every ROUTER_STATE_REFRESH_SECONDS with one pipelined, projected print of
+    each table; with ROUTER_STATE_FOLLOW enabled a dedicated session streams
+    changes via =follow-only= instead, and a periodic ping on that session
+    keeps a quiet router's snapshot fresh while it answers. A snapshot older
+    than the staleness bound is refreshed inline before it is returned.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: int = settings.ROUTER_STATE_REFRESH_SECONDS,
+        max_staleness: int = settings.ROUTER_STATE_MAX_STALENESS_SECONDS,
+        idle_after: int = settings.ROUTER_STATE_IDLE_SECONDS,
+        follow: bool = settings.ROUTER_STATE_FOLLOW,
+    ):
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.idle_after = idle_after
+        self.follow = follow
+        self._snapshots: Dict[int, RouterStateSnapshot] = {}
+        self._routers: Dict[int, RouterCredentials] = {}
+        self._last_lookup: Dict[int, float] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._followers: Dict[int, asyncio.Task] = {}
+        self.counters = {"hits": 0, "refreshes": 0, "refresh_failures": 0}
+
+    async def _load(self, credentials: RouterCredentials) -> Optional[RouterStateSnapshot]:
+        async with mikrotik_pool.session(credentials) as api:
+            if not api:
+                return None
+            replies = await api.pipeline([
+                build_query_words(command, proplist=columns) for command, columns, _ in ROUTER_TABLES.values()
+            ])
+        snapshot = RouterStateSnapshot(credentials.router_id)
+        for name, reply in zip(ROUTER_TABLES, replies):
+            if "error" in reply:
+                logger.error(f"Failed to load {name} from router {credentials.router_id}: {reply['error']}")
+                return None
+            for row in reply.get("data", []):
+                snapshot.tables[name].upsert(row)
+        snapshot.refreshed_at = time.monotonic()
+        return snapshot
+
+    async def refresh(self, router) -> Optional[RouterStateSnapshot]:
+        """Reload a router's tables now (single-flight per router)"""
+        credentials = router if isinstance(router, RouterCredentials) else RouterCredentials.from_router(router)
+        lock = self._locks.setdefault(credentials.router_id, asyncio.Lock())
+        async with lock:
+            current = self._snapshots.get(credentials.router_id)
+            if current and current.age < 1:
+                # Someone else refreshed while we were waiting
+                return current
+            snapshot = await self._load(credentials)
+            if snapshot is None:
+                self.counters["refresh_failures"] += 1
+                return None
+            self.counters["refreshes"] += 1
+            self._snapshots[credentials.router_id] = snapshot
+            return snapshot
+
+    async def get(self, router, max_staleness: Optional[float] = None) -> Optional[RouterStateSnapshot]:
+        """
+        Return a snapshot no older than max_staleness seconds, refreshing inline
+        if needed. Returns None when the router cannot be read.
+        """
+        credentials = router if isinstance(router, RouterCredentials) else RouterCredentials.from_router(router)
+        self._routers[credentials.router_id] = credentials
+        self._last_lookup[credentials.router_id] = time.monotonic()
+        if self.follow and credentials.router_id not in self._followers:
+            self._followers[credentials.router_id] = asyncio.create_task(self._follow(credentials))
+
+        bound = self.max_staleness if max_staleness is None else max_staleness
+        snapshot = self._snapshots.get(credentials.router_id)
+        if snapshot and snapshot.age <= bound:
+            self.counters["hits"] += 1
+            return snapshot
+        return await self.refresh(credentials)
+
+    def invalidate(self, router_id: int):
+        """Force the next lookup to re-read the router (call after writing to it)"""
+        snapshot = self._snapshots.get(router_id)
+        if snapshot:
+            snapshot.refreshed_at = 0.0
+
+    def _forget_idle_routers(self):
+        cutoff = time.monotonic() - self.idle_after
+        for router_id in [r for r, seen in self._last_lookup.items() if seen < cutoff]:
+            self._last_lookup.pop(router_id, None)
+            self._routers.pop(router_id, None)
+            self._snapshots.pop(router_id, None)
+            follower = self._followers.pop(router_id, None)
+            if follower:
+                follower.cancel()
+
+    async def _heartbeat(self, api: AsyncMikroTikAPI, router_id: int):
+        """
+        Keep a quiet router's followed snapshot fresh: while the session still
+        answers, its streams are live and the snapshot is current. Returns
+        (ending the follow) once the session stops answering.
+        """
+        interval = max(1.0, min(self.refresh_interval, self.max_staleness / 2))
+        while True:
+            await asyncio.sleep(interval)
+            reply = await api.send_words(["/system/identity/print"])
+            if "error" in reply:
+                logger.warning(f"Follow session for router {router_id} stopped answering: {reply['error']}")
+                return
+            current = self._snapshots.get(router_id)
+            # An invalidated snapshot stays invalid until it is reloaded
+            if current and current.refreshed_at:
+                current.refreshed_at = time.monotonic()
+
+    async def _follow(self, credentials: RouterCredentials):
+        """Stream table changes on a dedicated session, reconnecting on failure"""
+        while True:
+            api = AsyncMikroTikAPI(credentials.host, credentials.username, credentials.password, credentials.port)
+            try:
+                if await api.connect():
+                    snapshot = await self.refresh(credentials)
+                    if snapshot:
+                        def apply(name):
+                            def on_row(row):
+                                current = self._snapshots.get(credentials.router_id)
+                                if current:
+                                    current.tables[name].upsert(row)
+                                    current.refreshed_at = time.monotonic()
+                            return on_row
+
+                        streams = [
+                            api.stream(build_query_words(command, proplist=columns) + ["=follow-only="], apply(name))
+                            for name, (command, columns, _) in ROUTER_TABLES.items()
+                        ]
+                        streams.append(self._heartbeat(api, credentials.router_id))
+                        # Returns as soon as the router or the network ends any stream
+                        done, pending = await asyncio.wait(
+                            [asyncio.ensure_future(stream) for stream in streams],
+                            return_when=asyncio.FIRST_COMPLETED
+                        )
+                        for task in pending:
+                            task.cancel()
+                        logger.warning(f"Follow stream for router {credentials.router_id} ended, restarting")
+            except asyncio.CancelledError:
+                await api.disconnect()
+                raise
+            except Exception as e:
+                logger.error(f"Follow stream error for router {credentials.router_id}: {e}")
+            await api.disconnect()
+            self.invalidate(credentials.router_id)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def run_refresher(self):
+        """Background task that keeps tracked routers' snapshots warm"""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                self._forget_idle_routers()
+                due = [
+                    credentials for router_id, credentials in self._routers.items()
+                    if router_id not in self._followers
+                    and (router_id not in self._snapshots
+                         or self._snapshots[router_id].age >= self.refresh_interval)
+                ]
+                if due:
+                    await asyncio.gather(*(self.refresh(credentials) for credentials in due))
+            except Exception as e:
+                logger.error(f"Router state refresher error: {e}")
+
+    async def close(self):
+        for follower in self._followers.values():
+            follower.cancel()
+        self._followers.clear()
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "routers": {
+                router_id: {
+                    "age_seconds": round(snapshot.age, 1),
+                    "users": len(snapshot.tables["users"].rows),
+                    "active": len(snapshot.tables["active"].rows),
+                    "following": router_id in self._followers,
+                }
+                for router_id, snapshot in self._snapshots.items()
+            },
+        }
+
+
+router_state_cache = RouterStateCache()